@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+benchmark.py
+Time scan, sync and list on generated catalog trees and write the results as JSON to compare between commits.
+"""
+import click
+import contextlib
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from lightroom_sync import lightroom_sync  # noqa: E402
+
+MB = 1024 * 1024
+
+
+def create_catalog(path, size, real=False, page_size=4096):
+    """Create a SQLite catalog of about size bytes
+
+    A real catalog is filled with rows, otherwise a small database is extended to the size as a sparse file.
+    """
+    conn = sqlite3.connect(str(path))
+    conn.execute(f"PRAGMA page_size = {page_size}")
+    conn.execute("CREATE TABLE Adobe_images(id_local INTEGER PRIMARY KEY, data BLOB)")
+    if real:
+        rows = max(1, size // (page_size * 4))
+        conn.executemany("INSERT INTO Adobe_images(data) VALUES (randomblob(?))",
+                         [(page_size * 3,) for _ in range(rows)])
+    conn.commit()
+    conn.close()
+    if not real:
+        with open(path, "r+b") as f:
+            f.truncate(max(size - size % page_size, os.path.getsize(path)))
+
+
+def create_tree(root, drives=3, catalogs=100, depth=3, previews=10, size=MB, real=False):
+    """Create drives with the same catalogs nested depth folders deep, each with a previews folder
+
+    Every catalog exists on every drive so sync has replicas to copy to.
+    """
+    random.seed(0)
+    for drive in range(drives):
+        for catalog in range(catalogs):
+            folder = Path(root) / f"drive_{drive}"
+            for level in range(depth):
+                folder = folder / f"level_{level}_{catalog % (level + 2)}"
+            folder.mkdir(parents=True, exist_ok=True)
+
+            name = f"catalog_{catalog}_v{catalog % 5 + 1:03}"
+            if drive == 0:
+                create_catalog(folder / f"{name}.lrcat", size, real=real)
+            else:
+                shutil.copy2(str(Path(root) / "drive_0" / folder.relative_to(Path(root) / f"drive_{drive}") /
+                                 f"{name}.lrcat"), str(folder / f"{name}.lrcat"))
+
+            preview_folder = folder / f"{name} Previews.lrdata"
+            for preview in range(previews):
+                subfolder = preview_folder / f"{preview % 16:X}"
+                subfolder.mkdir(parents=True, exist_ok=True)
+                (subfolder / f"{preview}.lrprev").write_bytes(b"\0" * 1024)
+
+
+def touch_catalogs(paths, page_size=4096):
+    """Change one page in each catalog and make it the newest so sync has something to copy
+
+    The change counter in the header is incremented like SQLite does on every write, since that's how sync
+    tells which catalogs changed.
+    """
+    for path in paths:
+        with open(path, "r+b") as f:
+            size = f.seek(0, os.SEEK_END)
+            f.seek(random.randrange(1, max(2, size // page_size)) * page_size)
+            f.write(os.urandom(page_size))
+            f.seek(24)
+            counter = (int.from_bytes(f.read(4), "big") + 1) % 2 ** 32
+            # The version-valid-for number at 92 has to match the counter for the rest of the header to be used
+            for offset in (24, 92):
+                f.seek(offset)
+                f.write(counter.to_bytes(4, "big"))
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+
+def copied_bytes(lrsync):
+    """Return the bytes written by all the copies sync recorded in the database"""
+    lrsync.execute("SELECT COALESCE(SUM(bytes), 0) FROM copies;")
+    return lrsync.cur.fetchone()[0]
+
+
+def timed(function, repeat=1):
+    """Call a function repeat times and return the seconds of every call"""
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            function()
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def startup(repeat=1):
+    """Time running the CLI in a new interpreter, which is what every command pays before doing anything"""
+    command = [sys.executable, "-m", "lightroom_sync.lightroom_sync", "--help"]
+    root = str(Path(__file__).resolve().parent.parent)
+    return timed(lambda: subprocess.run(command, cwd=root, stdout=subprocess.DEVNULL, check=True), repeat)
+
+
+def git_commit():
+    """Return the current commit of the repository, if there is one"""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=str(Path(__file__).resolve().parent),
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              universal_newlines=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(directory, drives=3, catalogs=100, depth=3, previews=10, size=MB, real=False, repeat=3,
+                   modes=("copy", "delta")):
+    """Generate a tree in directory, time every benchmark on it and return the results"""
+    tree = Path(directory) / "tree"
+    start = time.perf_counter()
+    create_tree(tree, drives=drives, catalogs=catalogs, depth=depth, previews=previews, size=size, real=real)
+    logging.info(f"Created tree in {time.perf_counter() - start:.1f} seconds")
+
+    lrsync = lightroom_sync.LightroomSync(str(Path(directory) / "benchmark.db"))
+    results = {}
+    results["startup"] = startup(repeat)
+    results["scan_for_catalogs"] = timed(lambda: lightroom_sync.scan_for_catalogs(tree), repeat)
+    results["scan"] = timed(lambda: lrsync.scan(tree), repeat)
+    lrsync.clear()
+    results["scan_incremental_first"] = timed(lambda: lrsync.scan(tree, incremental=True), 1)
+    results["scan_incremental"] = timed(lambda: lrsync.scan(tree, incremental=True), repeat)
+
+    names = [x[1] for x in lrsync.select_all_catalogs()]
+    results["last_modified_path"] = timed(lambda: [lrsync.last_modified_path(x) for x in names], repeat)
+    results["list_catalogs"] = timed(lrsync.list_catalogs, repeat)
+    results["list_paths"] = timed(lrsync.list_paths, repeat)
+    results["list_jsonl"] = timed(lambda: lrsync.print_list(output_format="jsonl"), repeat)
+
+    # The bytes the syncs wrote show that they copied something instead of timing syncs with nothing to do
+    written = {}
+    sources = [x[0] for x in lrsync.select_paths_under(str((tree / "drive_0").resolve()))]
+    for mode in modes:
+        seconds = []
+        before = copied_bytes(lrsync)
+        for _ in range(repeat):
+            touch_catalogs(sources)
+            seconds.extend(timed(lambda: lrsync.sync(mode=mode), 1))
+        results[f"sync_{mode}"] = seconds
+        written[f"sync_{mode}"] = copied_bytes(lrsync) - before
+    before = copied_bytes(lrsync)
+    results["sync_unchanged"] = timed(lrsync.sync, repeat)
+    written["sync_unchanged"] = copied_bytes(lrsync) - before
+    lrsync.close()
+
+    return {
+        "commit": git_commit(),
+        "created": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {
+            "drives": drives,
+            "catalogs": catalogs,
+            "depth": depth,
+            "previews": previews,
+            "size": size,
+            "real": real,
+            "repeat": repeat,
+        },
+        "results": {name: dict({"seconds": seconds, "best": min(seconds)},
+                               **({"bytes": written[name]} if name in written else {}))
+                    for name, seconds in results.items()},
+    }
+
+
+def compare_results(base, current, threshold=1.2):
+    """Return (name, base seconds, current seconds, ratio) for every benchmark and the ones that regressed"""
+    rows = []
+    regressions = []
+    for name, result in current["results"].items():
+        if name not in base["results"]:
+            continue
+        before = base["results"][name]["best"]
+        after = result["best"]
+        ratio = after / before if before else float("inf")
+        rows.append((name, before, after, ratio))
+        if ratio > threshold:
+            regressions.append(name)
+    return rows, regressions
+
+
+#
+# CLI
+#
+@click.group()
+def cli():
+    logging.getLogger().setLevel(logging.WARNING)
+
+
+@cli.command()
+@click.option("--output", type=click.Path(), default="benchmark.json", help="JSON file to write the results to")
+@click.option("--directory", type=click.Path(), default=None, help="Where to generate the tree, a temp dir by default")
+@click.option("--drives", type=int, default=3, help="Number of drives with a replica of every catalog")
+@click.option("--catalogs", type=int, default=100, help="Number of catalogs per drive")
+@click.option("--depth", type=int, default=3, help="Number of folders above every catalog")
+@click.option("--previews", type=int, default=10, help="Number of preview files per catalog")
+@click.option("--size", type=int, default=1, help="Size of every catalog in MB")
+@click.option("--real", is_flag=True, help="Fill the catalogs with data instead of making them sparse")
+@click.option("--repeat", type=int, default=3, help="Number of times to run every benchmark")
+@click.option("--mode", "modes", multiple=True, default=("copy", "delta"), help="Sync modes to benchmark")
+def run(output, directory, drives, catalogs, depth, previews, size, real, repeat, modes):
+    """Generate a catalog tree and time scan, sync and list on it"""
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        results = run_benchmarks(tmp, drives=drives, catalogs=catalogs, depth=depth, previews=previews,
+                                 size=size * MB, real=real, repeat=repeat, modes=modes)
+    Path(output).write_text(json.dumps(results, indent=2))
+    for name, result in results["results"].items():
+        print(f"{name.ljust(24)} {result['best']:.4f}s")
+    print(f"Wrote results to {output}")
+
+
+@cli.command()
+@click.argument("base", type=click.Path(exists=True))
+@click.argument("current", type=click.Path(exists=True))
+@click.option("--threshold", type=float, default=1.2, help="Slowdown ratio that counts as a regression")
+def compare(base, current, threshold):
+    """Compare two result files and fail if a benchmark got slower than the threshold"""
+    rows, regressions = compare_results(json.loads(Path(base).read_text()), json.loads(Path(current).read_text()),
+                                        threshold=threshold)
+    for name, before, after, ratio in rows:
+        print(f"{name.ljust(24)} {before:.4f}s -> {after:.4f}s  x{ratio:.2f}")
+    if regressions:
+        print(f"Regressions: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    cli()
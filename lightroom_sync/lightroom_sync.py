@@ -5,19 +5,41 @@ lightroom_sync.py
 Lightroom sync is a script to synchronize your lightroom catalogs across multiple devices.
 """
 import click
+import errno
+import io
 import os
 import sqlite3
 import re
+import json
 import logging
 import shutil
+import threading
+import queue
+import select
+import struct
+import sys
 import time
-from logging.config import dictConfig
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, redirect_stdout
+from itertools import islice
 from pathlib import Path
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def setup_logging(level="debug", filename="lightroom_sync.log"):
+    """Log to stderr and to a file, which isn't created until something is logged"""
+    # Only the CLI configures logging, so keep the import cost out of importing the module
+    from logging.config import dictConfig
 
-def setup_logging(level="debug"):
     if level == "info":
         log_level = logging.INFO
+    elif level == "warning":
+        log_level = logging.WARNING
     else:
         log_level = logging.DEBUG
 
@@ -32,11 +54,12 @@ def setup_logging(level="debug"):
                    "level": log_level},
             "fh": {"class": "logging.FileHandler",
                    "formatter": "f",
-                   "filename": "lightroom_sync.log",
+                   "filename": filename,
+                   "delay": True,
                    "level": log_level}
         },
         root={
-            "handlers": ["sh", "fh"],
+            "handlers": ["sh", "fh"] if filename else ["sh"],
             "level": log_level,
         },
     )
@@ -47,148 +70,814 @@ def setup_logging(level="debug"):
     return logger
 
 
-setup_logging(level="debug")
+SQLITE_MAGIC = b"SQLite format 3\x00"
+SQLITE_HEADER_SIZE = 100
+DELTA_PAGES_PER_BLOCK = 256
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+# Bytes to copy between checkpoints of a resumable copy and bytes to compare before resuming from one
+COPY_CHECKPOINT_SIZE = 256 * 1024 * 1024
+COPY_VERIFY_SIZE = 1024 * 1024
+# Checkpoint offset of a delta copy, which writes to the destination itself so it's half written until it's cleared
+IN_PLACE_OFFSET = -1
+# Times a copy that doesn't match its source when it's verified is made again
+VERIFY_RETRIES = 1
+# Bytes to copy at a time when a copy is rate limited
+THROTTLE_CHUNK_SIZE = 4 * 1024 * 1024
+# I/O scheduling (class, level) for ioprio_set, and its syscall number on every architecture
+IO_PRIORITIES = {"idle": (3, 0), "low": (2, 7)}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_SET_SYSCALLS = {"x86_64": 251, "i686": 289, "i386": 289, "aarch64": 30, "riscv64": 30, "armv7l": 314}
+# ioctl to clone a file on copy-on-write filesystems
+FICLONE = 0x40049409
+MB = 1024 * 1024
+FANOUT_BUFFER_SIZE = 8 * 1024 * 1024
+FANOUT_QUEUE_SIZE = 8
+FINGERPRINT_CHUNK_SIZE = 16 * 1024 * 1024
+FINGERPRINT_WORKERS = 4
+SCAN_WORKERS = 8
+SCAN_BATCH_SIZE = 500
+SCAN_QUEUE_SIZE = 10000
+ONLINE_COPY_PAGES = 1024
+ONLINE_COPY_SLEEP = 0.01
+PREVIEW_WORKERS = 16
+WATCH_INTERVAL = 1.0
+WATCH_DEBOUNCE = 5.0
+# Seconds to wait for a stat before a path counts as offline, and seconds before an offline volume is tried again
+STAT_TIMEOUT = 2.0
+OFFLINE_RETRY = 300.0
+# Copies per device used to estimate its throughput, and the bytes per second assumed without any history
+THROUGHPUT_HISTORY = 50
+DEFAULT_THROUGHPUT = 100 * 1024 * 1024
+# Rows fetched from the database at a time when listing, and rows looked at for the column widths of a table
+LIST_BATCH_SIZE = 500
+LIST_LOOKAHEAD = 1000
+LIST_FORMATS = ("table", "json", "jsonl", "csv")
+# Keys and titles of the columns of list
+CATALOG_COLUMNS = (("id", "ID"), ("name", "Name"), ("paths", "Paths"), ("last_sync", "Last sync"))
+PATH_COLUMNS = (("id", "ID"), ("path", "Path"), ("cat_id", "Cat. ID"), ("cat_name", "Cat. Name"))
+# Unix socket of the daemon, next to the database
+DAEMON_SOCKET = "lightroom_sync.sock"
+DAEMON_COMMANDS = ("status", "scan", "sync", "list")
+# Seconds importing the module may take, checked by the tests and the startup benchmark
+STARTUP_BUDGET = 0.5
+# Pages per backup chunk, the chunk mask gives about 64 pages per chunk on average
+BACKUP_PAGE_SIZE = 4096
+BACKUP_CHUNK_MASK = 0x3f
+BACKUP_MIN_PAGES = 16
+BACKUP_MAX_PAGES = 512
+BACKUP_KEEP_LAST = 10
+BACKUP_KEEP_DAYS = 90
+# Suffixes of the files SQLite writes next to a catalog while it's being saved
+CATALOG_JOURNAL_SUFFIXES = ("", "-journal", "-wal")
+
+# Each migration brings the database up one schema version, stored in PRAGMA user_version
+MIGRATIONS = [
+    """
+    -- Create catalogs table
+    CREATE TABLE IF NOT EXISTS catalogs(
+        catalog_id INTEGER PRIMARY KEY,
+        catalog_name TEXT NOT NULL UNIQUE,
+        last_sync INTEGER
+    );
+
+    -- Create paths table
+    CREATE TABLE IF NOT EXISTS paths(
+        path_id INTEGER PRIMARY KEY,
+        path text UNIQUE,
+        catalog_id INTEGER,
+        FOREIGN KEY(catalog_id) REFERENCES catalogs(catalog_id)
+    );
+    """,
+    """
+    -- Create fingerprints table
+    CREATE TABLE IF NOT EXISTS fingerprints(
+        path TEXT PRIMARY KEY,
+        size INTEGER,
+        mtime_ns INTEGER,
+        inode INTEGER,
+        fingerprint TEXT
+    );
+
+    -- Create directories table
+    CREATE TABLE IF NOT EXISTS directories(
+        path TEXT PRIMARY KEY,
+        mtime_ns INTEGER,
+        subdirs TEXT,
+        catalogs TEXT
+    );
+    """,
+    """
+    -- Index paths on catalog for counting and joining
+    CREATE INDEX IF NOT EXISTS paths_catalog_id ON paths(catalog_id);
+    """,
+    """
+    -- Create copies table
+    CREATE TABLE IF NOT EXISTS copies(
+        copy_id INTEGER PRIMARY KEY,
+        source TEXT,
+        destination TEXT,
+        strategy TEXT,
+        bytes INTEGER,
+        seconds REAL,
+        device INTEGER,
+        copied_at REAL
+    );
+    """,
+    """
+    -- Create versions table, the base name and version of every path filled in by scan
+    CREATE TABLE IF NOT EXISTS versions(
+        path TEXT PRIMARY KEY,
+        base_name TEXT NOT NULL,
+        version INTEGER,
+        device INTEGER
+    );
+
+    -- Index versions so the latest version of a catalog on every device is a single lookup
+    CREATE INDEX IF NOT EXISTS versions_base_name ON versions(base_name, device, version);
+    """,
+    """
+    -- Create checkpoints table, how far the unfinished copies got
+    CREATE TABLE IF NOT EXISTS checkpoints(
+        destination TEXT PRIMARY KEY,
+        source TEXT,
+        size INTEGER,
+        mtime_ns INTEGER,
+        offset INTEGER,
+        updated REAL
+    );
+    """,
+    """
+    -- Create settings table for the config command
+    CREATE TABLE IF NOT EXISTS settings(
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+    """,
+    """
+    -- Create offline table, the paths that couldn't be reached and why
+    CREATE TABLE IF NOT EXISTS offline(
+        path TEXT PRIMARY KEY,
+        volume TEXT,
+        reason TEXT,
+        since REAL
+    );
+    """,
+    """
+    -- Index copies on device for the throughput history of the planner
+    CREATE INDEX IF NOT EXISTS copies_device ON copies(device, copied_at);
+    """,
+    """
+    -- Create verifications table, every check of a copy against its source after a sync
+    CREATE TABLE IF NOT EXISTS verifications(
+        verification_id INTEGER PRIMARY KEY,
+        source TEXT,
+        destination TEXT,
+        expected TEXT,
+        actual TEXT,
+        quick_check TEXT,
+        ok INTEGER,
+        attempt INTEGER,
+        verified_at REAL
+    );
+    """,
+    """
+    -- Create headers table, the header of every SQLite catalog file when it was last read and last synced, and
+    -- the header of the source it was synced from
+    CREATE TABLE IF NOT EXISTS headers(
+        path TEXT PRIMARY KEY,
+        size INTEGER,
+        change_counter INTEGER,
+        schema_cookie INTEGER,
+        synced_size INTEGER,
+        synced_counter INTEGER,
+        synced_cookie INTEGER,
+        source_size INTEGER,
+        source_counter INTEGER,
+        source_cookie INTEGER,
+        diverged REAL
+    );
+    """,
+]
+
+# Settings of the config command, rate limits for a single device are stored as rate_limit:<path on the device>
+SETTINGS = ("rate_limit", "ionice", "drop_cache")
 
 
 class LightroomSync:
-    def __init__(self, db_name="lightroom_sync.db"):
+    def __init__(self, db_name="lightroom_sync.db", stat_timeout=STAT_TIMEOUT, cache=False):
+        """With cache the fingerprints and devices are also kept in memory, for an instance that outlives a single
+        command"""
         self.db = db_name
         self.conn = sqlite3.connect(self.db)
         self.cur = self.conn.cursor()
+        self.transaction_depth = 0
+        self.stat_timeout = stat_timeout
+        # Volumes whose stats timed out, by the monotonic time they did
+        self.offline_volumes = {}
+        # Fingerprints by path with the stat key they were taken at, None if they're only kept in the database
+        self.fingerprints = {} if cache else None
+        # Devices by directory, None if every path is stat'ed again
+        self.devices = {} if cache else None
+        self.backups = BackupStore(Path(db_name).with_suffix(".backups"))
         self.create_tables()
 
-    def sync(self, catalog_name=None, backup=True):
-        """Sync all or just one catalog across the paths found in the database"""
-        if catalog_name is not None:
-            # Get all paths for catalog
-            paths = self.get_catalog_paths(catalog_name)
-            # Get latest modified path
-            last_modified = self.last_modified_path(catalog_name)
-            logging.debug(f"Last modified file was {last_modified}")
-
-            # Copy latest to the other paths
-            for path in paths:
-                if path.resolve() != last_modified.resolve():
-                    shutil.copy2(str(last_modified.resolve()), str(path.resolve()))
-                    logging.debug(f"Copied catalog from {last_modified.resolve()} to {path.resolve()}")
-            # Update last sync date in database
-            self.update_last_sync(catalog_name, time.time())
-            return True
-
-    def scan(self, directory):
-        """Scan a directory and add all Lightroom catalogs to database"""
-        print(f"Scanning {directory} for Lightroom catalogs")
-        # Get list of catalog paths
-        catalogs = scan_for_catalogs(directory)
-        logging.debug(f"Found {len(catalogs)} catalogs in {directory}")
-
-        for catalog in catalogs:
-            logging.debug(f"Processing {catalog}")
-            path = str(catalog.resolve())
-            name = str(catalog.stem)
-            logging.debug(f"{name, path}")
+    def sync(self, catalog_name=None, backup=True, mode="copy", workers=None, options=None, previews=False,
+             latest_only=False, io_limits=None, io_priority=None, plan=None, verify=False):
+        """Sync all or just one catalog across the paths found in the database
+
+        mode is one of COPY_MODES, "copy" copies the whole file, "delta" only rewrites the pages that differ,
+        "fanout" reads the source once and writes it to all paths at the same time and "online" takes a
+        consistent snapshot with the SQLite backup API. options are passed on to the copy function of the mode.
+        With previews the .lrdata preview folders next to the catalogs are synced as well.
+        With latest_only only the newest version of every catalog is synced and older versions are left alone.
+        With backup every destination is stored in the backup store right before it's overwritten, under the
+        same device scheduling and io_limits as the copies, and a destination that can't be backed up isn't
+        overwritten. Copies run in parallel as long as they don't touch the same device.
+        io_limits are the IOLimits of the copies and io_priority one of IO_PRIORITIES, both from the settings
+        if they're not given. plan is a list of jobs from plan_sync or load_plan to run instead of planning,
+        leaving out the catalogs that were written to since they were planned. With verify every copy is read
+        back and compared to the source, copies that don't match are made again and a catalog that still
+        doesn't match fails.
+        """
+        settings = self.select_settings()
+        if io_limits is None:
+            io_limits = self.io_limits(settings=settings)
+        io_priority = io_priority or settings.get("ionice")
+        # The priority is only lowered for this sync, so a daemon goes back to its own priority afterwards
+        with lowered_io_priority(io_priority):
+            return self._sync(catalog_name, mode=mode, workers=workers, options=options, previews=previews,
+                              latest_only=latest_only, io_limits=io_limits, backup=backup, plan=plan, verify=verify)
+
+    def _sync(self, catalog_name, mode, workers, options, previews, latest_only, io_limits, backup, plan, verify):
+        """Plan or check the jobs of sync, back up and copy them and record the result"""
+        with metrics.phase("sync.plan"):
+            if plan is None:
+                jobs = self.plan_sync(catalog_name, mode=mode, previews=previews, latest_only=latest_only)
+            else:
+                jobs = self.check_plan(plan)
+        catalogs = {job["catalog"] for job in jobs}
+        # Catalogs that were edited in more than one place are left for the user to sort out
+        failed = {job["catalog"] for job in jobs if job.get("diverged")}
+        # The checkpoints are written on their own connection, which can't while this one holds a write lock
+        self.commit()
+        checkpoints = CopyCheckpoints(self.db)
+        try:
+            with metrics.phase("sync.copy"):
+                failed |= run_sync_jobs([x for x in jobs if x["catalog"] not in failed], mode=mode,
+                                        workers=workers, options=options, checkpoints=checkpoints,
+                                        io_limits=io_limits, verify=verify, backups=self.backups if backup else None)
+        finally:
+            checkpoints.close()
+        snapshots = sum(job.get("snapshots", 0) for job in jobs)
+
+        with metrics.phase("sync.record"), self.transaction():
+            # The copies now have the same content as the source, so remember that instead of hashing them again
+            for job in jobs:
+                if job["catalog"] not in failed and job["fingerprint"] is not None:
+                    for destination in job["destinations"]:
+                        self.store_fingerprint(destination, job["fingerprint"])
+            self.insert_copies(jobs)
+            self.insert_verifications(jobs)
+            # Every reachable path of a synced catalog now has the content of the source, but not always its
+            # header, an online copy for one is a new database with a change counter of its own
+            headers = {}
+            for job in jobs:
+                if job["catalog"] in failed or job.get("header") is None:
+                    continue
+                for path in job["mtimes"]:
+                    if path == str(job["source"]):
+                        headers[path] = (job["header"], job["header"])
+                    elif path not in headers:
+                        headers[path] = (catalog_header(path), job["header"])
+            self.store_synced_headers([(x, *y) for x, y in headers.items() if y[0] is not None])
 
-            self.insert_catalog(name)
-            logging.debug(f"Added catalog {name} to database")
+            # Update last sync date in database
+            self.update_last_syncs([(catalog, time.time()) for catalog in sorted(catalogs - failed)])
+
+        # Pruning lists every chunk, so it's only worth it when new snapshots were stored
+        if snapshots:
+            with metrics.phase("sync.prune"):
+                self.backups.prune()
+        return not failed
+
+    def io_limits(self, rate_limit=None, device_limits=None, drop_cache=None, settings=None):
+        """Return the IOLimits from the settings, with the given limits in MB/s taking precedence
+
+        device_limits maps a path on a device to the limit of that device.
+        """
+        if settings is None:
+            settings = self.select_settings()
+        if rate_limit is None:
+            rate_limit = float(settings.get("rate_limit", 0))
+        limits = {x[len("rate_limit:"):]: float(y) for x, y in settings.items() if x.startswith("rate_limit:")}
+        limits.update(device_limits or {})
+        # The limit of a drive that isn't mounted would end up on the device of the mount point
+        limits = {x: y for x, y in limits.items() if os.path.exists(x)}
+        if drop_cache is None:
+            drop_cache = settings.get("drop_cache", "false").lower() in ("1", "true", "yes", "on")
+        return IOLimits(rate_limit * MB, {device_id(x): y * MB for x, y in limits.items()}, drop_cache=drop_cache)
+
+    def restore(self, snapshot_id, destination=None, backup=True):
+        """Restore a snapshot to the path it was taken of, or to destination
+
+        With backup the file that's replaced is stored as a snapshot first, so a restore can be undone.
+        """
+        manifest = self.backups.find(snapshot_id)
+        destination = Path(destination or manifest["path"])
+        if backup and destination.exists():
+            self.backups.snapshot(destination, manifest["catalog"])
+        return self.backups.restore(snapshot_id, destination)
+
+    def plan_sync(self, catalog_name=None, mode="copy", previews=False, latest_only=False, metadata_only=False):
+        """Return the copy jobs needed to sync one catalog or all catalogs if no name is given
+
+        Every job is a dict with the catalog name, the source path, its size and fingerprint, the destination
+        paths, the (source, destination) preview folders to sync, the devices they are on and the mtimes of
+        the catalog paths. Destinations with the same fingerprint as the source are left out and a catalog
+        that is already in sync gets a job without destinations, which still syncs the preview folders if
+        previews is True. With latest_only the catalogs are replaced by the newest version of their base name.
+        With metadata_only no files are hashed, only cached fingerprints are used and destinations of the same
+        size without one are planned as if they differ. See compare_replicas for how the source is picked. A
+        catalog that was edited in more than one place gets a job without destinations that lists the paths
+        under "diverged".
+        """
+        if catalog_name is None:
+            catalog_names = [x[1] for x in self.select_all_catalogs()]
+        else:
+            catalog_names = [catalog_name]
+        if latest_only:
+            catalog_names = self.latest_catalog_names(catalog_names)
 
-            self.insert_path(path, name)
-            logging.debug(f"Added path {path} to database and linking to catalog {name}")
+        jobs = []
+        for name in catalog_names:
+            # Get all paths for catalog
+            paths = self.get_catalog_paths(name)
+            if not paths:
+                continue
+            # Only use the paths that answer in time, the others are on volumes that are offline
+            stats = self.stat_catalog_paths(paths)
+            if not stats:
+                logging.warning(f"None of the paths of {name} are reachable, skipping it")
+                continue
+            latest, destinations, header, diverged = self.compare_replicas(name, stats, cached_only=metadata_only)
+            source = latest.resolve()
+            logging.debug(f"Newest file is {source}")
+            if diverged:
+                logging.warning(f"{name} was changed in more than one place since it was last synced, "
+                                f"skipping it: {', '.join(diverged)}")
+
+            # The header already tells which copies differ, so the source is only hashed for the mtime fallback
+            fingerprint = self.fingerprint(source, cached_only=metadata_only or header is not None)
+            others = [path.resolve() for path in stats if path.resolve() != source]
+            if mode == "fanout" or not destinations:
+                groups = [(destinations, destinations)]
+            else:
+                groups = [([destination], [destination]) for destination in destinations]
+            # Catalogs that are already in sync can still have outdated previews
+            in_sync = [x for x in others if x not in destinations]
+            if previews and in_sync and destinations:
+                groups.append(([], in_sync))
+            elif previews and in_sync:
+                groups = [([], in_sync)]
+            if diverged:
+                groups = [([], [])]
+
+            for group, targets in groups:
+                jobs.append({
+                    "catalog": name,
+                    "source": source,
+                    "fingerprint": fingerprint,
+                    "destinations": group,
+                    "previews": [x for target in targets for x in preview_pairs(source, target)] if previews else [],
+                    "devices": sorted({self.device_id(x) for x in [source, *targets]}),
+                    "size": stats[latest].st_size,
+                    "mtimes": {str(x.resolve()): y.st_mtime_ns for x, y in stats.items()},
+                    "header": header,
+                    "diverged": diverged,
+                })
+        return jobs
+
+    def compare_replicas(self, catalog_name, stats, cached_only=False):
+        """Return the newest of the reachable paths of a catalog, the paths that differ from it, its header and the
+        paths that diverged
+
+        SQLite catalogs are compared by the size, change counter and schema cookie in their first 100 bytes,
+        since every write changes them, instead of by mtime, which has a 2 second resolution on FAT drives, is off
+        by hours on NAS mounts in another timezone and changes when a file is touched. A path changed if its header
+        isn't the one it had after the last sync, and the newest path is the one of those with the highest change
+        counter. A path that changed as well but doesn't have the same content was edited on its own, so nothing
+        is copied and the changed paths are returned as diverged and flagged in the database. Files that aren't
+        SQLite databases or are in WAL mode, where the counter isn't kept up to date, are compared by mtime and
+        fingerprint instead. Paths that didn't change are the same if they were synced from the same source, since
+        an online copy has a header of its own. A path with an interrupted delta copy is always a destination.
+        With cached_only nothing is hashed.
+        """
+        # Paths a delta copy was interrupted on are half written by the sync, not edited
+        interrupted = self.select_interrupted_copies(stats)
+        headers = self.read_headers(stats)
+        if headers is None:
+            latest = max([x for x in stats if x not in interrupted] or stats, key=lambda x: stats[x].st_mtime)
+            source = latest.resolve()
+            destinations = [x.resolve() for x in stats if x.resolve() != source and (
+                x in interrupted or not self.is_identical(x, source, cached_only=cached_only))]
+            return latest, destinations, None, []
+
+        synced = self.select_synced_headers(stats)
+        # A path without a synced header is new, it only counts as changed if it's ahead of all the others
+        top = max([x[0][1] for x in synced.values()] or [0])
+        changed = []
+        for path in stats:
+            if path in interrupted:
+                continue
+            if path in synced and headers[path] != synced[path][0]:
+                changed.append(path)
+            elif path not in synced and synced and headers[path][1] > top:
+                changed.append(path)
+        latest = max(changed or [x for x in stats if x not in interrupted] or stats,
+                     key=lambda x: (headers[x][1], stats[x].st_mtime))
+        source = latest.resolve()
+
+        destinations = []
+        diverged = []
+        for path in stats:
+            if path == latest or path.resolve() == source:
+                continue
+            if path in interrupted:
+                destinations.append(path.resolve())
+                continue
+            if path in changed or latest in changed or path not in synced or latest not in synced:
+                same = headers[path] == headers[latest]
+                if same:
+                    same = (cached_only and path in changed) or self.is_identical(path, source,
+                                                                                  cached_only=cached_only)
+            else:
+                # Paths that are both as they were after a sync are the same if they were synced from the same file
+                same = synced[path][1] == synced[latest][1]
+            if not same and path in changed:
+                diverged.append(path)
+            elif not same:
+                destinations.append(path.resolve())
+        if diverged:
+            diverged = [str(x.resolve()) for x in [latest, *diverged]]
+            self.flag_diverged(diverged)
+            return latest, [], headers[latest], diverged
+        return latest, destinations, headers[latest], []
+
+    def read_headers(self, stats):
+        """Return the size, change counter and schema cookie of every path, or None if one isn't a SQLite catalog
+
+        The headers are stored in the database as well.
+        """
+        headers = {}
+        for path, stat in stats.items():
+            header = sqlite_header(path)
+            if header is None:
+                return None
+            headers[path] = (stat.st_size, *header)
+        rows = [(str(x.resolve()),) for x in headers]
+        self.executemany("INSERT OR IGNORE INTO headers(path) VALUES (?);", rows)
+        self.executemany("UPDATE headers SET size = ?, change_counter = ?, schema_cookie = ? WHERE path = ?;",
+                         [(*y, str(x.resolve())) for x, y in headers.items()])
+        self.commit()
+        return headers
+
+    def estimate_plan(self, jobs, mode="copy"):
+        """Return the jobs of a plan with the bytes each one moves and an estimate of the seconds it takes
+
+        The estimate uses the throughput of the last copies to every device. Jobs on different devices run at
+        the same time, so the plan takes as long as its busiest device. Delta copies are estimated as full
+        copies since the pages that differ aren't known without reading them. The result can be written as JSON
+        and passed back to sync with load_plan.
+        """
+        throughput = {x: y / z for x, (y, z) in self.select_throughput().items() if y and z}
+        load = {}
+        planned = []
+        for job in jobs:
+            seconds = 0.0
+            moved = job["size"] * len(job["destinations"])
+            # A fanout job writes to all its destinations at the same time
+            for destination in job["destinations"]:
+                rate = throughput.get(self.device_id(destination), DEFAULT_THROUGHPUT)
+                seconds = max(seconds, job["size"] / rate)
+            for source, destination in job["previews"]:
+                source_files, _ = tree_listing(source)
+                destination_files, _ = tree_listing(destination)
+                size = sum(source_files[x][0] for x in tree_changes(source_files, destination_files))
+                moved += size
+                seconds += size / throughput.get(self.device_id(destination), DEFAULT_THROUGHPUT)
+            for device in job["devices"]:
+                load[device] = load.get(device, 0.0) + seconds
+            planned.append({
+                "catalog": job["catalog"],
+                "source": str(job["source"]),
+                "fingerprint": job["fingerprint"],
+                "destinations": [str(x) for x in job["destinations"]],
+                "previews": [[str(x), str(y)] for x, y in job["previews"]],
+                "devices": job["devices"],
+                "size": job["size"],
+                "mtimes": job["mtimes"],
+                "header": job.get("header"),
+                "diverged": job.get("diverged", []),
+                "bytes": moved,
+                "seconds": seconds,
+            })
+        return {
+            "created": time.time(),
+            "mode": mode,
+            "bytes": sum(x["bytes"] for x in planned),
+            "seconds": max(load.values(), default=0.0),
+            "throughput": {str(x): y / MB for x, y in throughput.items()},
+            "jobs": planned,
+        }
+
+    def check_plan(self, jobs):
+        """Return the jobs of a plan that can still run
+
+        A catalog with a destination that changed since it was planned is left out, since copying over it
+        could lose work. A source that changed is still copied, but without the fingerprint of the plan.
+        """
+        checked = []
+        mounts = mount_points()
+        for job in jobs:
+            paths = [Path(x) for x in job["mtimes"]]
+            stats, failed = stat_paths(paths, timeout=self.stat_timeout,
+                                       volumes={x: volume_of(x, mounts) for x in paths})
+            mtimes = {str(x): y.st_mtime_ns for x, y in stats.items()}
+            changed = [x for x, y in job["mtimes"].items() if mtimes.get(x) != y]
+            if any(x != str(job["source"]) for x in changed):
+                logging.warning(f"{job['catalog']} changed since it was planned, skipping it")
+                continue
+            if changed:
+                job = dict(job, fingerprint=None)
+            checked.append(job)
+        return checked
+
+    def scan(self, *directories, incremental=False, workers=SCAN_WORKERS, batch_size=SCAN_BATCH_SIZE):
+        """Scan directories and add all Lightroom catalogs to database
+
+        The directories are walked at the same time and catalogs are added in batches while they're found.
+        An incremental scan only lists the directories that changed since the last incremental scan and also
+        removes the catalogs that are gone from the directories. Directories that can't be read, like a drive
+        that isn't mounted, keep what was stored under them.
+        """
+        roots = [os.path.realpath(x) for x in directories]
+        print(f"Scanning {', '.join(str(x) for x in directories)} for Lightroom catalogs")
+
+        known = {}
+        if incremental:
+            for root in roots:
+                known.update(self.select_directories(root))
+
+        count = 0
+        batch = []
+        changed = []
+        seen = set()
+        found = set()
+        listed_count = 0
+        unreachable = []
+        with metrics.phase("scan.walk"):
+            for path, mtime_ns, subdirs, files, listed in walk_catalog_directories_parallel(roots, known, workers,
+                                                                                           unreachable):
+                if incremental:
+                    seen.add(path)
+                    if listed:
+                        changed.append((path, mtime_ns, subdirs, files))
+                        listed_count += 1
+                    if len(changed) >= batch_size:
+                        self.store_directories(changed)
+                        changed = []
+
+                for f in files:
+                    catalog = Path(path) / f
+                    logging.debug(f"Processing {catalog}")
+                    batch.append(catalog)
+                    if incremental:
+                        found.add(str(catalog.resolve()))
+                if len(batch) >= batch_size:
+                    self.add_catalogs(batch)
+                    count += len(batch)
+                    batch = []
+
+            self.add_catalogs(batch)
+            count += len(batch)
+        metrics.incr("catalogs_found", count)
+        logging.debug(f"Found {count} catalogs in {', '.join(roots)}")
+
+        if incremental:
+            with metrics.phase("scan.remove"):
+                # A directory that couldn't be read isn't gone, so nothing under it is removed
+                prefixes = tuple(os.path.join(x, "") for x in unreachable)
+                kept = set(unreachable)
+
+                def is_kept(path):
+                    return path in kept or path.startswith(prefixes)
+
+                for path in unreachable:
+                    logging.warning(f"Couldn't read {path}, keeping the catalogs stored under it")
+                self.store_directories(changed)
+                self.delete_directories([x for x in known if x not in seen and not is_kept(x)])
+                logging.debug(f"Listed {listed_count} of {len(seen)} directories")
+                # Remove catalogs that have disappeared since the last scan
+                missing = [x[0] for root in roots for x in self.select_paths_under(root)
+                           if x[0] not in found and not is_kept(x[0])]
+                with self.transaction():
+                    self.delete_paths(missing)
+                    self.delete_catalogs_without_paths()
+                logging.debug(f"Removed {len(missing)} missing paths from database")
+
+        print(f"Found {count} Lightroom catalogs")
+
+    def add_catalogs(self, catalogs):
+        """Add catalog files and their versions to the database in a single transaction"""
+        paths = [(str(catalog.resolve()), str(catalog.stem)) for catalog in catalogs]
+        versions = [(path, *filename_to_name_and_version(path), self.device_id(path)) for path, name in paths]
+        with self.transaction():
+            self.insert_catalogs([name for path, name in paths])
+            self.insert_paths(paths)
+            self.insert_versions(versions)
+        logging.debug(f"Added {len(paths)} paths to database")
+        return True
 
-        print(f"Found {len(catalogs)} Lightroom catalogs")
+    def latest_versions(self, base_name):
+        """Return a dict with the (version, path) of the newest version of a catalog on every device"""
+        return {x[0]: (x[1], Path(x[2])) for x in self.select_latest_versions(base_name)}
+
+    def latest_catalog_names(self, catalog_names):
+        """Replace every catalog name with the name of the newest version of its base name
+
+        Catalogs that aren't in the version index yet are kept as they are.
+        """
+        newest = {x[0]: Path(x[2]).stem for x in self.select_newest_versions()}
+        names = []
+        for name in catalog_names:
+            latest = newest.get(filename_to_name_and_version(name)[0], name)
+            if latest != name:
+                logging.debug(f"Skipping {name}, the newest version is {latest}")
+            if latest not in names:
+                names.append(latest)
+        return names
 
     def clear(self):
         """Clear out the database"""
         self.execute("DELETE FROM catalogs")
         self.execute("DELETE FROM paths")
+        self.execute("DELETE FROM directories")
+        self.execute("DELETE FROM versions")
+        self.execute("DELETE FROM headers")
         self.commit()
         return True
 
-    def list_catalogs(self):
-        """List all paths in the database"""
-        paths = self.select_all_paths()
-        catalogs = []
-        for c in self.select_all_catalogs():
-            catalogs.append({
-                "id": c[0],
-                "name": c[1],
-                "paths": len([x for x in paths if x[2] == c[0]]),
-                "last_sync": c[2]
-            })
-
-        # Setup formatting
-        len_id = len("ID") + 2
-        if catalogs:
-            len_name = len(max([catalogs[x]["name"] for x in range(len(catalogs))], key=len)) + 2
-        else:
-            len_name = 8
-
-        len_paths = len("Paths") + 2
-        len_last_sync = len("Last sync") + 2
-        if catalogs:
-            longets_sync_date = [catalogs[x]["last_sync"] for x in range(len(catalogs))
-                                 if not catalogs[x]["last_sync"] is None]
-            if longets_sync_date:
-                len_last_sync = len(max(longets_sync_date, key=len)) + 2
-
-        print("ID".ljust(len_id),
-              "Name".ljust(len_name),
-              "Paths".ljust(len_paths),
-              "Last sync".ljust(len_last_sync))
-        print("".ljust(len_id + len_name + len_paths + len_last_sync + 1, "-"))
-        for catalog in catalogs:
-            print(str(catalog['id']).ljust(len_id),
-                  str(catalog['name']).ljust(len_name),
-                  str(catalog['paths']).ljust(len_paths),
-                  str(catalog['last_sync']).ljust(len_last_sync))
-
+    def list_catalogs(self, name=None, limit=None, offset=0, output_format="table"):
+        """List all catalogs in the database, or the ones with a name matching a pattern, and return them"""
+        catalogs = [dict(zip([x[0] for x in CATALOG_COLUMNS], row))
+                    for row in self.iter_catalogs_with_path_count(name, limit=limit, offset=offset)]
+        write_rows(catalogs, CATALOG_COLUMNS, output_format)
         return catalogs
 
-    def list_paths(self):
-        """List all paths in the database"""
-        catalogs = self.select_all_catalogs()
-        paths = []
-        for p in self.select_all_paths():
-            paths.append({
-                "id": p[0],
-                "path": p[1],
-                "cat_id": p[2],
-                "cat_name": [x[1] for x in catalogs if x[0] == p[2]][0]
-            })
-
-        # Setup formatting
-        len_id = len("ID") + 2
-        if paths:
-            len_path = len(max([paths[x]["path"] for x in range(len(paths))], key=len)) + 2
-        else:
-            len_path = 8
-        len_cat_id = len("Cat. ID") + 2
-        if paths:
-            len_cat_name = len(max([paths[x]["cat_name"] for x in range(len(paths))], key=len)) + 2
-        else:
-            len_cat_name = len("Cat. Name") + 2
+    def list_paths(self, name=None, limit=None, offset=0, output_format="table"):
+        """List all paths in the database, or the paths of catalogs with a name matching a pattern, and return them"""
+        paths = [dict(zip([x[0] for x in PATH_COLUMNS], row))
+                 for row in self.iter_paths_with_catalog_name(name, limit=limit, offset=offset)]
+        write_rows(paths, PATH_COLUMNS, output_format)
+        return paths
 
-        print("ID".ljust(len_id),
-              "Path".ljust(len_path),
-              "Cat. ID".ljust(len_cat_id),
-              "Cat. Name".ljust(len_cat_name))
-        print("".ljust(len_id + len_path + len_cat_id + len_cat_name, "-"))
-        for path in paths:
-            print(str(path['id']).ljust(len_id),
-                  str(path['path']).ljust(len_path),
-                  str(path['cat_id']).ljust(len_cat_id),
-                  str(path['cat_name']).ljust(len_cat_name))
+    def print_list(self, catalogs=True, name=None, limit=None, offset=0, output_format="table", file=None):
+        """Print the catalogs or paths while they're read from the database and return the number of rows
 
-        return paths
+        Unlike list_catalogs and list_paths the rows aren't kept, so memory use doesn't grow with the database.
+        """
+        if catalogs:
+            columns = CATALOG_COLUMNS
+            rows = self.iter_catalogs_with_path_count(name, limit=limit, offset=offset)
+        else:
+            columns = PATH_COLUMNS
+            rows = self.iter_paths_with_catalog_name(name, limit=limit, offset=offset)
+        keys = [x[0] for x in columns]
+        return write_rows((dict(zip(keys, row)) for row in rows), columns, output_format, file=file)
 
     def last_modified_path(self, catalog_name):
-        """Get the last modified file for a catalog"""
+        """Get the newest file for a catalog, or None if none of its files can be reached
+
+        SQLite catalogs are compared by their headers and other files by mtime, see compare_replicas.
+        """
         cat_id = self.catalog_id_from_name(catalog_name)
 
-        paths = [x[1] for x in self.select_all_paths_with_catalog_id(cat_id)]
-        paths_with_mtimes = mtimes(paths)
-        latest = max(paths_with_mtimes, key=paths_with_mtimes.get)
-        latest_path = Path(latest)
-        return latest_path
+        paths = [Path(x[1]) for x in self.select_all_paths_with_catalog_id(cat_id)]
+        stats = self.stat_catalog_paths(paths)
+        if not stats:
+            return None
+        return self.compare_replicas(catalog_name, stats, cached_only=True)[0]
+
+    def stat_catalog_paths(self, paths):
+        """Stat paths in parallel and return a dict with the stat of every path that could be reached
+
+        Paths that are missing or don't answer within the stat timeout are marked offline in the database
+        and paths that are back are marked online again. A volume with a path that timed out is skipped
+        without waiting for OFFLINE_RETRY seconds, so a hung network share only costs one timeout.
+        """
+        now = time.monotonic()
+        self.offline_volumes = {x: y for x, y in self.offline_volumes.items() if now - y < OFFLINE_RETRY}
+        mounts = mount_points()
+        volumes = {path: volume_of(path, mounts) for path in paths}
+        skipped = {x: "volume offline" for x in paths if volumes[x] in self.offline_volumes}
+        stats, failed = stat_paths([x for x in paths if x not in skipped], timeout=self.stat_timeout, volumes=volumes)
+        for path, reason in failed.items():
+            if reason == "timeout":
+                logging.warning(f"{path} didn't answer in {self.stat_timeout} seconds, skipping {volumes[path]}")
+                self.offline_volumes[volumes[path]] = now
+        failed.update(skipped)
+        # A volume that went away can come back as another device
+        if failed and self.devices:
+            self.devices.clear()
+
+        offline = self.select_offline(paths)
+        with self.transaction():
+            self.insert_offline([(x, volumes[x], y) for x, y in failed.items() if str(x) not in offline])
+            self.delete_offline([x for x in stats if str(x) in offline])
+        return stats
+
+    def device_id(self, path):
+        """Return the device a path is on, from memory for paths in a directory that was looked up before"""
+        if self.devices is None:
+            return device_id(path)
+        directory = os.path.dirname(os.path.abspath(str(path)))
+        if directory not in self.devices:
+            self.devices[directory] = device_id(path)
+        return self.devices[directory]
+
+    def watch(self, debounce=WATCH_DEBOUNCE, interval=WATCH_INTERVAL, mode="copy", poll=False, stop=None):
+        """Watch all paths in the database and sync a catalog when its files change
+
+        Changes are collected until a catalog has been quiet for debounce seconds, so a save in Lightroom only
+        triggers one sync of that catalog. Runs until the stop event is set.
+        """
+        catalogs = {x[1]: x[3] for x in self.select_paths_with_catalog_name()}
+        watcher = create_watcher(catalogs, poll=poll, interval=interval)
+        logging.info(f"Watching {len(catalogs)} paths with {type(watcher).__name__}")
+
+        changed = {}
+        synced = {}
+        try:
+            while stop is None or not stop.is_set():
+                timeout = interval
+                if changed:
+                    timeout = min(timeout, max(0.0, min(changed.values()) + debounce - time.monotonic()))
+                for path in watcher.wait(timeout):
+                    # Skip the events caused by our own copies
+                    if synced.get(path) == catalog_state(path):
+                        continue
+                    logging.debug(f"{path} changed")
+                    changed[catalogs[path]] = time.monotonic()
+
+                now = time.monotonic()
+                for name in [x for x, last_change in changed.items() if now - last_change >= debounce]:
+                    del changed[name]
+                    logging.info(f"Syncing {name}")
+                    try:
+                        self.sync(name, mode=mode)
+                    except Exception:
+                        logging.exception(f"Failed to sync {name}")
+                    for path in self.get_catalog_paths(name):
+                        synced[str(path)] = catalog_state(path)
+        finally:
+            watcher.close()
+        return True
+
+    def fingerprint(self, path, cached_only=False):
+        """Get the content fingerprint of a file, only hashing it if it changed since it was last hashed
+
+        With cached_only None is returned instead of hashing the file.
+        """
+        path = str(path)
+        key = stat_key(path)
+        if self.fingerprints is not None and self.fingerprints.get(path, (None,))[0] == key:
+            return self.fingerprints[path][1]
+        self.execute("SELECT fingerprint FROM fingerprints "
+                     "WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ?",
+                     (path, *key))
+        row = self.cur.fetchone()
+        if row:
+            fingerprint = row[0]
+        elif cached_only:
+            return None
+        else:
+            fingerprint = file_fingerprint(path)
+            self.store_fingerprint(path, fingerprint)
+        if self.fingerprints is not None:
+            self.fingerprints[path] = (key, fingerprint)
+        return fingerprint
+
+    def is_identical(self, path, source, cached_only=False):
+        """Check if a file has the same content as the source file
+
+        With cached_only files without a cached fingerprint count as different.
+        """
+        path = Path(path)
+        if not path.is_file() or path.stat().st_size != Path(source).stat().st_size:
+            return False
+        fingerprint = self.fingerprint(path, cached_only=cached_only)
+        return fingerprint is not None and fingerprint == self.fingerprint(source, cached_only=cached_only)
 
     def get_catalog_paths(self, catalog):
         """Get all paths for a catalog name or id"""
@@ -202,10 +891,32 @@ class LightroomSync:
 
     # Database actions
     def commit(self):
-        self.conn.commit()
-
-    def execute(self, query):
-        self.cur.execute(query)
+        """Commit unless inside a transaction block, which commits when it ends"""
+        if not self.transaction_depth:
+            metrics.incr("db_commits")
+            self.conn.commit()
+
+    def execute(self, query, parameters=()):
+        metrics.incr("db_queries")
+        self.cur.execute(query, parameters)
+
+    def executemany(self, query, parameters):
+        metrics.incr("db_queries")
+        self.cur.executemany(query, parameters)
+
+    @contextmanager
+    def transaction(self):
+        """Run everything in the block as one transaction, rolling back if it fails"""
+        self.transaction_depth += 1
+        try:
+            yield
+        except Exception:
+            self.transaction_depth -= 1
+            if not self.transaction_depth:
+                self.conn.rollback()
+            raise
+        self.transaction_depth -= 1
+        self.commit()
 
     def close(self):
         self.conn.close()
@@ -214,23 +925,16 @@ class LightroomSync:
     # Database related
     #
     def create_tables(self):
-        """Create the tables to be used"""
-        self.execute(""" -- Create catalogs table
-                    CREATE TABLE IF NOT EXISTS catalogs(
-                        catalog_id INTEGER PRIMARY KEY,
-                        catalog_name TEXT NOT NULL UNIQUE,
-                        last_sync INTEGER
-                    );
-                    """)
-        self.execute("""
-                    -- Create paths table
-                    CREATE TABLE IF NOT EXISTS paths(
-                        path_id INTEGER PRIMARY KEY,
-                        path text UNIQUE,
-                        catalog_id INTEGER,
-                        FOREIGN KEY(catalog_id) REFERENCES catalogs(catalog_id)
-                    );
-                """)
+        """Create the tables to be used, or migrate an older database to the current schema"""
+        self.execute("PRAGMA user_version")
+        version = self.cur.fetchone()[0]
+        # An up to date database only costs reading the version
+        if version >= len(MIGRATIONS):
+            return True
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            logging.debug(f"Migrating {self.db} to schema version {number}")
+            self.cur.executescript(migration)
+            self.execute(f"PRAGMA user_version = {number}")
         self.commit()
         return True
 
@@ -244,21 +948,61 @@ class LightroomSync:
         self.execute(f"SELECT * FROM paths")
         return self.cur.fetchall()
 
+    def iter_catalogs_with_path_count(self, name=None, limit=None, offset=0):
+        """Yield the id, name, number of paths and last sync date of the catalogs with a name matching a pattern"""
+        return self.iter_rows("SELECT catalogs.catalog_id, catalog_name, COUNT(paths.path_id), last_sync "
+                              "FROM catalogs LEFT JOIN paths ON paths.catalog_id = catalogs.catalog_id "
+                              "WHERE ? IS NULL OR catalog_name GLOB ? "
+                              "GROUP BY catalogs.catalog_id "
+                              "ORDER BY catalogs.catalog_id "
+                              "LIMIT ? OFFSET ?;",
+                              (name, name, -1 if limit is None else limit, offset))
+
+    def iter_paths_with_catalog_name(self, name=None, limit=None, offset=0):
+        """Yield the id, path, catalog id and catalog name of the paths of catalogs with a name matching a pattern"""
+        return self.iter_rows("SELECT path_id, path, paths.catalog_id, catalog_name "
+                              "FROM paths LEFT JOIN catalogs ON catalogs.catalog_id = paths.catalog_id "
+                              "WHERE ? IS NULL OR catalog_name GLOB ? "
+                              "ORDER BY path_id "
+                              "LIMIT ? OFFSET ?;",
+                              (name, name, -1 if limit is None else limit, offset))
+
+    def iter_rows(self, query, parameters=(), batch_size=LIST_BATCH_SIZE):
+        """Yield the rows of a query a batch at a time, from a cursor of its own so other queries can run meanwhile"""
+        metrics.incr("db_queries")
+        cur = self.conn.cursor()
+        try:
+            cur.execute(query, parameters)
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            cur.close()
+
+    def select_paths_with_catalog_name(self):
+        """Return the id, path, catalog id and catalog name of all paths"""
+        self.execute("SELECT path_id, path, paths.catalog_id, catalog_name "
+                     "FROM paths LEFT JOIN catalogs ON catalogs.catalog_id = paths.catalog_id "
+                     "ORDER BY path_id;")
+        return self.cur.fetchall()
+
     def select_all_paths_with_catalog_id(self, catalog_id):
         """Return all content from a table"""
         self.execute("SELECT * FROM paths "
-                     f"WHERE catalog_id = {catalog_id}")
+                     "WHERE catalog_id = ?", (catalog_id,))
         return self.cur.fetchall()
 
     def select_all_paths_for_catalog_name(self, catalog_name):
         """Return all content from a table"""
         self.execute("SELECT * FROM paths "
-                     f"WHERE catalog_id = (SELECT catalog_id FROM catalogs WHERE catalog_name = '{catalog_name}');")
+                     "WHERE catalog_id = (SELECT catalog_id FROM catalogs WHERE catalog_name = ?);", (catalog_name,))
         return self.cur.fetchall()
 
     def catalog_id_from_name(self, catalog_name):
         self.execute("SELECT catalog_id FROM catalogs "
-                     f"WHERE catalog_name = '{catalog_name}';")
+                     "WHERE catalog_name = ?;", (catalog_name,))
         ids = self.cur.fetchone()
         if ids:
             return ids[0]
@@ -267,62 +1011,1925 @@ class LightroomSync:
 
     def insert_catalog(self, catalog_name):
         """Insert a catalog into the database"""
-        self.execute("INSERT INTO catalogs(catalog_name) "
-                     f"SELECT '{catalog_name}' "
-                     f"WHERE NOT EXISTS (SELECT * FROM catalogs WHERE catalog_name = '{catalog_name}');")
+        return self.insert_catalogs([catalog_name])
+
+    def insert_catalogs(self, catalog_names):
+        """Insert catalogs into the database, skipping the ones that already exist"""
+        self.executemany("INSERT INTO catalogs(catalog_name) VALUES (?) "
+                         "ON CONFLICT(catalog_name) DO NOTHING;",
+                         [(x,) for x in catalog_names])
         self.commit()
         return True
 
     def delete_catalog(self, catalog_name):
         """Delete a catalog from the database"""
-        self.execute(f"DELETE FROM catalogs WHERE catalog_name = '{catalog_name}'")
+        self.execute("DELETE FROM catalogs WHERE catalog_name = ?", (catalog_name,))
         self.commit()
         return True
 
     def insert_path(self, path, catalog_name):
         """Insert a path and link to a catalog"""
-        cat_id = self.catalog_id_from_name(catalog_name)
-        self.execute("INSERT INTO paths(path, catalog_id) "
-                     f"SELECT '{path}', {cat_id} "
-                     "WHERE NOT EXISTS (SELECT * FROM paths "
-                     f"WHERE path = '{path}');")
+        return self.insert_paths([(path, catalog_name)])
+
+    def insert_paths(self, paths):
+        """Insert (path, catalog name) pairs and link them to their catalogs, skipping paths that already exist"""
+        self.executemany("INSERT INTO paths(path, catalog_id) "
+                         "VALUES (?, (SELECT catalog_id FROM catalogs WHERE catalog_name = ?)) "
+                         "ON CONFLICT(path) DO NOTHING;",
+                         [(str(path), name) for path, name in paths])
+        self.commit()
+        return True
+
+    def insert_versions(self, versions):
+        """Insert or update (path, base name, version, device) rows of the version index"""
+        self.executemany("INSERT OR REPLACE INTO versions(path, base_name, version, device) "
+                         "VALUES (?, ?, ?, ?);",
+                         [(str(path), base_name, version or None, device)
+                          for path, base_name, version, device in versions])
+        self.commit()
+        return True
+
+    def select_latest_versions(self, base_name):
+        """Return the device, version and path of the newest version of a catalog on every device"""
+        # SQLite returns the path of the row with the max version for the bare column
+        self.execute("SELECT device, MAX(version), path FROM versions "
+                     "WHERE base_name = ? "
+                     "GROUP BY device;", (base_name,))
+        return self.cur.fetchall()
+
+    def select_newest_versions(self):
+        """Return the base name, version and path of the newest version of every catalog"""
+        self.execute("SELECT base_name, MAX(version), path FROM versions "
+                     "GROUP BY base_name;")
+        return self.cur.fetchall()
+
+    def store_fingerprint(self, path, fingerprint):
+        """Store the fingerprint of a file together with its current size, mtime and inode"""
+        path = str(path)
+        size, mtime_ns, inode = stat_key(path)
+        self.execute("INSERT OR REPLACE INTO fingerprints(path, size, mtime_ns, inode, fingerprint) "
+                     "VALUES (?, ?, ?, ?, ?);",
+                     (path, size, mtime_ns, inode, fingerprint))
+        self.commit()
+        return True
+
+    def select_paths_under(self, directory):
+        """Return the path and catalog id of all paths inside a directory"""
+        prefix = os.path.join(directory, "")
+        self.execute("SELECT path, catalog_id FROM paths "
+                     "WHERE substr(path, 1, ?) = ?;",
+                     (len(prefix), prefix))
+        return self.cur.fetchall()
+
+    def delete_paths(self, paths):
+        """Delete paths and their versions from the database"""
+        self.executemany("DELETE FROM paths WHERE path = ?", [(str(x),) for x in paths])
+        self.executemany("DELETE FROM versions WHERE path = ?", [(str(x),) for x in paths])
+        self.commit()
+        return True
+
+    def delete_catalogs_without_paths(self):
+        """Delete the catalogs that don't have any paths left"""
+        self.execute("DELETE FROM catalogs "
+                     "WHERE catalog_id NOT IN (SELECT catalog_id FROM paths WHERE catalog_id IS NOT NULL);")
+        self.commit()
+        return True
+
+    def select_directories(self, directory):
+        """Return a dict with the stored mtime, subdirectories and catalogs for a directory and everything in it"""
+        prefix = os.path.join(directory, "")
+        self.execute("SELECT path, mtime_ns, subdirs, catalogs FROM directories "
+                     "WHERE path = ? OR substr(path, 1, ?) = ?;",
+                     (directory, len(prefix), prefix))
+        return {x[0]: (x[1], json.loads(x[2]), json.loads(x[3])) for x in self.cur.fetchall()}
+
+    def store_directories(self, directories):
+        """Store the mtime, subdirectories and catalogs of directories"""
+        self.executemany("INSERT OR REPLACE INTO directories(path, mtime_ns, subdirs, catalogs) "
+                         "VALUES (?, ?, ?, ?);",
+                         [(x[0], x[1], json.dumps(x[2]), json.dumps(x[3])) for x in directories])
+        self.commit()
+        return True
+
+    def delete_directories(self, directories):
+        """Delete stored directories"""
+        self.executemany("DELETE FROM directories WHERE path = ?", [(x,) for x in directories])
+        self.commit()
+        return True
+
+    def insert_copies(self, jobs):
+        """Record how every copy of the sync jobs was made"""
+        copies = []
+        for job in jobs:
+            for destination, result in job.get("results", {}).items():
+                copies.append((str(job["source"]), str(destination), result["strategy"], result["bytes"],
+                               result["seconds"], self.device_id(destination), time.time()))
+        self.executemany("INSERT INTO copies(source, destination, strategy, bytes, seconds, device, copied_at) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?);",
+                         copies)
+        self.commit()
+        return True
+
+    def select_interrupted_copies(self, paths):
+        """Return the paths that a delta copy was writing to when it was interrupted"""
+        self.execute("SELECT destination FROM checkpoints WHERE offset = ?;", (IN_PLACE_OFFSET,))
+        interrupted = {x[0] for x in self.cur.fetchall()}
+        return {x for x in paths if str(Path(x).resolve()) in interrupted}
+
+    def select_synced_headers(self, paths):
+        """Return the size, change counter and schema cookie the paths had after they were last synced, with the
+        ones of the source they were synced from"""
+        synced = {}
+        for path in paths:
+            self.execute("SELECT synced_size, synced_counter, synced_cookie, source_size, source_counter, "
+                         "source_cookie FROM headers WHERE path = ? AND synced_counter IS NOT NULL;",
+                         (str(Path(path).resolve()),))
+            row = self.cur.fetchone()
+            if row:
+                synced[path] = (tuple(row[:3]), tuple(row[3:]))
+        return synced
+
+    def store_synced_headers(self, headers):
+        """Store the (path, header, source header) of paths that were synced and clear their diverged flag"""
+        rows = [(str(x[0]),) for x in headers]
+        self.executemany("INSERT OR IGNORE INTO headers(path) VALUES (?);", rows)
+        self.executemany("UPDATE headers SET synced_size = ?, synced_counter = ?, synced_cookie = ?, source_size = ?, "
+                         "source_counter = ?, source_cookie = ?, diverged = NULL WHERE path = ?;",
+                         [(*y, *z, str(x)) for x, y, z in headers])
+        self.commit()
+        return True
+
+    def flag_diverged(self, paths):
+        """Flag paths of a catalog that were edited independently since it was last synced"""
+        self.executemany("UPDATE headers SET diverged = ? WHERE path = ?;", [(time.time(), str(x)) for x in paths])
+        self.commit()
+        return True
+
+    def select_diverged(self):
+        """Return the flagged paths of every catalog that diverged"""
+        self.execute("SELECT catalog_name, headers.path FROM headers "
+                     "JOIN paths ON paths.path = headers.path "
+                     "JOIN catalogs ON catalogs.catalog_id = paths.catalog_id "
+                     "WHERE diverged IS NOT NULL "
+                     "ORDER BY catalog_name, headers.path;")
+        diverged = {}
+        for name, path in self.cur.fetchall():
+            diverged.setdefault(name, []).append(path)
+        return diverged
+
+    def insert_verifications(self, jobs):
+        """Record every check of the copies of the sync jobs"""
+        self.executemany("INSERT INTO verifications(source, destination, expected, actual, quick_check, ok, attempt, "
+                         "verified_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?);",
+                         [(str(job["source"]), str(x["destination"]), x["expected"], x["actual"], x["quick_check"],
+                           x["ok"], x["attempt"], x["verified_at"])
+                          for job in jobs for x in job.get("verifications", [])])
         self.commit()
         return True
 
     def update_last_sync(self, catalog_name, timestamp):
-        self.execute("UPDATE catalogs "
-                     f"SET last_sync = {timestamp} "
-                     f"WHERE catalog_name = '{catalog_name}';")
+        return self.update_last_syncs([(catalog_name, timestamp)])
+
+    def update_last_syncs(self, syncs):
+        """Set the last sync date for (catalog name, timestamp) pairs"""
+        self.executemany("UPDATE catalogs "
+                         "SET last_sync = ? "
+                         "WHERE catalog_name = ?;",
+                         [(timestamp, name) for name, timestamp in syncs])
         self.commit()
+        return True
+
+    def select_offline(self, paths=None):
+        """Return a dict with the volume, reason and time of the offline paths, or of the ones in paths"""
+        if paths is None:
+            self.execute("SELECT path, volume, reason, since FROM offline ORDER BY path;")
+        else:
+            self.execute("SELECT path, volume, reason, since FROM offline "
+                         f"WHERE path IN ({', '.join('?' * len(paths))});", [str(x) for x in paths])
+        return {x[0]: x[1:] for x in self.cur.fetchall()}
+
+    def insert_offline(self, paths):
+        """Mark (path, volume, reason) as offline"""
+        self.executemany("INSERT OR REPLACE INTO offline(path, volume, reason, since) VALUES (?, ?, ?, ?);",
+                         [(str(path), volume, reason, time.time()) for path, volume, reason in paths])
+        self.commit()
+        return True
 
+    def delete_offline(self, paths):
+        """Mark paths as online again"""
+        self.executemany("DELETE FROM offline WHERE path = ?;", [(str(x),) for x in paths])
+        self.commit()
         return True
 
+    def select_throughput(self, history=THROUGHPUT_HISTORY):
+        """Return the bytes and seconds of the last full copies to every device
+
+        Delta copies and reflinks don't say anything about how fast a device is, so they're left out.
+        """
+        self.execute("SELECT device, SUM(bytes), SUM(seconds) FROM ("
+                     "    SELECT device, bytes, seconds, "
+                     "    ROW_NUMBER() OVER (PARTITION BY device ORDER BY copied_at DESC) AS number "
+                     "    FROM copies WHERE seconds > 0 AND strategy NOT IN ('delta', 'reflink')"
+                     ") WHERE number <= ? "
+                     "GROUP BY device;", (history,))
+        return {x[0]: (x[1], x[2]) for x in self.cur.fetchall()}
+
+    def select_settings(self):
+        """Return a dict with all settings"""
+        self.execute("SELECT key, value FROM settings ORDER BY key;")
+        return dict(self.cur.fetchall())
+
+    def store_setting(self, key, value):
+        """Store a setting, replacing its old value"""
+        self.execute("INSERT OR REPLACE INTO settings(key, value) VALUES (?, ?);", (key, str(value)))
+        self.commit()
+        return True
+
+    def delete_setting(self, key):
+        """Delete a setting"""
+        self.execute("DELETE FROM settings WHERE key = ?;", (key,))
+        self.commit()
+        return True
 
-def mtimes(file_list):
-    """Return a list of modified times for the given list of files"""
+
+def mtimes(file_list, timeout=STAT_TIMEOUT):
+    """Return the modified times of the files that could be reached within the timeout"""
+    stats, failed = stat_paths(file_list, timeout=timeout)
+    return {x: y.st_mtime for x, y in stats.items()}
+
+
+# Threads of volumes whose stat didn't answer, so a hung volume doesn't get another thread until it answers
+_hung_stats = {}
+_hung_stats_lock = threading.Lock()
+
+
+def stat_paths(paths, timeout=STAT_TIMEOUT, volumes=None):
+    """Stat paths and return the stats and the reason the others failed
+
+    The paths on a volume are stat'ed one after the other on a daemon thread for that volume, so volumes are
+    stat'ed at the same time without a thread for every path. A volume with a stat that doesn't answer within
+    timeout seconds is given up on and its remaining paths get "timeout" as their reason, as do the paths on a
+    volume that's still hung from an earlier call. Missing paths get "missing" as their reason.
+    """
+    if volumes is None:
+        mounts = mount_points()
+        volumes = {path: volume_of(path, mounts) for path in paths}
+    by_volume = {}
+    for path in paths:
+        by_volume.setdefault(volumes[path], []).append(path)
+
+    results = {}
+    started = {}
+    condition = threading.Condition()
+
+    def stat_volume(volume, volume_paths):
+        for path in volume_paths:
+            started[volume] = time.monotonic()
+            try:
+                results[path] = os.stat(path)
+            except OSError as e:
+                results[path] = e
+        with condition:
+            del started[volume]
+            condition.notify()
+
+    threads = {}
+    with _hung_stats_lock:
+        for volume, volume_paths in by_volume.items():
+            hung = _hung_stats.get(volume)
+            if hung is not None and hung.is_alive():
+                continue
+            started[volume] = time.monotonic()
+            threads[volume] = threading.Thread(target=stat_volume, args=(volume, volume_paths), daemon=True)
+            threads[volume].start()
+    with condition:
+        while True:
+            now = time.monotonic()
+            remaining = [timeout - (now - x) for x in started.values() if now - x < timeout]
+            if not remaining:
+                break
+            condition.wait(min(remaining))
+        hung = dict(started)
+    with _hung_stats_lock:
+        _hung_stats.update({x: threads[x] for x in hung})
+    metrics.incr("stats", len(results))
+
+    stats = {}
+    failed = {}
+    for path in paths:
+        result = results.get(path)
+        if result is None:
+            failed[path] = "timeout"
+            metrics.incr("stat_timeouts")
+        elif isinstance(result, FileNotFoundError):
+            failed[path] = "missing"
+        elif isinstance(result, OSError):
+            failed[path] = result.strerror
+        else:
+            stats[path] = result
+    return stats, failed
+
+
+def mount_points():
+    """Return the mount points from /proc/self/mounts, or an empty list where that doesn't exist"""
+    try:
+        with open("/proc/self/mounts") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return []
+    # Spaces and other special characters are escaped as octal
+    return [re.sub(r"\\([0-7]{3})", lambda x: chr(int(x.group(1), 8)), line.split()[1])
+            for line in lines if len(line.split()) > 1]
+
+
+def volume_of(path, mounts=None):
+    """Return the volume a path is on without touching the file system
+
+    That's the longest mount point the path is in, or the /Volumes, /mnt or /media folder or drive it's on
+    where the mount points aren't known.
+    """
+    if mounts is None:
+        mounts = mount_points()
+    path = os.path.abspath(str(path))
+    matches = [x for x in mounts if path == x or path.startswith(os.path.join(x, ""))]
+    if matches:
+        return max(matches, key=len)
+    parts = Path(path).parts
+    if len(parts) > 2 and parts[1] in ("Volumes", "mnt", "media"):
+        return os.path.join(*parts[:3])
+    return Path(path).anchor
+
+
+def stat_key(path):
+    """Return the size, mtime in nanoseconds and inode of a file"""
+    metrics.incr("stats")
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+
+def _hash_chunk(path, offset, size):
+    """Hash a part of a file"""
+    import hashlib
+
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read(size)
+    metrics.incr("bytes_read", len(data))
+    return hashlib.blake2b(data, digest_size=32).digest()
+
+
+def _hash_mapped_chunk(mapped, offset, size):
+    """Hash a part of a memory-mapped file in place"""
+    import hashlib
+
+    with memoryview(mapped) as view, view[offset:offset + size] as data:
+        metrics.incr("bytes_read", len(data))
+        return hashlib.blake2b(data, digest_size=32).digest()
+
+
+def file_fingerprint(path, chunk_size=FINGERPRINT_CHUNK_SIZE, workers=FINGERPRINT_WORKERS, mapped=False):
+    """Return a content hash of a file, hashing chunks of it in parallel
+
+    The result is a hash of the file size and the hashes of every chunk, so it only depends on the content
+    and the chunk size. With mapped the file is memory-mapped and hashed without copying it into buffers.
+    """
+    import hashlib
+
+    size = os.stat(path).st_size
+    offsets = range(0, size, chunk_size)
+    result = hashlib.blake2b(size.to_bytes(8, "big"), digest_size=32)
+    if mapped and size:
+        import mmap
+
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for digest in executor.map(lambda offset: _hash_mapped_chunk(data, offset, chunk_size), offsets):
+                    result.update(digest)
+        return result.hexdigest()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for digest in executor.map(lambda offset: _hash_chunk(path, offset, chunk_size), offsets):
+            result.update(digest)
+    return result.hexdigest()
+
+
+def sqlite_header(path):
+    """Return the file change counter and schema cookie from the header of a SQLite database
+
+    Returns None if the file isn't a SQLite database, or is in WAL mode where the change counter isn't updated.
+    """
+    try:
+        with open(path, "rb") as f:
+            header = f.read(SQLITE_HEADER_SIZE)
+    except OSError:
+        return None
+    metrics.incr("bytes_read", len(header))
+    if len(header) < SQLITE_HEADER_SIZE or not header.startswith(SQLITE_MAGIC):
+        return None
+    # The write and read versions are 2 in WAL mode
+    if header[18] == 2 or header[19] == 2:
+        return None
+    return int.from_bytes(header[24:28], "big"), int.from_bytes(header[40:44], "big")
+
+
+def catalog_header(path):
+    """Return the size, change counter and schema cookie of a catalog, or None if it isn't a SQLite catalog"""
+    header = sqlite_header(path)
+    try:
+        return None if header is None else (os.path.getsize(path), *header)
+    except OSError:
+        return None
+
+
+def sqlite_quick_check(path):
+    """Run PRAGMA quick_check on a SQLite database without writing to it and return "ok" or the problems found
+
+    The database is opened as immutable, since a read only connection to a catalog in WAL mode still creates
+    the -wal and -shm files next to it.
+    """
+    try:
+        conn = sqlite3.connect(Path(path).resolve().as_uri() + "?mode=ro&immutable=1", uri=True)
+        try:
+            rows = conn.execute("PRAGMA quick_check;").fetchall()
+        finally:
+            conn.close()
+    except sqlite3.DatabaseError as e:
+        return str(e)
+    return "\n".join(str(x[0]) for x in rows)
+
+
+def sqlite_page_size(path):
+    """Return the page size from the header of a SQLite database or None if it isn't one"""
+    with open(path, "rb") as f:
+        header = f.read(SQLITE_HEADER_SIZE)
+    if len(header) < SQLITE_HEADER_SIZE or not header.startswith(SQLITE_MAGIC):
+        return None
+    page_size = int.from_bytes(header[16:18], "big")
+    # A stored value of 1 means 65536 since it doesn't fit in two bytes
+    if page_size == 1:
+        return 65536
+    return page_size
+
+
+def _reflink(src, dst, size, offset):
+    """Clone the whole file on copy-on-write filesystems like btrfs and XFS"""
+    if fcntl is None or offset:
+        raise OSError(errno.EOPNOTSUPP, "Reflinks aren't supported")
+    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    return size
+
+
+def _copy_file_range(src, dst, size, offset):
+    """Copy inside the kernel with copy_file_range, continuing from offset"""
+    while offset < size:
+        copied = os.copy_file_range(src.fileno(), dst.fileno(), min(size - offset, COPY_CHUNK_SIZE),
+                                    offset, offset)
+        if not copied:
+            break
+        offset += copied
+    return offset
+
+
+def _sendfile(src, dst, size, offset):
+    """Copy inside the kernel with sendfile, continuing from offset"""
+    dst.seek(offset)
+    while offset < size:
+        copied = os.sendfile(dst.fileno(), src.fileno(), offset, min(size - offset, COPY_CHUNK_SIZE))
+        if not copied:
+            break
+        offset += copied
+    return offset
+
+
+def _buffered(src, dst, size, offset):
+    """Copy through a buffer in user space, continuing from offset"""
+    src.seek(offset)
+    dst.seek(offset)
+    while offset < size:
+        chunk = src.read(min(size - offset, COPY_CHUNK_SIZE))
+        if not chunk:
+            break
+        dst.write(chunk)
+        offset += len(chunk)
+    return offset
+
+
+COPY_STRATEGIES = {
+    "reflink": _reflink,
+    "copy_file_range": _copy_file_range,
+    "sendfile": _sendfile,
+    "buffered": _buffered,
+}
+
+
+def copy_file(source, destination, strategies=("reflink", "copy_file_range", "sendfile", "buffered"), offset=0,
+              checkpoint=None, interval=COPY_CHECKPOINT_SIZE, throttle=None, drop_cache=False):
+    """Copy a file and its metadata with the cheapest strategy that works and return the name of that strategy
+
+    The strategies are tried in order, each one continuing from where the previous one stopped, and the
+    buffered copy always works as a last resort. A copy from an offset keeps what the destination already
+    has before it. With a checkpoint function the destination is synced to disk every interval bytes and
+    the function is called with the offset that's safely written. A throttle function is called with the
+    bytes of every step of the copy and with drop_cache the copied data is dropped from the page cache.
+    """
+    size = os.stat(source).st_size
+    strategy = "buffered"
+    step = interval if checkpoint is not None else size
+    if throttle is not None:
+        step = min(step, THROTTLE_CHUNK_SIZE)
+    checkpointed = offset
+    with open(source, "rb") as src, open(destination, "r+b" if offset else "wb") as dst:
+        for strategy in strategies:
+            if strategy == "copy_file_range" and not hasattr(os, "copy_file_range"):
+                continue
+            if strategy == "sendfile" and not hasattr(os, "sendfile"):
+                continue
+            while offset < size:
+                # A reflink clones the whole file at once without moving any data
+                end = size if strategy == "reflink" else min(size, offset + step)
+                try:
+                    copied = COPY_STRATEGIES[strategy](src, dst, end, offset)
+                except OSError as e:
+                    if strategy == "buffered":
+                        raise
+                    logging.debug(f"Couldn't copy {source} with {strategy}: {e}")
+                    break
+                if copied <= offset:
+                    break
+                if throttle is not None and strategy != "reflink":
+                    throttle(copied - offset)
+                if drop_cache:
+                    drop_page_cache(src, offset, copied - offset)
+                offset = copied
+                if checkpoint is not None and (offset - checkpointed >= interval or offset >= size):
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                    checkpoint(offset)
+                    checkpointed = offset
+            if offset >= size:
+                break
+        dst.truncate(offset)
+        if drop_cache:
+            drop_page_cache(dst, sync=True)
+    shutil.copystat(str(source), str(destination))
+    return strategy
+
+
+def drop_page_cache(f, offset=0, length=0, sync=False):
+    """Tell the kernel the data of a file won't be needed again, so it doesn't push other files out of the cache
+
+    Dirty pages can't be dropped, so a file that was written to has to be synced first. A length of 0 means
+    the whole file from offset.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+        os.posix_fadvise(f.fileno(), offset, length, os.POSIX_FADV_DONTNEED)
+    except OSError as e:
+        logging.debug(f"Couldn't drop {f.name} from the page cache: {e}")
+
+
+def partial_path(destination):
+    """Return the hidden sibling a copy is written to before it replaces the destination"""
+    destination = Path(destination)
+    return destination.with_name(f".{destination.name}.partial")
+
+
+def publish(temp, destination):
+    """Sync a finished file to disk and atomically move it over the destination"""
+    with open(temp, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(str(temp), str(destination))
+    # Make the rename itself durable, not possible on every platform
+    try:
+        fd = os.open(str(Path(destination).parent), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def full_copy(source, destination, checkpoints=None, interval=COPY_CHECKPOINT_SIZE, throttle=None,
+              drop_cache=False):
+    """Copy the whole source file to a temp file next to the destination and then replace the destination
+
+    The destination is never half written. With checkpoints the offset is saved every interval bytes and a
+    copy that was interrupted continues from its last checkpoint. throttle and drop_cache are passed on to
+    copy_file.
+    Returns a dict with the number of bytes written, the copy strategy that was used and the bytes resumed.
+    """
+    temp = partial_path(destination)
+    offset = checkpoints.resume(source, destination, temp) if checkpoints is not None else 0
+    if offset:
+        logging.info(f"Resuming copy to {destination} at {offset} bytes")
+        metrics.incr("bytes_resumed", offset)
+    checkpoint = None
+    if checkpoints is not None:
+        def checkpoint(copied):
+            checkpoints.save(source, destination, copied)
+    strategy = copy_file(source, temp, offset=offset, checkpoint=checkpoint, interval=interval, throttle=throttle,
+                         drop_cache=drop_cache)
+    publish(temp, destination)
+    if checkpoints is not None:
+        checkpoints.clear(destination)
+    size = Path(destination).stat().st_size - offset
+    # A reflink shares the data instead of reading it
+    return {"bytes": size, "read": 0 if strategy == "reflink" else size, "strategy": strategy, "resumed": offset}
+
+
+def delta_copy(source, destination, checkpoints=None, throttle=None, drop_cache=False):
+    """Only rewrite the pages of destination that differ from source
+
+    Falls back to a full copy when the destination is missing or doesn't share the page size of the source.
+    With checkpoints the destination is marked as half written before the first page is written, until the copy
+    is done, so a copy that's interrupted isn't taken for an edit. A throttle function is called with the bytes
+    read and written of every block and with drop_cache the compared data is dropped from the page cache.
+    Returns a dict with the number of bytes written and the copy strategy that was used.
+    """
+    source = Path(source)
+    destination = Path(destination)
+    page_size = sqlite_page_size(source)
+    if page_size is None or not destination.is_file() or sqlite_page_size(destination) != page_size:
+        logging.debug(f"Can't delta copy to {destination}, falling back to a full copy")
+        return full_copy(source, destination, checkpoints=checkpoints, throttle=throttle, drop_cache=drop_cache)
+
+    # Compare many pages at a time and only look at single pages when a block differs
+    block_size = page_size * DELTA_PAGES_PER_BLOCK
+    written = 0
+    read = 0
+    offset = 0
+    with open(source, "rb") as src, open(destination, "r+b") as dst:
+        while True:
+            block = src.read(block_size)
+            if not block:
+                break
+            dst.seek(offset)
+            read += len(block) * 2
+            block_written = 0
+            if dst.read(len(block)) != block:
+                for page_offset in range(0, len(block), page_size):
+                    page = block[page_offset:page_offset + page_size]
+                    dst.seek(offset + page_offset)
+                    if dst.read(len(page)) != page:
+                        if checkpoints is not None and not written + block_written:
+                            checkpoints.save(source, destination, IN_PLACE_OFFSET)
+                        dst.seek(offset + page_offset)
+                        dst.write(page)
+                        block_written += len(page)
+            written += block_written
+            if throttle is not None:
+                throttle(len(block) * 2 + block_written)
+            if drop_cache:
+                drop_page_cache(src, offset, len(block))
+            offset += len(block)
+        # Drop pages that no longer exist in the source
+        dst.truncate(offset)
+        # The pages have to be on disk before the checkpoint is cleared, or a power loss could leave a torn copy
+        # that looks clean
+        dst.flush()
+        os.fsync(dst.fileno())
+        if drop_cache:
+            drop_page_cache(dst)
+
+    shutil.copystat(str(source), str(destination))
+    if checkpoints is not None:
+        checkpoints.clear(destination)
+    return {"bytes": written, "read": read, "strategy": "delta"}
+
+
+def _fanout_writer(destination, chunks, stats, drop_cache=False):
+    """Write chunks from a queue to a destination file until the end marker is received"""
+    start = time.perf_counter()
+    done = False
+    try:
+        with open(destination, "wb") as f:
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    done = True
+                    break
+                f.write(chunk)
+                stats["bytes"] += len(chunk)
+            if drop_cache:
+                drop_page_cache(f, sync=True)
+    except Exception as e:
+        stats["error"] = e
+        # Keep draining so the reader never blocks on a dead destination, unless the end was already reached
+        # and it was the flush or close that failed
+        while not done and chunks.get() is not None:
+            pass
+    stats["seconds"] = time.perf_counter() - start
+
+
+def fanout_copy(source, destinations, buffer_size=FANOUT_BUFFER_SIZE, queue_size=FANOUT_QUEUE_SIZE, throttle=None,
+                drop_cache=False):
+    """Read source once and write it to all destinations at the same time
+
+    Every destination gets its own writer thread and a queue of at most queue_size chunks, so a slow
+    destination only holds back the others once its queue is full. A throttle function is called with the
+    bytes of every chunk that's read and with drop_cache the data is dropped from the page cache.
+    Returns a dict with the bytes written, seconds, MB/s and strategy for each destination. The bytes read
+    from the source are split evenly between the destinations. If a destination fails the others are still
+    published, the partial copies of the failed ones are deleted and the first error is raised.
+    """
+    stats = {}
+    queues = {}
+    writers = []
+    for destination in destinations:
+        stats[destination] = {"bytes": 0, "read": 0, "seconds": 0.0, "strategy": "fanout", "error": None}
+        queues[destination] = queue.Queue(maxsize=queue_size)
+        writer = threading.Thread(target=_fanout_writer,
+                                  args=(partial_path(destination), queues[destination], stats[destination],
+                                        drop_cache),
+                                  daemon=True)
+        writer.start()
+        writers.append(writer)
+
+    read = 0
+    try:
+        with open(source, "rb") as f:
+            while True:
+                chunk = f.read(buffer_size)
+                if not chunk:
+                    break
+                if throttle is not None:
+                    throttle(len(chunk))
+                if drop_cache:
+                    drop_page_cache(f, read, len(chunk))
+                read += len(chunk)
+                for chunks in queues.values():
+                    chunks.put(chunk)
+    finally:
+        for chunks in queues.values():
+            chunks.put(None)
+        for writer in writers:
+            writer.join()
+
+    errors = []
+    for destination, result in stats.items():
+        temp = partial_path(destination)
+        if result["error"] is None:
+            try:
+                shutil.copystat(str(source), str(temp))
+                publish(temp, destination)
+            except OSError as e:
+                result["error"] = e
+        if result["error"] is not None:
+            logging.error(f"Failed to write {destination}: {result['error']}")
+            errors.append(result["error"])
+            try:
+                os.unlink(temp)
+            except OSError:
+                pass
+            continue
+        result["read"] = read / len(stats)
+        result["mb_per_s"] = result["bytes"] / MB / result["seconds"] if result["seconds"] else 0.0
+        logging.info(f"Wrote {result['bytes']} bytes to {destination} at {result['mb_per_s']:.1f} MB/s")
+    if errors:
+        raise errors[0]
+    return stats
+
+
+def online_copy(source, destination, pages=ONLINE_COPY_PAGES, sleep=ONLINE_COPY_SLEEP):
+    """Copy a catalog with the SQLite online backup API and return the size of the copy and the strategy
+
+    The source is opened read only and copied pages at a time, sleeping between the steps so Lightroom can
+    keep writing to it. The result is a consistent snapshot even if the source changes during the copy.
+    Falls back to a full copy if the source isn't a SQLite database.
+    """
+    source = Path(source).resolve()
+    destination = Path(destination)
+    if sqlite_page_size(source) is None:
+        logging.debug(f"{source} isn't a SQLite database, falling back to a full copy")
+        return full_copy(source, destination)
+    # Back up into a new database next to the destination and replace the destination when it's done
+    temp = partial_path(destination)
+    if temp.exists():
+        temp.unlink()
+
+    src = sqlite3.connect(f"{source.as_uri()}?mode=ro", uri=True)
+    try:
+        dst = sqlite3.connect(str(temp))
+        try:
+            src.backup(dst, pages=pages, sleep=sleep)
+        finally:
+            dst.close()
+    finally:
+        src.close()
+
+    shutil.copystat(str(source), str(temp))
+    publish(temp, destination)
+    size = destination.stat().st_size
+    return {"bytes": size, "read": size, "strategy": "online"}
+
+
+COPY_MODES = {
+    "copy": full_copy,
+    "delta": delta_copy,
+    "fanout": lambda source, destination, **options: fanout_copy(source, [destination], **options)[destination],
+    "online": online_copy,
+}
+
+
+# Copy modes that keep checkpoints, to resume an interrupted copy or to know a destination was left half written
+RESUMABLE_COPY_MODES = ("copy", "delta")
+# Copy modes that can be rate limited, online copies are slowed down with their pages and sleep options
+THROTTLED_COPY_MODES = ("copy", "delta", "fanout")
+
+
+def copy_catalog(source, destination, mode="copy", options=None, checkpoints=None, io_limits=None):
+    """Copy a catalog file using one of the COPY_MODES
+
+    checkpoints are used by the RESUMABLE_COPY_MODES to resume interrupted copies and io_limits by the
+    THROTTLED_COPY_MODES to limit the rate of the copy.
+    Returns a dict with the bytes written, the copy strategy that was used and the seconds it took.
+    """
+    options = dict(options or {})
+    if checkpoints is not None and mode in RESUMABLE_COPY_MODES:
+        options["checkpoints"] = checkpoints
+    if io_limits is not None and mode in THROTTLED_COPY_MODES:
+        options.update(throttle=io_limits.throttle(source, destination), drop_cache=io_limits.drop_cache)
+    start = time.perf_counter()
+    result = COPY_MODES[mode](source, destination, **options)
+    result.setdefault("seconds", time.perf_counter() - start)
+    return result
+
+
+def copy_catalogs(source, destinations, mode="copy", options=None, checkpoints=None, io_limits=None):
+    """Copy a catalog file to several destinations and return a dict with the result of each copy"""
+    if mode == "fanout":
+        options = dict(options or {})
+        if io_limits is not None:
+            options.update(throttle=io_limits.throttle(source, *destinations), drop_cache=io_limits.drop_cache)
+        return fanout_copy(source, destinations, **options)
+    return {destination: copy_catalog(source, destination, mode=mode, options=options, checkpoints=checkpoints,
+                                      io_limits=io_limits)
+            for destination in destinations}
+
+
+class CopyCheckpoints:
+    """Store how far copies got in the sync database, so an interrupted copy can continue where it stopped
+
+    Copies run on worker threads, so this has its own connection to the database, shared behind a lock.
+    """
+
+    def __init__(self, db):
+        self.conn = sqlite3.connect(db, check_same_thread=False, timeout=60)
+        self.lock = threading.Lock()
+
+    def resume(self, source, destination, temp):
+        """Return the offset to continue a copy from, or 0 if it has to start over
+
+        A checkpoint is only used if the source didn't change since and the end of what was copied still
+        matches the source. The checkpoint of a delta copy is never used, since it wrote to the destination.
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT source, size, mtime_ns, offset FROM checkpoints "
+                                    "WHERE destination = ?;", (str(destination),)).fetchone()
+        if row is None or row[3] == IN_PLACE_OFFSET:
+            return 0
+        source_path, size, mtime_ns, offset = row
+        stat = os.stat(source)
+        if source_path != str(source) or (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+            logging.debug(f"{source} changed since the copy to {destination} was interrupted")
+            return 0
+        try:
+            if os.stat(temp).st_size < offset:
+                return 0
+            verify = min(offset, COPY_VERIFY_SIZE)
+            with open(source, "rb") as src, open(temp, "rb") as dst:
+                src.seek(offset - verify)
+                dst.seek(offset - verify)
+                if src.read(verify) != dst.read(verify):
+                    logging.debug(f"{temp} doesn't match {source} at its checkpoint")
+                    return 0
+        except OSError:
+            return 0
+        return offset
+
+    def save(self, source, destination, offset):
+        """Store the offset a copy has safely written"""
+        stat = os.stat(source)
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO checkpoints(destination, source, size, mtime_ns, offset, "
+                              "updated) VALUES (?, ?, ?, ?, ?, ?);",
+                              (str(destination), str(source), stat.st_size, stat.st_mtime_ns, offset, time.time()))
+            self.conn.commit()
+        metrics.incr("checkpoints")
+
+    def clear(self, destination):
+        """Forget the checkpoint of a finished copy"""
+        with self.lock:
+            self.conn.execute("DELETE FROM checkpoints WHERE destination = ?;", (str(destination),))
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+class TokenBucket:
+    """Limit a rate of bytes, letting through bursts of up to burst bytes
+
+    Callers that take more than there is go into debt and sleep until it's paid back, so threads sharing a
+    bucket share its rate.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        """Take amount tokens and return the seconds slept waiting for them"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            metrics.incr("throttled_seconds", wait)
+            time.sleep(wait)
+        return wait
+
+
+class IOLimits:
+    """Per device rate limits and page cache policy for the copies of a sync
+
+    rates maps device ids to bytes per second and default is the rate of every other device, None or 0
+    meaning no limit. Every device gets one token bucket that all copies touching it share.
+    """
+
+    def __init__(self, default=None, rates=None, drop_cache=False):
+        self.default = default
+        self.rates = rates or {}
+        self.drop_cache = drop_cache
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, device):
+        rate = self.rates.get(device, self.default)
+        if not rate:
+            return None
+        with self.lock:
+            if device not in self.buckets:
+                self.buckets[device] = TokenBucket(rate)
+            return self.buckets[device]
+
+    def throttle(self, *paths):
+        """Return a function that limits bytes moved to the rates of the devices of the paths, or None"""
+        if not self.default and not self.rates:
+            return None
+        buckets = [x for x in (self.bucket(device) for device in {device_id(path) for path in paths}) if x]
+        if not buckets:
+            return None
+
+        def throttle(amount):
+            for bucket in buckets:
+                bucket.consume(amount)
+        return throttle
+
+
+def set_io_priority(priority):
+    """Set the I/O priority of this process to one of IO_PRIORITIES or an (io class, level) tuple and return if
+    that worked
+
+    Uses the ioprio_set syscall on Linux, falling back to the ionice command. Threads started afterwards get
+    the same priority.
+    """
+    io_class, level = IO_PRIORITIES.get(priority, priority)
+    number = IOPRIO_SET_SYSCALLS.get(os.uname().machine) if hasattr(os, "uname") else None
+    if number is not None and sys.platform.startswith("linux"):
+        import ctypes
+        import ctypes.util
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if libc.syscall(number, IOPRIO_WHO_PROCESS, 0, io_class << IOPRIO_CLASS_SHIFT | level) == 0:
+            logging.debug(f"Set I/O priority to {priority}")
+            return True
+        logging.debug(f"ioprio_set failed: {os.strerror(ctypes.get_errno())}")
+
+    ionice = shutil.which("ionice")
+    if ionice is not None:
+        import subprocess
+
+        command = [ionice, "-c", str(io_class), "-p", str(os.getpid())]
+        if io_class == 2:
+            command[3:3] = ["-n", str(level)]
+        if subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0:
+            logging.debug(f"Set I/O priority to {priority} with ionice")
+            return True
+    logging.warning(f"Couldn't set the I/O priority to {priority}")
+    return False
+
+
+def get_io_priority():
+    """Return the I/O priority of this process as an (io class, level) tuple, or None where it can't be read"""
+    number = IOPRIO_SET_SYSCALLS.get(os.uname().machine) if hasattr(os, "uname") else None
+    if number is None or not sys.platform.startswith("linux"):
+        return None
+    import ctypes
+    import ctypes.util
+
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    # ioprio_get is the syscall right after ioprio_set on every architecture
+    value = libc.syscall(number + 1, IOPRIO_WHO_PROCESS, 0)
+    if value < 0:
+        return None
+    return value >> IOPRIO_CLASS_SHIFT, value & ((1 << IOPRIO_CLASS_SHIFT) - 1)
+
+
+@contextmanager
+def lowered_io_priority(priority):
+    """Lower the I/O priority to one of IO_PRIORITIES in the block and restore it afterwards
+
+    Without a priority the block runs as it is. A priority that can't be read is restored to the default,
+    which is what the ionice fallback of set_io_priority leaves behind on other systems.
+    """
+    previous = None
+    if priority in IO_PRIORITIES:
+        previous = get_io_priority() or (0, 0)
+        if not set_io_priority(priority):
+            previous = None
+    try:
+        yield
+    finally:
+        if previous is not None:
+            set_io_priority(previous)
+
+
+def preview_folders(catalog):
+    """Return the .lrdata folders that belong to a catalog, like its Previews and Smart Previews"""
+    catalog = Path(catalog)
+    prefix = f"{catalog.stem} "
+    try:
+        with os.scandir(catalog.parent) as entries:
+            return sorted(Path(x.path) for x in entries
+                          if x.name.startswith(prefix) and x.name.endswith(".lrdata") and x.is_dir())
+    except OSError:
+        return []
+
+
+def preview_pairs(source, destination):
+    """Return (source folder, destination folder) for every preview folder of the source catalog"""
+    return [(folder, Path(destination).parent / folder.name) for folder in preview_folders(source)]
+
+
+def tree_listing(directory):
+    """Return the size and mtime of every file in a directory tree by relative path, and the relative directories"""
     files = {}
-    for f in file_list:
-        path = Path(f)
-        files[f] = path.stat().st_mtime
-    return files
+    directories = set()
+    stack = [""]
+    while stack:
+        relative = stack.pop()
+        try:
+            with os.scandir(os.path.join(directory, relative)) as entries:
+                for entry in entries:
+                    path = os.path.join(relative, entry.name)
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.add(path)
+                        stack.append(path)
+                    else:
+                        metrics.incr("stats")
+                        stat = entry.stat(follow_symlinks=False)
+                        files[path] = (stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            continue
+    return files, directories
+
+
+def tree_changes(source_files, destination_files):
+    """Return the relative paths of the files in a tree listing that are new or changed in the source"""
+    return [x for x, key in source_files.items() if destination_files.get(x) != key]
+
+
+def sync_tree(source, destination, workers=PREVIEW_WORKERS, throttle=None):
+    """Make a destination directory tree match the source tree
+
+    The trees are compared by relative path, size and mtime. New and changed files are copied by a pool of
+    workers and files and folders that are gone from the source are deleted. A throttle function is called
+    with the size of every copied file.
+    Returns the number of files copied and deleted and the bytes copied.
+    """
+    source_files, source_directories = tree_listing(source)
+    destination_files, destination_directories = tree_listing(destination)
+
+    changed = tree_changes(source_files, destination_files)
+    removed = [x for x in destination_files if x not in source_files]
+
+    # Create the folders up front so the workers don't race each other
+    for directory in sorted(source_directories - destination_directories):
+        os.makedirs(os.path.join(destination, directory), exist_ok=True)
+    os.makedirs(destination, exist_ok=True)
+
+    def copy(path):
+        shutil.copy2(os.path.join(source, path), os.path.join(destination, path), follow_symlinks=False)
+        if throttle is not None:
+            throttle(source_files[path][0])
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for _ in executor.map(copy, changed):
+            pass
+
+    for path in removed:
+        os.unlink(os.path.join(destination, path))
+    # Remove the deepest folders first
+    for directory in sorted(destination_directories - source_directories, key=len, reverse=True):
+        os.rmdir(os.path.join(destination, directory))
+
+    return {
+        "copied": len(changed),
+        "deleted": len(removed),
+        "bytes": sum(source_files[x][0] for x in changed),
+    }
+
+
+def write_rows(rows, columns, output_format="table", file=None, lookahead=LIST_LOOKAHEAD):
+    """Write dict rows as they come in one of LIST_FORMATS and return the number of rows
+
+    columns are the (key, title) of every column. A table only looks at the first lookahead rows for the column
+    widths, so the first rows are written before the rest are read and longer values further down stick out.
+    """
+    file = file or sys.stdout
+    keys = [x[0] for x in columns]
+    count = 0
+    if output_format == "table":
+        rows = iter(rows)
+        head = [*islice(rows, lookahead)]
+        widths = [max([len(str(row[key])) for row in head] + [len(title)]) + 2 for key, title in columns]
+        print(*(title.ljust(width) for (key, title), width in zip(columns, widths)), file=file)
+        print("".ljust(sum(widths) + len(widths) - 1, "-"), file=file)
+        for row in head:
+            print(*(str(row[key]).ljust(width) for key, width in zip(keys, widths)), file=file)
+        count = len(head)
+        for row in rows:
+            print(*(str(row[key]).ljust(width) for key, width in zip(keys, widths)), file=file)
+            count += 1
+    elif output_format == "json":
+        file.write("[")
+        for row in rows:
+            file.write(("\n" if not count else ",\n") + json.dumps(row))
+            count += 1
+        file.write("\n]\n" if count else "]\n")
+    elif output_format == "jsonl":
+        for row in rows:
+            file.write(json.dumps(row) + "\n")
+            count += 1
+    elif output_format == "csv":
+        import csv
+
+        writer = csv.writer(file, lineterminator="\n")
+        writer.writerow(keys)
+        for row in rows:
+            writer.writerow([row[key] for key in keys])
+            count += 1
+    else:
+        raise ValueError(f"Unknown format {output_format}, use one of {', '.join(LIST_FORMATS)}")
+    return count
+
+
+def load_plan(plan):
+    """Return the jobs of a plan from LightroomSync.estimate_plan, for example read back from JSON"""
+    return [{
+        "catalog": job["catalog"],
+        "source": Path(job["source"]),
+        "fingerprint": job["fingerprint"],
+        "destinations": [Path(x) for x in job["destinations"]],
+        "previews": [(Path(x), Path(y)) for x, y in job["previews"]],
+        "devices": job["devices"],
+        "size": job["size"],
+        "mtimes": job["mtimes"],
+        "header": None if job.get("header") is None else tuple(job["header"]),
+        "diverged": job.get("diverged", []),
+    } for job in plan["jobs"]]
+
+
+def device_id(path):
+    """Return the device a path is on, using the parent directory if the path doesn't exist"""
+    path = Path(path)
+    metrics.incr("stats")
+    while not path.exists() and path.parent != path:
+        metrics.incr("stats")
+        path = path.parent
+    return path.stat().st_dev
+
+
+def verify_copies(source, destinations, hashed=True):
+    """Check copies of a catalog and return a dict with the result of every destination
+
+    The source and the copies are hashed with memory-mapped reads by a thread per device, so copies on different
+    devices are read at the same time and every device reads one file at a time. The copies are dropped from the
+    page cache first, so they're read back from the device instead of from memory. A copy of a SQLite database
+    also has to pass PRAGMA quick_check. Without hashed only quick_check is used, for copies that don't have the
+    same bytes as the source, like the ones made with the backup API.
+    """
+    source = Path(source)
+    paths = [source, *destinations] if hashed else [*destinations]
+    by_device = {}
+    for path in paths:
+        by_device.setdefault(device_id(path), []).append(path)
+    for destination in destinations:
+        with open(destination, "rb") as f:
+            drop_page_cache(f)
+
+    fingerprints = {}
+    checks = {}
+    is_sqlite = sqlite_page_size(source) is not None
+
+    def check_device(device_paths):
+        for path in device_paths:
+            if hashed:
+                fingerprints[path] = file_fingerprint(path, mapped=True)
+            if path != source and is_sqlite:
+                checks[path] = sqlite_quick_check(path)
+
+    with ThreadPoolExecutor(max_workers=len(by_device) or 1) as executor:
+        for _ in executor.map(check_device, by_device.values()):
+            pass
+
+    results = {}
+    for destination in destinations:
+        expected = fingerprints.get(source)
+        actual = fingerprints.get(destination)
+        quick_check = checks.get(destination)
+        results[destination] = {
+            "destination": destination,
+            "expected": expected,
+            "actual": actual,
+            "quick_check": quick_check,
+            "matches": expected == actual,
+            "ok": expected == actual and quick_check in (None, "ok"),
+            "verified_at": time.time(),
+        }
+    return results
+
+
+def verify_job(job, mode="copy", io_limits=None, retries=VERIFY_RETRIES):
+    """Verify the copies of a job and copy the ones that don't match the source again
+
+    Every check is stored in the job under "verifications". A copy that matches the source but fails
+    quick_check isn't copied again, since the source is damaged as well. Raises an OSError if a copy is still
+    bad after the retries.
+    """
+    hashed = mode != "online"
+    recopy_mode = "online" if mode == "online" else "copy"
+    job["verifications"] = []
+    pending = [*job["destinations"]]
+    for attempt in range(retries + 1):
+        results = verify_copies(job["source"], pending, hashed=hashed)
+        for result in results.values():
+            job["verifications"].append(dict(result, attempt=attempt))
+        if all(x["ok"] for x in results.values()):
+            if hashed and results:
+                # The copies match the source as it is now, which may be newer than the planned fingerprint
+                job["fingerprint"] = next(iter(results.values()))["expected"]
+            return job["verifications"]
+        damaged = [x for x, y in results.items() if not y["ok"] and (not y["matches"] or not hashed)]
+        for destination, result in results.items():
+            if destination in damaged:
+                logging.warning(f"{destination} doesn't match {job['source']} after copying it")
+            elif not result["ok"]:
+                raise OSError(f"{job['source']} fails quick_check: {result['quick_check']}")
+        if attempt == retries:
+            break
+        for destination in damaged:
+            result = copy_catalog(job["source"], destination, mode=recopy_mode, io_limits=io_limits)
+            job["results"][destination] = result
+            metrics.add_copy(destination, result)
+            metrics.incr("recopies")
+        pending = damaged
+    raise OSError(f"Copies of {job['source']} still don't match it after {retries} retries")
+
+
+def _run_sync_job(job, mode, options=None, checkpoints=None, io_limits=None, verify=False, backups=None):
+    """Back up the destinations of a job, copy the source to them and sync its preview folders
+
+    With backups every destination is stored in that BackupStore first and the number of snapshots is stored
+    in the job under "snapshots". The result of every copy is stored in the job under "results", and the checks
+    with verify under "verifications".
+    """
+    job["snapshots"] = 0
+    for destination in job["destinations"] if backups is not None else []:
+        if not destination.exists():
+            continue
+        try:
+            backups.snapshot(destination, job["catalog"],
+                             throttle=io_limits.throttle(destination) if io_limits is not None else None,
+                             drop_cache=io_limits is not None and io_limits.drop_cache)
+        except OSError:
+            logging.error(f"Couldn't back up {destination}, not overwriting it")
+            raise
+        job["snapshots"] += 1
+    job["results"] = copy_catalogs(job["source"], job["destinations"], mode=mode, options=options,
+                                   checkpoints=checkpoints, io_limits=io_limits)
+    for destination, result in job["results"].items():
+        metrics.add_copy(destination, result)
+        logging.debug(f"Copied catalog from {job['source']} to {destination} with {result['strategy']} "
+                      f"({result['bytes']} bytes written)")
+    if verify and job["destinations"]:
+        verify_job(job, mode=mode, io_limits=io_limits)
+    for source, destination in job.get("previews", []):
+        start = time.perf_counter()
+        stats = sync_tree(source, destination,
+                          throttle=io_limits.throttle(source, destination) if io_limits is not None else None)
+        metrics.add_copy(destination, {"bytes": stats["bytes"], "read": stats["bytes"],
+                                       "seconds": time.perf_counter() - start})
+        logging.debug(f"Synced previews from {source} to {destination}, copied {stats['copied']} files "
+                      f"({stats['bytes']} bytes) and deleted {stats['deleted']}")
+    return job["results"]
+
+
+def run_sync_jobs(jobs, mode="copy", workers=None, options=None, checkpoints=None, io_limits=None, verify=False,
+                  backups=None):
+    """Run sync jobs on a pool of workers and return the names of the catalogs that failed
+
+    A job only starts when none of its devices are busy with another job, so copies to different drives run
+    in parallel while copies touching the same drive are serialized. checkpoints is a CopyCheckpoints used to
+    resume interrupted copies and io_limits the IOLimits of the copies and the backups. With verify the copies
+    are checked against the source after they're made. With backups the destinations are backed up to that
+    BackupStore right before they're copied to.
+    """
+    pending = [job for job in jobs if job["destinations"] or job.get("previews")]
+    if not pending:
+        return set()
+    if workers is None:
+        workers = len({device for job in pending for device in job["devices"]})
+
+    failed = set()
+    busy = set()
+    condition = threading.Condition()
+
+    def worker():
+        while True:
+            with condition:
+                while True:
+                    if not pending:
+                        return
+                    job = next((x for x in pending if busy.isdisjoint(x["devices"])), None)
+                    if job is not None:
+                        break
+                    condition.wait()
+                pending.remove(job)
+                busy.update(job["devices"])
+            try:
+                _run_sync_job(job, mode, options, checkpoints, io_limits, verify, backups)
+            except Exception:
+                logging.exception(f"Failed to sync {job['catalog']} from {job['source']}")
+                with condition:
+                    failed.add(job["catalog"])
+            finally:
+                with condition:
+                    busy.difference_update(job["devices"])
+                    condition.notify_all()
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(max(1, min(workers, len(pending))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return failed
 
 
 def scan_for_catalogs(directory):
     """Scan a directory for catalog files"""
-    catalogs = []
-    path = Path(directory)
+    return [x for x in iter_catalogs(directory)]
 
-    # Walk through files and directories
-    for root, dirs, files in os.walk(path, topdown=True):
-        # Skip lrdata folders
-        dirs[:] = [x for x in dirs if not x.endswith(".lrdata")]
-        # Skip backups folders
-        dirs[:] = [x for x in dirs if "backups" not in x]
 
-        # Get catalog files
-        catalogs.extend([Path(root) / f for f in files if Path(f).suffix == ".lrcat"])
+def iter_catalogs(*directories, workers=SCAN_WORKERS):
+    """Yield catalog files in the directories while they're found"""
+    for path, mtime_ns, subdirs, catalogs, listed in walk_catalog_directories_parallel(directories, workers=workers):
+        for catalog in catalogs:
+            yield Path(path) / catalog
+
+
+def is_skipped_directory(name):
+    """Check if a directory should be left out when scanning for catalogs"""
+    # Skip lrdata folders
+    if name.endswith(".lrdata"):
+        return True
+    # Skip backups folders
+    if "backups" in name:
+        return True
+    return False
+
+
+def walk_catalog_directories(directory, known=None, recursive=True, unreachable=None):
+    """Walk a directory and yield (path, mtime_ns, subdirs, catalogs, listed) for every directory in it
+
+    Only the directory itself is yielded when recursive is False. known maps directory paths to the (mtime_ns,
+    subdirs, catalogs) of an earlier walk. A directory with the same mtime as before isn't listed again and its
+    subdirectories and catalogs are taken from known instead. The mtime of a directory only changes with its own
+    entries, so subdirectories are still checked one by one.
+    Directories that can't be stat'ed or listed are skipped and appended to the unreachable list if one is given.
+    """
+    known = known or {}
+    stack = [str(directory)]
+    while stack:
+        path = stack.pop()
+        try:
+            metrics.incr("stats")
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError as e:
+            logging.debug(f"Couldn't stat {path}: {e}")
+            if unreachable is not None:
+                unreachable.append(path)
+            continue
+
+        cached = known.get(path)
+        listed = cached is None or cached[0] != mtime_ns
+        if listed:
+            subdirs = []
+            catalogs = []
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            if not is_skipped_directory(entry.name):
+                                subdirs.append(entry.name)
+                        elif os.path.splitext(entry.name)[1] == ".lrcat":
+                            catalogs.append(entry.name)
+            except OSError as e:
+                logging.debug(f"Couldn't list {path}: {e}")
+                if unreachable is not None:
+                    unreachable.append(path)
+                continue
+        else:
+            subdirs, catalogs = cached[1], cached[2]
+
+        yield path, mtime_ns, subdirs, catalogs, listed
+        if recursive:
+            stack.extend([os.path.join(path, x) for x in reversed(subdirs)])
+
+
+def walk_catalog_directories_parallel(directories, known=None, workers=SCAN_WORKERS, unreachable=None):
+    """Walk several directories at the same time and yield the same records as walk_catalog_directories
+
+    Each directory and each of its subdirectories is walked as a separate unit on a pool of threads, so walking
+    several drives takes about as long as the slowest one. Records are handed over through a bounded queue while
+    they're found, which keeps memory flat however big the trees are.
+    """
+    records = queue.Queue(maxsize=SCAN_QUEUE_SIZE)
+    stop = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=workers)
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                records.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def walk(directory, recursive):
+        try:
+            for record in walk_catalog_directories(directory, known, recursive=recursive, unreachable=unreachable):
+                if not put(("record", record)):
+                    return
+                if not recursive:
+                    # Split the top level into one unit per subdirectory
+                    subdirs = [os.path.join(record[0], x) for x in record[2]]
+                    put(("units", len(subdirs)))
+                    for subdir in subdirs:
+                        if stop.is_set():
+                            break
+                        executor.submit(walk, subdir, True)
+        except Exception as e:
+            put(("error", e))
+        finally:
+            put(("done", None))
+
+    outstanding = 0
+    try:
+        for directory in directories:
+            executor.submit(walk, str(directory), False)
+            outstanding += 1
+        while outstanding:
+            kind, value = records.get()
+            if kind == "record":
+                yield value
+            elif kind == "units":
+                outstanding += value
+            elif kind == "done":
+                outstanding -= 1
+            else:
+                raise value
+    finally:
+        stop.set()
+        executor.shutdown(wait=False)
+
+
+#
+# Backups
+#
+def content_chunks(path, page_size=None, mask=BACKUP_CHUNK_MASK, min_pages=BACKUP_MIN_PAGES,
+                   max_pages=BACKUP_MAX_PAGES, throttle=None, drop_cache=False):
+    """Split a file into content defined chunks of whole pages
+
+    A chunk ends after a page whose checksum has none of the mask bits set, so the boundaries only depend on
+    the pages around them and a page that changed between two snapshots only changes the chunk it's in.
+    A throttle function is called with the bytes of every chunk and with drop_cache the chunks are dropped
+    from the page cache once they're read.
+    """
+    page_size = page_size or sqlite_page_size(path) or BACKUP_PAGE_SIZE
+    pages = []
+    offset = 0
+    with open(path, "rb", buffering=FANOUT_BUFFER_SIZE) as f:
+        while True:
+            page = f.read(page_size)
+            if not page:
+                break
+            pages.append(page)
+            if len(pages) >= max_pages or (len(pages) >= min_pages and not zlib.crc32(page) & mask):
+                chunk = b"".join(pages)
+                pages = []
+                if throttle is not None:
+                    throttle(len(chunk))
+                if drop_cache:
+                    drop_page_cache(f, offset, len(chunk))
+                offset += len(chunk)
+                yield chunk
+        if pages:
+            chunk = b"".join(pages)
+            if throttle is not None:
+                throttle(len(chunk))
+            if drop_cache:
+                drop_page_cache(f, offset, len(chunk))
+            yield chunk
+
+
+class BackupStore:
+    """Keep snapshots of files as content addressed chunks, each unique chunk is stored once
+
+    Chunks are stored under chunks/ by their hash and every snapshot is a JSON manifest under
+    manifests/<catalog>/ listing its chunks in order. Nothing is created until the first snapshot.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.chunks = self.root / "chunks"
+        self.manifests = self.root / "manifests"
+
+    def chunk_path(self, digest):
+        return self.chunks / digest[:2] / digest
+
+    def snapshot(self, path, catalog=None, throttle=None, drop_cache=False):
+        """Store a snapshot of a file and return its manifest
+
+        A file that didn't change since its last snapshot returns that snapshot instead of a new one. throttle
+        and drop_cache are passed on to content_chunks for reading the file.
+        """
+        import hashlib
+
+        path = Path(path)
+        catalog = catalog or path.stem
+        page_size = sqlite_page_size(path) or BACKUP_PAGE_SIZE
+        chunks = []
+        stored = 0
+        for data in content_chunks(path, page_size=page_size, throttle=throttle, drop_cache=drop_cache):
+            digest = hashlib.blake2b(data, digest_size=20).hexdigest()
+            chunks.append([digest, len(data)])
+            chunk_path = self.chunk_path(digest)
+            if not chunk_path.exists():
+                chunk_path.parent.mkdir(parents=True, exist_ok=True)
+                # Write to a temp file first so a chunk is never stored half written
+                temp = chunk_path.with_name(f"{digest}.tmp{threading.get_ident()}")
+                temp.write_bytes(data)
+                os.replace(str(temp), str(chunk_path))
+                stored += len(data)
+        metrics.incr("backup_bytes_stored", stored)
+
+        previous = [x for x in self.snapshots(catalog) if x["path"] == str(path)]
+        if previous and previous[-1]["chunks"] == chunks:
+            logging.debug(f"{path} didn't change since snapshot {previous[-1]['id']}")
+            return previous[-1]
+
+        created = time.time()
+        manifest = {
+            "id": f"{time.time_ns()}-{zlib.crc32(os.fsencode(str(path))):08x}",
+            "catalog": catalog,
+            "path": str(path),
+            "created": created,
+            "size": sum(x[1] for x in chunks),
+            "page_size": page_size,
+            "chunks": chunks,
+        }
+        manifest_path = self.manifests / catalog / f"{manifest['id']}.json"
+        manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        temp = manifest_path.with_suffix(".tmp")
+        temp.write_text(json.dumps(manifest))
+        os.replace(str(temp), str(manifest_path))
+        logging.debug(f"Stored snapshot {manifest['id']} of {path}, {stored} new bytes")
+        return manifest
+
+    def snapshots(self, catalog=None):
+        """Return the manifests of all snapshots, or the ones of a catalog, oldest first"""
+        if catalog:
+            paths = (self.manifests / catalog).glob("*.json")
+        else:
+            paths = self.manifests.glob("*/*.json")
+        manifests = [json.loads(x.read_text()) for x in paths]
+        return sorted(manifests, key=lambda x: (x["created"], x["id"]))
+
+    def find(self, snapshot_id):
+        """Return the manifest of a snapshot"""
+        if self.manifests.is_dir():
+            for directory in self.manifests.iterdir():
+                manifest_path = directory / f"{snapshot_id}.json"
+                if manifest_path.is_file():
+                    return json.loads(manifest_path.read_text())
+        raise KeyError(f"No snapshot with id {snapshot_id}")
+
+    def restore(self, snapshot_id, destination=None):
+        """Write a snapshot back to its path, or to destination, and return the path
+
+        Every chunk is checked against its hash and the file is only replaced once all of it is written.
+        """
+        import hashlib
+
+        manifest = self.find(snapshot_id)
+        destination = Path(destination or manifest["path"])
+        temp = partial_path(destination)
+        with open(temp, "wb") as f:
+            for digest, size in manifest["chunks"]:
+                data = self.chunk_path(digest).read_bytes()
+                if len(data) != size or hashlib.blake2b(data, digest_size=20).hexdigest() != digest:
+                    temp.unlink()
+                    raise ValueError(f"Chunk {digest} of snapshot {snapshot_id} is corrupt")
+                f.write(data)
+        publish(temp, destination)
+        logging.debug(f"Restored snapshot {snapshot_id} to {destination}")
+        return destination
+
+    def prune(self, keep_last=BACKUP_KEEP_LAST, keep_days=BACKUP_KEEP_DAYS, max_bytes=None):
+        """Delete old snapshots and the chunks no snapshot uses anymore
+
+        The newest keep_last snapshots of every catalog and all snapshots from the last keep_days days are
+        kept. If the kept snapshots still use more than max_bytes, the oldest ones are evicted until they fit,
+        but the newest snapshot of a catalog is never evicted. Returns the number of snapshots and chunks
+        deleted and the bytes freed.
+        """
+        manifests = self.snapshots()
+        newest = {x["catalog"]: x["id"] for x in manifests}
+        cutoff = time.time() - keep_days * 24 * 60 * 60
+        kept = []
+        removed = []
+        for catalog in newest:
+            snapshots = [x for x in manifests if x["catalog"] == catalog]
+            for index, manifest in enumerate(reversed(snapshots)):
+                if index < keep_last or manifest["created"] >= cutoff:
+                    kept.append(manifest)
+                else:
+                    removed.append(manifest)
+
+        # Count how many kept snapshots use every chunk, so evicting one only frees the chunks nobody else uses
+        references = {}
+        sizes = {}
+        for manifest in kept:
+            for digest, size in {x[0]: x[1] for x in manifest["chunks"]}.items():
+                references[digest] = references.get(digest, 0) + 1
+                sizes[digest] = size
+        total = sum(sizes.values())
+        if max_bytes is not None:
+            for manifest in sorted(kept, key=lambda x: x["created"]):
+                if total <= max_bytes:
+                    break
+                if manifest["id"] == newest[manifest["catalog"]]:
+                    continue
+                kept.remove(manifest)
+                removed.append(manifest)
+                for digest in {x[0] for x in manifest["chunks"]}:
+                    references[digest] -= 1
+                    if not references[digest]:
+                        total -= sizes[digest]
+
+        for manifest in removed:
+            (self.manifests / manifest["catalog"] / f"{manifest['id']}.json").unlink()
+            logging.debug(f"Deleted snapshot {manifest['id']} of {manifest['path']}")
+
+        used = {x[0] for manifest in kept for x in manifest["chunks"]}
+        chunks = 0
+        freed = 0
+        for chunk_path in self.chunks.glob("*/*"):
+            if chunk_path.name not in used:
+                freed += chunk_path.stat().st_size
+                chunk_path.unlink()
+                chunks += 1
+        return {"snapshots": len(removed), "chunks": chunks, "bytes": freed}
+
+    def size(self):
+        """Return the bytes used by all chunks in the store"""
+        return sum(x.stat().st_size for x in self.chunks.glob("*/*"))
+
+
+#
+# Metrics
+#
+class Metrics:
+    """Collect wall time per phase, counters and bytes per destination of a run"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.phases = {}
+            self.counters = {}
+            self.destinations = {}
+
+    @contextmanager
+    def phase(self, name):
+        """Add the wall time of the block to a phase"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_copy(self, destination, result):
+        """Add the bytes read and written and the seconds of a copy to its destination"""
+        with self.lock:
+            totals = self.destinations.setdefault(str(destination), {"bytes_read": 0, "bytes_written": 0,
+                                                                     "seconds": 0.0, "copies": 0})
+            totals["bytes_read"] += result.get("read", 0)
+            totals["bytes_written"] += result["bytes"]
+            totals["seconds"] += result["seconds"]
+            totals["copies"] += 1
+            self.counters["bytes_read"] = self.counters.get("bytes_read", 0) + result.get("read", 0)
+            self.counters["bytes_written"] = self.counters.get("bytes_written", 0) + result["bytes"]
+
+    def report(self):
+        """Return everything that was collected as a dict"""
+        with self.lock:
+            destinations = {}
+            for destination, totals in self.destinations.items():
+                destinations[destination] = dict(totals)
+                seconds = totals["seconds"]
+                destinations[destination]["mb_per_s"] = totals["bytes_written"] / MB / seconds if seconds else 0.0
+            return {
+                "phases": dict(self.phases),
+                "counters": dict(self.counters),
+                "destinations": destinations,
+            }
+
+    def write_json(self, path):
+        Path(path).write_text(json.dumps(self.report(), indent=2))
+
+    def write_prometheus(self, path):
+        """Write the report in the format of the Prometheus node exporter textfile collector"""
+        report = self.report()
+        lines = [
+            "# HELP lightroom_sync_phase_seconds Wall time spent in a phase of the last run",
+            "# TYPE lightroom_sync_phase_seconds gauge",
+        ]
+        lines.extend(f'lightroom_sync_phase_seconds{{phase="{_label(x)}"}} {y}' for x, y in report["phases"].items())
+        lines.extend([
+            "# HELP lightroom_sync_count Counters of the last run",
+            "# TYPE lightroom_sync_count gauge",
+        ])
+        lines.extend(f'lightroom_sync_count{{name="{_label(x)}"}} {y}' for x, y in report["counters"].items())
+        for key in ["bytes_read", "bytes_written", "seconds", "mb_per_s"]:
+            lines.extend([
+                f"# HELP lightroom_sync_destination_{key} {key.replace('_', ' ').capitalize()} per destination",
+                f"# TYPE lightroom_sync_destination_{key} gauge",
+            ])
+            lines.extend(f'lightroom_sync_destination_{key}{{destination="{_label(x)}"}} {y[key]}'
+                         for x, y in report["destinations"].items())
+
+        # Write to a temp file first so the collector never reads half a file
+        temp = Path(f"{path}.tmp")
+        temp.write_text("\n".join(lines) + "\n")
+        os.replace(str(temp), str(path))
+
+
+def _label(value):
+    """Escape a Prometheus label value"""
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+metrics = Metrics()
+
+
+#
+# Watch
+#
+def catalog_state(path):
+    """Return the size and mtime of a catalog and its journal files, or None for the ones that don't exist"""
+    state = []
+    for suffix in CATALOG_JOURNAL_SUFFIXES:
+        try:
+            metrics.incr("stats")
+            stat = os.stat(f"{path}{suffix}")
+            state.append((stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            state.append(None)
+    return tuple(state)
+
+
+class PollingWatcher:
+    """Watch catalog paths by comparing their size and mtime every interval"""
+
+    def __init__(self, paths, interval=WATCH_INTERVAL):
+        self.interval = interval
+        self.states = {str(x): catalog_state(x) for x in paths}
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds and return the paths that changed"""
+        time.sleep(min(timeout, self.interval))
+        changed = set()
+        for path, state in self.states.items():
+            current = catalog_state(path)
+            if current != state:
+                self.states[path] = current
+                changed.add(path)
+        return changed
+
+    def close(self):
+        pass
 
-    return catalogs
+
+class InotifyWatcher:
+    """Watch the directories of catalog paths with inotify"""
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, paths):
+        import ctypes
+        import ctypes.util
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "Couldn't initialize inotify")
+
+        self.names = {}
+        for path in paths:
+            directory, name = os.path.split(str(path))
+            self.names.setdefault(directory, {})[name] = str(path)
+
+        self.directories = {}
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        for directory in self.names:
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+            if wd < 0:
+                logging.warning(f"Couldn't watch {directory}: {os.strerror(ctypes.get_errno())}")
+                continue
+            self.directories[wd] = directory
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds and return the paths that changed"""
+        changed = set()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return changed
+
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+
+            catalogs = self.names.get(self.directories.get(wd), {})
+            for suffix in CATALOG_JOURNAL_SUFFIXES:
+                if name.endswith(suffix) and name[:len(name) - len(suffix)] in catalogs:
+                    changed.add(catalogs[name[:len(name) - len(suffix)]])
+                    break
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def create_watcher(paths, poll=False, interval=WATCH_INTERVAL):
+    """Return an inotify watcher on Linux and a polling watcher everywhere else or if poll is True"""
+    if not poll and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(paths)
+        except (OSError, AttributeError) as e:
+            logging.warning(f"Couldn't use inotify, falling back to polling: {e}")
+    return PollingWatcher(paths, interval=interval)
 
 
 def is_version_string(input_string):
@@ -349,28 +2956,430 @@ def filename_to_name_and_version(filename):
     return name, version
 
 
+#
+# Daemon
+#
+def run_sync(lrsync, catalog=None, mode="copy", workers=None, pages=ONLINE_COPY_PAGES, sleep=ONLINE_COPY_SLEEP,
+             previews=False, latest_only=False, backup=True, rate_limit=None, device_limits=None, ionice=None,
+             drop_cache=None, timeout=STAT_TIMEOUT, plan=None, plan_only=False, verify=False):
+    """Run the sync command with its options, in this process or in the daemon
+
+    plan is a plan written by --plan, whose mode is used. Returns the plan with plan_only, otherwise whether
+    every catalog was synced.
+    """
+    lrsync.stat_timeout = timeout
+    if plan is not None:
+        mode = plan["mode"]
+    if plan_only:
+        jobs = lrsync.plan_sync(catalog, mode=mode, previews=previews, latest_only=latest_only, metadata_only=True)
+        return lrsync.estimate_plan(jobs, mode=mode)
+    options = {"pages": pages, "sleep": sleep} if mode == "online" else None
+    io_limits = lrsync.io_limits(rate_limit=rate_limit, device_limits=device_limits, drop_cache=drop_cache)
+    return lrsync.sync(catalog, backup=backup, mode=mode, workers=workers, options=options, previews=previews,
+                       latest_only=latest_only, io_limits=io_limits, io_priority=ionice,
+                       plan=None if plan is None else load_plan(plan), verify=verify)
+
+
+class SyncDaemon:
+    """Keep a LightroomSync open and run commands for clients of a Unix socket
+
+    Every request is a line of JSON with a command from DAEMON_COMMANDS and its args, answered with a line of
+    JSON with ok, the result and the printed output, or the error. Commands run one at a time on the thread that
+    serves, since they share the database connection, but status is answered from memory right away.
+    """
+
+    def __init__(self, lrsync, path=DAEMON_SOCKET):
+        self.lrsync = lrsync
+        self.path = str(path)
+        self.requests = queue.Queue()
+        self.started = time.time()
+        self.served = 0
+        self.busy = None
+        self.catalogs = len(lrsync.select_all_catalogs())
+        # Published by the serving thread after every command, since status reads it from another thread while
+        # a command adds to the offline volumes
+        self.offline_volumes = tuple(sorted(lrsync.offline_volumes))
+
+    def status(self):
+        """Return what the daemon is doing, without touching the database"""
+        return {
+            "pid": os.getpid(),
+            "database": os.path.abspath(self.lrsync.db),
+            "started": self.started,
+            "uptime": time.time() - self.started,
+            "requests": self.served,
+            "busy": self.busy,
+            "queued": self.requests.qsize(),
+            "catalogs": self.catalogs,
+            "fingerprints": len(self.lrsync.fingerprints or {}),
+            "offline_volumes": [*self.offline_volumes],
+        }
+
+    def handle(self, line):
+        """Return the response to a request line, waiting for its command to run if it isn't status"""
+        try:
+            request = json.loads(line)
+            command = request["command"]
+            args = request.get("args") or {}
+        except (ValueError, KeyError, TypeError) as e:
+            return {"ok": False, "error": f"Invalid request: {e}"}
+        if command not in DAEMON_COMMANDS:
+            return {"ok": False, "error": f"Unknown command {command}, use one of {', '.join(DAEMON_COMMANDS)}"}
+        if command == "status":
+            return {"ok": True, "result": self.status()}
+        reply = queue.Queue(1)
+        self.requests.put((command, args, reply))
+        return reply.get()
+
+    def run(self, command, args):
+        """Run a command and return its response with everything it printed"""
+        self.busy = command
+        output = io.StringIO()
+        try:
+            with redirect_stdout(output):
+                if command == "scan":
+                    result = self.lrsync.scan(*(args.get("directories") or [Path()]),
+                                              incremental=args.get("incremental", False),
+                                              workers=args.get("workers", SCAN_WORKERS))
+                elif command == "sync":
+                    result = run_sync(self.lrsync, **args)
+                else:
+                    result = self.lrsync.print_list(**args)
+            self.catalogs = len(self.lrsync.select_all_catalogs())
+            return {"ok": True, "result": result, "output": output.getvalue()}
+        except Exception as e:
+            logging.exception(f"Daemon {command} failed")
+            return {"ok": False, "error": str(e) or type(e).__name__, "output": output.getvalue()}
+        finally:
+            self.offline_volumes = tuple(sorted(self.lrsync.offline_volumes))
+            self.busy = None
+            self.served += 1
+
+    def serve(self, stop=None):
+        """Serve clients until stop is set or the process is interrupted
+
+        A socket left behind by a daemon that's gone is replaced, but not one that a daemon still answers on.
+        """
+        import socketserver
+
+        if os.path.exists(self.path):
+            if daemon_request("status", path=self.path) is not None:
+                raise RuntimeError(f"A daemon is already running on {self.path}")
+            os.unlink(self.path)
+
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    self.wfile.write(json.dumps(daemon.handle(line)).encode() + b"\n")
+                    self.wfile.flush()
+
+        # The socket is listening before it's moved into place, so a client never finds one it can't connect to
+        temp = f"{self.path}.{os.getpid()}.tmp"
+        server = socketserver.ThreadingUnixStreamServer(temp, Handler)
+        os.replace(temp, str(self.path))
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        logging.info(f"Daemon listening on {self.path}")
+        try:
+            while stop is None or not stop.is_set():
+                try:
+                    command, args, reply = self.requests.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                reply.put(self.run(command, args))
+        finally:
+            server.shutdown()
+            server.server_close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+
+def daemon_request(command, args=None, path=DAEMON_SOCKET):
+    """Send a request to the daemon listening on path and return its response, or None if no daemon is running"""
+    import socket
+
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with client:
+        try:
+            client.connect(str(path))
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+        with client.makefile("rwb") as f:
+            f.write(json.dumps({"command": command, "args": args or {}}).encode() + b"\n")
+            f.flush()
+            line = f.readline()
+    if not line:
+        raise ConnectionError(f"The daemon on {path} closed the connection")
+    return json.loads(line)
+
+
+def daemon_command(command, **args):
+    """Run a command in the daemon if one is running, print its output and return its response
+
+    Returns None when there's no daemon or --no-daemon was given, so the command runs in this process.
+    """
+    settings = click.get_current_context().obj or {}
+    if not settings.get("daemon", True):
+        return None
+    response = daemon_request(command, args, path=settings.get("socket", DAEMON_SOCKET))
+    if response is None:
+        return None
+    click.echo(response.get("output", ""), nl=False)
+    if not response["ok"]:
+        raise click.ClickException(response["error"])
+    return response
+
+
 #
 # CLI
 #
+COPY_MODE_HELP = ("copy: whole files, delta: only changed pages, fanout: read once and write to all paths, "
+                  "online: consistent snapshot with the SQLite backup API")
+
+
 @click.group()
-def cli():
-    pass
+@click.option("--metrics", "metrics_path", type=click.Path(dir_okay=False), default=None,
+              help="Write wall time per phase, counters and throughput per destination to a JSON file")
+@click.option("--prometheus", "prometheus_path", type=click.Path(dir_okay=False), default=None,
+              help="Write the metrics to a Prometheus textfile collector file")
+@click.option("--profile", "profile_path", type=click.Path(dir_okay=False), default=None,
+              help="Profile the command with cProfile and dump the stats to a file")
+@click.option("--log-level", type=click.Choice(["debug", "info", "warning"]), default="info",
+              help="Level of the messages to log")
+@click.option("--log-file", type=click.Path(dir_okay=False), default="lightroom_sync.log",
+              help="File to log to, created when the first message is logged")
+@click.option("--socket", "socket_path", type=click.Path(dir_okay=False), default=DAEMON_SOCKET,
+              help="Unix socket of the daemon")
+@click.option("--no-daemon", is_flag=True, help="Run the command in this process even if a daemon is running")
+@click.pass_context
+def cli(ctx, metrics_path, prometheus_path, profile_path, log_level, log_file, socket_path, no_daemon):
+    ctx.obj = {"socket": socket_path, "daemon": not no_daemon}
+    setup_logging(level=log_level, filename=log_file)
+    metrics.reset()
+    if profile_path:
+        import cProfile
+        import pstats
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+        def dump_profile():
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(20)
+        ctx.call_on_close(dump_profile)
+
+    def write_metrics():
+        if metrics_path:
+            metrics.write_json(metrics_path)
+        if prometheus_path:
+            metrics.write_prometheus(prometheus_path)
+    ctx.call_on_close(write_metrics)
+
+
+@cli.command()
+@click.argument("catalog", default=None, required=False)
+@click.option("--all", "sync_all", is_flag=True, help="Sync every catalog in the database")
+@click.option("--mode", type=click.Choice(sorted(COPY_MODES)), default="copy", help=COPY_MODE_HELP)
+@click.option("--workers", type=int, default=None, help="Number of copies to run at the same time")
+@click.option("--pages", type=int, default=ONLINE_COPY_PAGES, help="Pages to copy per step in online mode")
+@click.option("--sleep", type=float, default=ONLINE_COPY_SLEEP, help="Seconds to sleep between steps in online mode")
+@click.option("--previews", is_flag=True, help="Also sync the .lrdata preview folders of the catalogs")
+@click.option("--latest-only", is_flag=True, help="Only sync the newest version of every catalog")
+@click.option("--backup/--no-backup", default=True, help="Snapshot every catalog before it's overwritten")
+@click.option("--rate-limit", type=float, default=None, help="MB/s to read or write on every device, 0 for no limit")
+@click.option("--device-limit", "device_limits", multiple=True, metavar="PATH=MB",
+              help="MB/s for the device a path is on, can be given more than once")
+@click.option("--ionice", type=click.Choice(sorted(IO_PRIORITIES)), default=None, help="Lower the I/O priority")
+@click.option("--drop-cache/--keep-cache", default=None, help="Drop copied data from the page cache")
+@click.option("--timeout", type=float, default=STAT_TIMEOUT,
+              help="Seconds to wait for a path before its volume is treated as offline")
+@click.option("--plan", "plan_only", is_flag=True,
+              help="Print what would be copied and how long it would take as JSON instead of syncing")
+@click.option("--from-plan", type=click.Path(exists=True, dir_okay=False), default=None,
+              help="Run a plan written by --plan")
+@click.option("--verify", is_flag=True, help="Read every copy back, check it against the source and copy it again "
+                                             "if it doesn't match")
+def sync(catalog, sync_all, mode, workers, pages, sleep, previews, latest_only, backup, rate_limit, device_limits,
+         ionice, drop_cache, timeout, plan_only, from_plan, verify):
+    """Sync a catalog, or all catalogs with --all, across its paths
+
+    Rate limits, I/O priority and page cache use not given here come from the config.
+    """
+    if catalog is None and not sync_all and from_plan is None:
+        raise click.UsageError("Give a catalog name, use --all or --from-plan")
+    plan = None
+    if from_plan is not None:
+        with open(from_plan) as f:
+            plan = json.load(f)
+    limits = {}
+    for device_limit in device_limits:
+        path, _, limit = device_limit.rpartition("=")
+        try:
+            limits[os.path.abspath(path)] = float(limit)
+        except ValueError:
+            raise click.BadParameter(f"{device_limit} isn't PATH=MB", param_hint="--device-limit")
+    args = {"catalog": None if sync_all else catalog, "mode": mode, "workers": workers, "pages": pages,
+            "sleep": sleep, "previews": previews, "latest_only": latest_only, "backup": backup,
+            "rate_limit": rate_limit, "device_limits": limits, "ionice": ionice, "drop_cache": drop_cache,
+            "timeout": timeout, "plan": plan, "plan_only": plan_only, "verify": verify}
+    response = daemon_command("sync", **args)
+    if response is None:
+        result = run_sync(LightroomSync(stat_timeout=timeout), **args)
+    else:
+        result = response["result"]
+    if plan_only:
+        print(json.dumps(result, indent=2))
+    elif not result:
+        raise click.ClickException("Some catalogs couldn't be synced, see the log for why")
+
+
+@cli.command()
+@click.argument("directories", nargs=-1)
+@click.option("--incremental", is_flag=True,
+              help="Only list directories that changed since the last incremental scan and remove missing catalogs")
+@click.option("--workers", type=int, default=SCAN_WORKERS, help="Number of directories to walk at the same time")
+def scan(directories, incremental, workers):
+    """Scan the directories for Lightroom catalogs"""
+    directories = [os.path.abspath(x) for x in directories or [Path()]]
+    if daemon_command("scan", directories=directories, incremental=incremental, workers=workers) is None:
+        lrsync = LightroomSync()
+        lrsync.scan(*directories, incremental=incremental, workers=workers)
 
 
 @cli.command()
-@click.argument("catalog", default=None)
-def sync(catalog):
-    """Sync """
+@click.option("--debounce", type=float, default=WATCH_DEBOUNCE,
+              help="Seconds a catalog has to be unchanged before it's synced")
+@click.option("--interval", type=float, default=WATCH_INTERVAL, help="Seconds between polls")
+@click.option("--mode", type=click.Choice(sorted(COPY_MODES)), default="copy", help=COPY_MODE_HELP)
+@click.option("--poll", is_flag=True, help="Poll for changes instead of using inotify")
+def watch(debounce, interval, mode, poll):
+    """Sync catalogs as soon as they change"""
     lrsync = LightroomSync()
-    lrsync.sync(catalog)
+    try:
+        lrsync.watch(debounce=debounce, interval=interval, mode=mode, poll=poll)
+    except KeyboardInterrupt:
+        print("Stopped watching")
+
+
+@cli.command()
+def daemon():
+    """Keep the database and caches open and serve scan, sync, list and status on the daemon socket
+
+    Other commands use the daemon while it's running.
+    """
+    import signal
+
+    settings = click.get_current_context().obj
+    lrsync = LightroomSync(cache=True)
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    try:
+        SyncDaemon(lrsync, settings["socket"]).serve(stop)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    except KeyboardInterrupt:
+        print("Stopped the daemon")
 
 
 @cli.command()
-@click.argument("directory", default=Path())
-def scan(directory):
-    """Scan the directory for Lightroom catalogs"""
+def status():
+    """Show what the daemon is doing"""
+    settings = click.get_current_context().obj
+    response = daemon_request("status", path=settings["socket"])
+    if response is None:
+        print("No daemon is running")
+        return
+    for key, value in response["result"].items():
+        print(f"{key} = {value}")
+
+
+@cli.command()
+@click.argument("catalog", default=None, required=False)
+def backups(catalog):
+    """List the backup snapshots of all catalogs or of one catalog"""
     lrsync = LightroomSync()
-    lrsync.scan(directory)
+    snapshots = lrsync.backups.snapshots(catalog)
+    len_id = max([len(x["id"]) for x in snapshots] + [len("ID")]) + 2
+    len_created = len("2000-01-01 00:00:00") + 2
+    len_size = max([len(str(x["size"])) for x in snapshots] + [len("Size")]) + 2
+    print("ID".ljust(len_id), "Created".ljust(len_created), "Size".ljust(len_size), "Path")
+    for snapshot in snapshots:
+        print(snapshot["id"].ljust(len_id),
+              time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(snapshot["created"])).ljust(len_created),
+              str(snapshot["size"]).ljust(len_size),
+              snapshot["path"])
+    print(f"{len(snapshots)} snapshots, {lrsync.backups.size() / MB:.1f} MB of chunks")
+
+
+@cli.command()
+@click.option("--keep-last", type=int, default=BACKUP_KEEP_LAST, help="Snapshots to keep of every catalog")
+@click.option("--keep-days", type=float, default=BACKUP_KEEP_DAYS, help="Keep all snapshots from the last days")
+@click.option("--max-size", type=float, default=None, help="Evict the oldest snapshots until the store fits in MB")
+def prune(keep_last, keep_days, max_size):
+    """Delete old backup snapshots and the chunks they don't share with newer ones"""
+    lrsync = LightroomSync()
+    result = lrsync.backups.prune(keep_last=keep_last, keep_days=keep_days,
+                                  max_bytes=None if max_size is None else int(max_size * MB))
+    print(f"Deleted {result['snapshots']} snapshots and {result['chunks']} chunks, "
+          f"freed {result['bytes'] / MB:.1f} MB")
+
+
+@cli.command()
+@click.argument("snapshot")
+@click.argument("destination", default=None, required=False)
+@click.option("--backup/--no-backup", default=True, help="Snapshot the file that's replaced first")
+def restore(snapshot, destination, backup):
+    """Restore a backup snapshot to the path it was taken of, or to DESTINATION"""
+    lrsync = LightroomSync()
+    try:
+        path = lrsync.restore(snapshot, destination, backup=backup)
+    except KeyError as e:
+        raise click.BadParameter(e.args[0], param_hint="SNAPSHOT")
+    print(f"Restored {snapshot} to {path}")
+
+
+@cli.command()
+@click.argument("key", default=None, required=False)
+@click.argument("value", default=None, required=False)
+@click.option("--unset", is_flag=True, help="Delete the setting")
+def config(key, value, unset):
+    """Show all settings, or show, set or unset one
+
+    \b
+    rate_limit        MB/s to read or write on every device, 0 for no limit
+    rate_limit:PATH   MB/s for the device PATH is on
+    ionice            I/O priority of syncs: idle, low or normal
+    drop_cache        Drop copied data from the page cache: true or false
+    """
+    lrsync = LightroomSync()
+    if key is None:
+        for name, setting in lrsync.select_settings().items():
+            print(f"{name} = {setting}")
+        return
+    if key not in SETTINGS and not key.startswith("rate_limit:"):
+        raise click.BadParameter(f"Unknown setting {key}, use one of {', '.join(SETTINGS)} or rate_limit:PATH",
+                                 param_hint="KEY")
+    if unset:
+        lrsync.delete_setting(key)
+    elif value is None:
+        print(lrsync.select_settings().get(key, ""))
+    else:
+        if key.startswith("rate_limit"):
+            try:
+                float(value)
+            except ValueError:
+                raise click.BadParameter(f"{value} isn't a number of MB/s", param_hint="VALUE")
+            if key != "rate_limit":
+                key = f"rate_limit:{os.path.realpath(key[len('rate_limit:'):])}"
+        elif key == "ionice" and value not in [*IO_PRIORITIES, "normal"]:
+            raise click.BadParameter(f"Use one of {', '.join(IO_PRIORITIES)} or normal", param_hint="VALUE")
+        lrsync.store_setting(key, value)
 
 
 @cli.command()
@@ -389,13 +3398,18 @@ def clear():
 
 @cli.command()
 @click.option("--catalogs/--paths", default=True)
-def list(catalogs):
+@click.option("--format", "output_format", type=click.Choice(LIST_FORMATS), default="table",
+              help="Print a table, a JSON array, a JSON object per line or CSV")
+@click.option("--limit", type=int, default=None, help="Number of rows to list")
+@click.option("--offset", type=int, default=0, help="Number of rows to skip")
+@click.option("--name", default=None, help="Only list catalogs, or paths of catalogs, matching a pattern like 'Trip*'")
+def list(catalogs, output_format, limit, offset, name):
     """List all the catalogs or paths in the database"""
+    args = {"catalogs": catalogs, "name": name, "limit": limit, "offset": offset, "output_format": output_format}
+    # Listing only reads the database, so it isn't sent to the daemon, which would hold all of it in one response
     lrsync = LightroomSync()
-    if catalogs:
-        lrsync.list_catalogs()
-    else:
-        lrsync.list_paths()
+    with metrics.phase("list"):
+        lrsync.print_list(**args)
 
 
 if __name__ == '__main__':
@@ -13,6 +13,110 @@ CREATE TABLE IF NOT EXISTS paths(
     FOREIGN KEY(catalog_id) REFERENCES catalogs(catalog_id)
 );
 
+-- Create fingerprints table
+CREATE TABLE IF NOT EXISTS fingerprints(
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    inode INTEGER,
+    fingerprint TEXT
+);
+
+-- Create directories table
+CREATE TABLE IF NOT EXISTS directories(
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER,
+    subdirs TEXT,
+    catalogs TEXT
+);
+
+-- Index paths on catalog for counting and joining
+CREATE INDEX IF NOT EXISTS paths_catalog_id ON paths(catalog_id);
+
+-- Create copies table
+CREATE TABLE IF NOT EXISTS copies(
+    copy_id INTEGER PRIMARY KEY,
+    source TEXT,
+    destination TEXT,
+    strategy TEXT,
+    bytes INTEGER,
+    seconds REAL,
+    device INTEGER,
+    copied_at REAL
+);
+
+-- Create versions table, the base name and version of every path filled in by scan
+CREATE TABLE IF NOT EXISTS versions(
+    path TEXT PRIMARY KEY,
+    base_name TEXT NOT NULL,
+    version INTEGER,
+    device INTEGER
+);
+
+-- Index versions so the latest version of a catalog on every device is a single lookup
+CREATE INDEX IF NOT EXISTS versions_base_name ON versions(base_name, device, version);
+
+-- Create checkpoints table, how far the unfinished copies got
+CREATE TABLE IF NOT EXISTS checkpoints(
+    destination TEXT PRIMARY KEY,
+    source TEXT,
+    size INTEGER,
+    mtime_ns INTEGER,
+    offset INTEGER,
+    updated REAL
+);
+
+-- Create settings table for the config command
+CREATE TABLE IF NOT EXISTS settings(
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+
+-- Create offline table, the paths that couldn't be reached and why
+CREATE TABLE IF NOT EXISTS offline(
+    path TEXT PRIMARY KEY,
+    volume TEXT,
+    reason TEXT,
+    since REAL
+);
+
+-- Index copies on device for the throughput history of the planner
+CREATE INDEX IF NOT EXISTS copies_device ON copies(device, copied_at);
+
+-- Create verifications table, every check of a copy against its source after a sync
+CREATE TABLE IF NOT EXISTS verifications(
+    verification_id INTEGER PRIMARY KEY,
+    source TEXT,
+    destination TEXT,
+    expected TEXT,
+    actual TEXT,
+    quick_check TEXT,
+    ok INTEGER,
+    attempt INTEGER,
+    verified_at REAL
+);
+
+-- Create headers table, the header of every SQLite catalog file when it was last read and last synced, and
+-- the header of the source it was synced from
+CREATE TABLE IF NOT EXISTS headers(
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    change_counter INTEGER,
+    schema_cookie INTEGER,
+    synced_size INTEGER,
+    synced_counter INTEGER,
+    synced_cookie INTEGER,
+    source_size INTEGER,
+    source_counter INTEGER,
+    source_cookie INTEGER,
+    diverged REAL
+);
+
+-- Count paths for every catalog
+SELECT catalogs.catalog_id, catalog_name, COUNT(paths.path_id), last_sync
+FROM catalogs LEFT JOIN paths ON paths.catalog_id = catalogs.catalog_id
+GROUP BY catalogs.catalog_id;
+
 -- Select all tables
 SELECT name FROM sqlite_master WHERE type = 'table';
 
@@ -67,4 +171,9 @@ WHERE catalog_id = (SELECT catalog_id FROM catalogs WHERE catalog_name = 'lr_cla
 -- Update last sync date
 UPDATE catalogs
 SET last_sync = 123
-WHERE catalog_name = 'lr_classic_2013_006';
\ No newline at end of file
+WHERE catalog_name = 'lr_classic_2013_006';
+
+-- Latest version of a catalog on every device
+SELECT device, MAX(version), path FROM versions
+WHERE base_name = 'lr_classic_2019'
+GROUP BY device;
@@ -1,9 +1,19 @@
-from unittest import TestCase
+from unittest import TestCase, skipUnless
 from lightroom_sync import lightroom_sync
 import sqlite3
+import json
+import io
+import logging
 import os
+import shutil
 from pathlib import Path
 import time
+from click.testing import CliRunner
+import tempfile
+import threading
+import subprocess
+import sys
+from unittest.mock import patch
 
 
 class TestLightroomSync(TestCase):
@@ -67,12 +77,14 @@ class TestLightroomSync(TestCase):
                          f"VALUES (2, '{self.test_catalog_c.resolve()}')")
 
     def tearDown(self):
+        self.lrsync.close()
         test_files = [self.test_db_name,
                       self.test_catalog_a.resolve(),
                       self.test_catalog_b.resolve(),
                       self.test_catalog_c.resolve(),
                       self.not_test_catalog.resolve()]
 
+        shutil.rmtree(str(Path(self.test_db_name).with_suffix(".backups")), ignore_errors=True)
         for f in test_files:
             p = Path(f)
             if p.is_file():
@@ -114,9 +126,53 @@ class TestLightroomSync(TestCase):
     def test_create_tables(self):
         self.cur.execute("DROP TABLE IF EXISTS catalogs")
         self.cur.execute("DROP TABLE IF EXISTS paths")
+        self.cur.execute("DROP TABLE IF EXISTS fingerprints")
+        self.cur.execute("DROP TABLE IF EXISTS directories")
+        self.cur.execute("DROP TABLE IF EXISTS copies")
+        self.cur.execute("DROP TABLE IF EXISTS versions")
+        self.cur.execute("DROP TABLE IF EXISTS checkpoints")
+        self.cur.execute("DROP TABLE IF EXISTS settings")
+        self.cur.execute("DROP TABLE IF EXISTS offline")
+        self.cur.execute("DROP TABLE IF EXISTS verifications")
+        self.cur.execute("DROP TABLE IF EXISTS headers")
+        self.cur.execute("PRAGMA user_version = 0")
         self.lrsync.create_tables()
         self.cur.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
-        self.assertListEqual(self.cur.fetchall(), [('catalogs',), ('paths',)])
+        self.assertListEqual(self.cur.fetchall(), [('catalogs',), ('paths',), ('fingerprints',), ('directories',),
+                                                   ('copies',), ('versions',), ('checkpoints',),
+                                                   ('settings',), ('offline',), ('verifications',),
+                                                   ('headers',)])
+
+    def test_create_tables_migrates(self):
+        self.cur.execute("PRAGMA user_version")
+        self.assertEqual(self.cur.fetchone()[0], len(lightroom_sync.MIGRATIONS))
+
+        # A database from before schema versions gets the new tables and indexes without losing data
+        self.lrsync.commit()
+        self.cur.execute("DROP INDEX paths_catalog_id")
+        self.cur.execute("DROP TABLE fingerprints")
+        self.cur.execute("PRAGMA user_version = 0")
+        self.lrsync.create_tables()
+        self.cur.execute("SELECT name FROM sqlite_master WHERE name IN ('paths_catalog_id', 'fingerprints')")
+        self.assertEqual(len(self.cur.fetchall()), 2)
+        self.assertEqual(len(self.lrsync.select_all_paths()), 3)
+
+    def test_iter_catalogs_with_path_count(self):
+        self.assertListEqual([tuple(x) for x in self.lrsync.iter_catalogs_with_path_count()],
+                             [(1, self.test_catalog_a.stem, 2, None), (2, self.test_catalog_c.stem, 1, None)])
+        self.assertListEqual([tuple(x) for x in self.lrsync.iter_catalogs_with_path_count("*_c_*")],
+                             [(2, self.test_catalog_c.stem, 1, None)])
+
+    def test_queries_schema(self):
+        # The scratch queries keep the schema in step with the migrations
+        queries = (Path(lightroom_sync.__file__).parent / "queries.sql").read_text()
+        for migration in lightroom_sync.MIGRATIONS:
+            for line in migration.splitlines():
+                self.assertIn(line.strip(), queries)
+
+    def test_select_paths_with_catalog_name(self):
+        self.assertListEqual([x[3] for x in self.lrsync.select_paths_with_catalog_name()],
+                             [self.test_catalog_a.stem, self.test_catalog_a.stem, self.test_catalog_c.stem])
 
     def test_select_all_catalogs(self):
         self.cur.execute("DELETE FROM paths")
@@ -167,6 +223,27 @@ class TestLightroomSync(TestCase):
                          "WHERE catalog_name = 'test_catalog'")
         self.assertEqual(self.cur.fetchone()[1], "test_catalog")
 
+    def test_insert_catalog_with_quote(self):
+        self.lrsync.insert_catalog("photographer's_catalog")
+        self.lrsync.insert_catalog("photographer's_catalog")
+        self.lrsync.insert_path("/test/photographer's_catalog.lrcat", "photographer's_catalog")
+        self.assertEqual(len(self.lrsync.select_all_paths_for_catalog_name("photographer's_catalog")), 1)
+
+    def test_transaction(self):
+        self.lrsync.commit()
+        with self.assertRaises(RuntimeError):
+            with self.lrsync.transaction():
+                self.lrsync.insert_catalogs(["rolled_back_a", "rolled_back_b"])
+                raise RuntimeError
+        self.assertIsNone(self.lrsync.catalog_id_from_name("rolled_back_a"))
+
+        with self.lrsync.transaction():
+            self.lrsync.insert_catalogs(["committed_a", "committed_b"])
+            self.lrsync.insert_paths([("/test/committed_a.lrcat", "committed_a")])
+        self.lrsync.conn.rollback()
+        self.assertIsNotNone(self.lrsync.catalog_id_from_name("committed_b"))
+        self.assertEqual(len(self.lrsync.select_all_paths_for_catalog_name("committed_a")), 1)
+
     def test_delete_catalog(self):
         self.lrsync.delete_catalog(self.test_catalog_a.stem)
 
@@ -215,26 +292,492 @@ class TestLightroomSync(TestCase):
         self.cur.execute(f"SELECT * FROM catalogs WHERE catalog_name = '{self.test_catalog_c.stem}'")
         self.assertIsNotNone(self.cur.fetchone()[2])
 
+        self.cur.execute("SELECT destination, strategy, bytes FROM copies")
+        destination, strategy, size = self.cur.fetchone()
+        self.assertEqual(destination, str(self.test_catalog_a.resolve()))
+        self.assertIn(strategy, lightroom_sync.COPY_STRATEGIES)
+        self.assertEqual(size, self.test_catalog_a.stat().st_size)
+
+    def test_sync_all(self):
+        self.assertTrue(self.lrsync.sync())
+        self.assertEqual(self.test_catalog_a.read_text(), self.test_catalog_b.read_text())
+        self.cur.execute("SELECT last_sync FROM catalogs")
+        self.assertNotIn(None, [x[0] for x in self.cur.fetchall()])
+
+    def test_plan_sync(self):
+        jobs = self.lrsync.plan_sync()
+        self.assertEqual(len(jobs), 2)
+        job = [x for x in jobs if x["catalog"] == self.test_catalog_a.stem][0]
+        self.assertEqual(job["source"], self.test_catalog_b.resolve())
+        self.assertListEqual(job["destinations"], [self.test_catalog_a.resolve()])
+        self.assertListEqual(job["devices"], [self.test_catalog_a.stat().st_dev])
+
+    def test_device_id_cache(self):
+        self.lrsync.devices = {}
+        device = self.test_catalog_a.stat().st_dev
+        self.assertEqual(self.lrsync.device_id(self.test_catalog_a), device)
+        self.assertEqual(self.lrsync.device_id(self.test_catalog_b), device)
+        self.assertEqual(self.lrsync.device_id(self.test_catalog_c), self.test_catalog_c.stat().st_dev)
+        with patch("lightroom_sync.lightroom_sync.device_id") as uncached:
+            self.assertEqual(self.lrsync.device_id(self.test_catalog_a.resolve()), device)
+            self.assertEqual(len(self.lrsync.plan_sync()), 2)
+            uncached.assert_not_called()
+
+    def test_estimate_plan(self):
+        jobs = self.lrsync.plan_sync(self.test_catalog_a.stem, metadata_only=True)
+        self.assertIsNone(jobs[0]["fingerprint"])
+        self.cur.execute("SELECT COUNT(*) FROM fingerprints")
+        self.assertEqual(self.cur.fetchone()[0], 0)
+
+        size = self.test_catalog_b.stat().st_size
+        plan = json.loads(json.dumps(self.lrsync.estimate_plan(jobs)))
+        self.assertEqual(plan["bytes"], size)
+        self.assertAlmostEqual(plan["seconds"], size / lightroom_sync.DEFAULT_THROUGHPUT)
+        self.assertEqual(plan["jobs"][0]["destinations"], [str(self.test_catalog_a.resolve())])
+
+        # Copies to a device are used for its throughput
+        device = self.test_catalog_a.stat().st_dev
+        self.cur.executemany("INSERT INTO copies(strategy, bytes, seconds, device, copied_at) VALUES (?, ?, ?, ?, ?)",
+                             [("sendfile", 100, 2.0, device, 1), ("delta", 100, 0.1, device, 2)])
+        self.assertDictEqual(self.lrsync.select_throughput(), {device: (100, 2.0)})
+        self.assertAlmostEqual(self.lrsync.estimate_plan(jobs)["seconds"], size / 50)
+
+    def test_sync_from_plan(self):
+        plan = json.loads(json.dumps(self.lrsync.estimate_plan(self.lrsync.plan_sync(metadata_only=True))))
+        self.assertTrue(self.lrsync.sync(plan=lightroom_sync.load_plan(plan)))
+        self.assertEqual(self.test_catalog_a.read_text(), self.test_catalog_b.read_text())
+
+        # A destination written to after planning isn't copied over
+        self.test_catalog_b.write_text("newer")
+        plan = self.lrsync.estimate_plan(self.lrsync.plan_sync(self.test_catalog_a.stem, metadata_only=True))
+        time.sleep(0.01)
+        self.test_catalog_a.write_text("changed")
+        self.assertTrue(self.lrsync.sync(plan=lightroom_sync.load_plan(plan)))
+        self.assertEqual(self.test_catalog_a.read_text(), "changed")
+
+    def test_latest_versions(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for drive, versions in [("drive_a", [1, 2, 3]), ("drive_b", [1, 2])]:
+                (Path(tmp) / drive).mkdir()
+                for version in versions:
+                    (Path(tmp) / drive / f"wedding_v{version:03}.lrcat").write_text(f"{drive} {version}")
+            self.lrsync.scan(tmp)
+
+            # Both drives are folders on the same device here
+            newest = (Path(tmp) / "drive_a" / "wedding_v003.lrcat").resolve()
+            self.assertDictEqual(self.lrsync.latest_versions("wedding"), {Path(tmp).stat().st_dev: (3, newest)})
+            self.assertListEqual(self.lrsync.latest_catalog_names(["wedding_v001", "wedding_v002",
+                                                                   self.test_catalog_a.stem]),
+                                 ["wedding_v003", self.test_catalog_a.stem])
+
+            # Only the newest version is synced, older versions keep their differences
+            self.assertTrue(self.lrsync.sync(latest_only=True))
+            self.assertEqual((Path(tmp) / "drive_a" / "wedding_v001.lrcat").read_text(), "drive_a 1")
+            self.assertEqual(self.test_catalog_a.read_text(), self.test_catalog_b.read_text())
+            jobs = self.lrsync.plan_sync("wedding_v001", latest_only=True)
+            self.assertListEqual([x["catalog"] for x in jobs], ["wedding_v003"])
+
+    def test_content_chunks(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "catalog.lrcat"
+            path.write_bytes(os.urandom(4096 * 1000))
+            chunks = [x for x in lightroom_sync.content_chunks(path, page_size=4096)]
+            self.assertEqual(b"".join(chunks), path.read_bytes())
+            self.assertTrue(all(len(x) % 4096 == 0 for x in chunks))
+
+            # Changing a page only changes the chunk it's in, and the next one if the page was a boundary
+            with open(path, "r+b") as f:
+                f.seek(4096 * 500)
+                f.write(os.urandom(4096))
+            changed = [x for x in lightroom_sync.content_chunks(path, page_size=4096)]
+            self.assertIn(len(set(chunks) - set(changed)), [1, 2])
+
+    def test_backup_store(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = lightroom_sync.BackupStore(Path(tmp) / "backups")
+            path = Path(tmp) / "catalog.lrcat"
+            path.write_bytes(os.urandom(4096 * 1000))
+            original = path.read_bytes()
+            first = store.snapshot(path)
+            self.assertEqual(store.snapshot(path)["id"], first["id"])
+            size = store.size()
+
+            with open(path, "r+b") as f:
+                f.write(os.urandom(4096))
+            second = store.snapshot(path)
+            self.assertNotEqual(second["id"], first["id"])
+            self.assertLessEqual(store.size() - size, 2 * lightroom_sync.BACKUP_MAX_PAGES * 4096)
+            self.assertListEqual([x["id"] for x in store.snapshots("catalog")], [first["id"], second["id"]])
+
+            store.restore(first["id"])
+            self.assertEqual(path.read_bytes(), original)
+            with self.assertRaises(KeyError):
+                store.restore("missing")
+
+            # Only the chunks of the evicted snapshot that the newest one doesn't use are deleted
+            result = store.prune(keep_last=1, keep_days=0)
+            self.assertEqual(result["snapshots"], 1)
+            self.assertGreater(result["chunks"], 0)
+            self.assertListEqual([x["id"] for x in store.snapshots()], [second["id"]])
+            store.restore(second["id"], Path(tmp) / "restored.lrcat")
+            self.assertEqual(store.prune(keep_last=1, keep_days=0, max_bytes=0)["snapshots"], 0)
+
+    def test_sync_backup(self):
+        self.test_catalog_b.write_text("newer")
+        old = self.test_catalog_a.read_text()
+        self.assertTrue(self.lrsync.sync(self.test_catalog_a.stem))
+        self.assertEqual(self.test_catalog_a.read_text(), "newer")
+
+        snapshots = self.lrsync.backups.snapshots(self.test_catalog_a.stem)
+        self.assertListEqual([x["path"] for x in snapshots], [str(self.test_catalog_a.resolve())])
+        self.lrsync.restore(snapshots[0]["id"])
+        self.assertEqual(self.test_catalog_a.read_text(), old)
+        self.assertEqual(len(self.lrsync.backups.snapshots()), 2)
+
+        # A sync without anything to back up doesn't prune
+        with patch.object(self.lrsync.backups, "prune") as prune:
+            self.assertTrue(self.lrsync.sync(self.test_catalog_c.stem))
+            prune.assert_not_called()
+
+    def test_run_sync_jobs(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            jobs = []
+            for x in range(4):
+                source = Path(tmp) / f"source_{x}.lrcat"
+                source.write_text(str(x))
+                jobs.append({"catalog": str(x), "source": source,
+                             "destinations": [Path(tmp) / f"destination_{x}.lrcat"], "devices": [x % 2]})
+            jobs.append({"catalog": "missing", "source": Path(tmp) / "missing.lrcat",
+                         "destinations": [Path(tmp) / "missing_copy.lrcat"], "devices": [0]})
+
+            self.assertSetEqual(lightroom_sync.run_sync_jobs(jobs), {"missing"})
+            for x in range(4):
+                self.assertEqual((Path(tmp) / f"destination_{x}.lrcat").read_text(), str(x))
+
+    def test_run_sync_jobs_backup(self):
+        throttled = []
+
+        class Limits:
+            drop_cache = True
+
+            def throttle(self, *paths):
+                # The copy writes to the partial file, the backup reads before it exists
+                return lambda amount: throttled.append((amount, lightroom_sync.partial_path(destination).exists()))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            source = Path(tmp) / "source.lrcat"
+            source.write_bytes(os.urandom(100000))
+            destination = Path(tmp) / "destination.lrcat"
+            destination.write_bytes(os.urandom(50000))
+            old = destination.read_bytes()
+            store = lightroom_sync.BackupStore(Path(tmp) / "backups")
+            job = {"catalog": "trip", "source": source, "destinations": [destination], "devices": [0]}
+
+            # The backup is read under the limits of the destination, like the copy that follows it
+            self.assertSetEqual(lightroom_sync.run_sync_jobs([job], io_limits=Limits(), backups=store), set())
+            self.assertEqual(job["snapshots"], 1)
+            self.assertEqual(sum(x for x, copying in throttled if not copying), len(old))
+            self.assertGreater(sum(x for x, copying in throttled if copying), 0)
+            self.assertEqual(destination.read_bytes(), source.read_bytes())
+            store.restore(store.snapshots("trip")[0]["id"])
+            self.assertEqual(destination.read_bytes(), old)
+
+    def test_fingerprint(self):
+        fingerprint = self.lrsync.fingerprint(self.test_catalog_a.resolve())
+        self.assertEqual(fingerprint, lightroom_sync.file_fingerprint(self.test_catalog_a))
+        self.assertNotEqual(fingerprint, self.lrsync.fingerprint(self.test_catalog_b.resolve()))
+
+        # A cached fingerprint is used until the file changes
+        self.cur.execute("UPDATE fingerprints SET fingerprint = 'cached'")
+        self.assertEqual(self.lrsync.fingerprint(self.test_catalog_a.resolve()), "cached")
+        self.test_catalog_a.write_text("changed")
+        self.assertNotEqual(self.lrsync.fingerprint(self.test_catalog_a.resolve()), "cached")
+
+    def test_sync_skips_identical(self):
+        self.lrsync.sync(self.test_catalog_a.stem)
+        jobs = self.lrsync.plan_sync(self.test_catalog_a.stem)
+        self.assertListEqual([x["destinations"] for x in jobs], [[]])
+
+    def test_sync_previews(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = Path(tmp) / "a" / "catalog.lrcat"
+            destination = Path(tmp) / "b" / "catalog.lrcat"
+            previews = source.parent / "catalog Previews.lrdata"
+            (previews / "0" / "1").mkdir(parents=True)
+            (previews / "0" / "1" / "preview.lrprev").write_text("preview")
+            destination.parent.mkdir()
+            destination.write_text("catalog")
+            source.write_text("catalog")
+            self.lrsync.insert_catalog("catalog")
+            self.lrsync.insert_paths([(source, "catalog"), (destination, "catalog")])
+
+            # The catalogs are identical but the previews still get synced
+            self.lrsync.sync("catalog", previews=True)
+            self.assertEqual((destination.parent / "catalog Previews.lrdata" / "0" / "1" / "preview.lrprev").read_text(),
+                             "preview")
+
+    def test_watch(self):
+        self.lrsync.sync(self.test_catalog_a.stem)
+        stop = threading.Event()
+
+        def edit_catalog():
+            time.sleep(0.2)
+            self.test_catalog_a.write_text("edited")
+            time.sleep(0.6)
+            stop.set()
+
+        editor = threading.Thread(target=edit_catalog)
+        editor.start()
+        self.lrsync.watch(debounce=0.1, interval=0.05, poll=True, stop=stop)
+        editor.join()
+        self.assertEqual(self.test_catalog_b.read_text(), "edited")
+
     def test_scan(self):
         self.cur.execute("DELETE FROM catalogs")
         self.cur.execute("DELETE FROM paths")
         self.lrsync.commit()
 
         self.lrsync.scan(Path())
-        self.cur.execute("SELECT * FROM catalogs")
-        self.assertListEqual(self.cur.fetchall(), self.test_catalogs)
+        # Directories are walked in parallel so the order of the ids isn't fixed
+        self.cur.execute("SELECT catalog_name, last_sync FROM catalogs")
+        self.assertListEqual(sorted(self.cur.fetchall()), sorted(x[1:] for x in self.test_catalogs))
 
         self.cur.execute("SELECT * FROM paths")
 
+    def test_scan_incremental(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp).resolve()
+            (root / "2020").mkdir()
+            (root / "2020" / "a.lrcat").write_text("a")
+            (root / "2020" / "a Previews.lrdata").mkdir()
+            (root / "2020" / "a Previews.lrdata" / "skip.lrcat").write_text("skip")
+            (root / "b.lrcat").write_text("b")
+
+            self.lrsync.scan(root, incremental=True)
+            self.assertListEqual(sorted(x[0] for x in self.lrsync.select_paths_under(str(root))),
+                                 [str(root / "2020" / "a.lrcat"), str(root / "b.lrcat")])
+
+            # Unchanged directories aren't listed again
+            records = lightroom_sync.walk_catalog_directories(root, self.lrsync.select_directories(str(root)))
+            self.assertListEqual([x[4] for x in records], [False, False])
+
+            (root / "2020" / "a.lrcat").unlink()
+            (root / "2020" / "c.lrcat").write_text("c")
+            self.lrsync.scan(root, incremental=True)
+            self.assertListEqual(sorted(x[0] for x in self.lrsync.select_paths_under(str(root))),
+                                 [str(root / "2020" / "c.lrcat"), str(root / "b.lrcat")])
+            self.assertIsNone(self.lrsync.catalog_id_from_name("a"))
+
+    def test_scan_incremental_unreachable(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp).resolve() / "drive"
+            (root / "2020").mkdir(parents=True)
+            (root / "2020" / "a.lrcat").write_text("a")
+            (root / "b.lrcat").write_text("b")
+            self.lrsync.scan(root, incremental=True)
+            paths = sorted(x[0] for x in self.lrsync.select_paths_under(str(root)))
+
+            # A folder that can't be listed keeps its catalogs
+            (root / "2020" / "c.lrcat").write_text("c")
+            scandir = os.scandir
+
+            def failing_scandir(path):
+                if str(path) == str(root / "2020"):
+                    raise PermissionError(13, "Permission denied", str(path))
+                return scandir(path)
+
+            with patch("os.scandir", failing_scandir):
+                self.lrsync.scan(root, incremental=True)
+            self.assertListEqual(sorted(x[0] for x in self.lrsync.select_paths_under(str(root))), paths)
+            self.assertIn(str(root / "2020"), self.lrsync.select_directories(str(root)))
+
+            # So does a drive that isn't mounted
+            root.rename(Path(tmp) / "unmounted")
+            self.lrsync.scan(root, incremental=True)
+            self.assertListEqual(sorted(x[0] for x in self.lrsync.select_paths_under(str(root))), paths)
+            self.assertIsNotNone(self.lrsync.catalog_id_from_name("a"))
+
+    def test_scan_multiple_directories(self):
+        with tempfile.TemporaryDirectory() as tmp_a, tempfile.TemporaryDirectory() as tmp_b:
+            for root in [tmp_a, tmp_b]:
+                for x in range(5):
+                    (Path(root) / str(x)).mkdir()
+                    (Path(root) / str(x) / f"catalog_{x}.lrcat").write_text(str(x))
+            self.cur.execute("DELETE FROM catalogs")
+            self.cur.execute("DELETE FROM paths")
+
+            self.lrsync.scan(tmp_a, tmp_b, workers=3, batch_size=2)
+            self.assertEqual(len(self.lrsync.select_all_catalogs()), 5)
+            self.assertEqual(len(self.lrsync.select_all_paths()), 10)
+
     def test_list_paths(self):
         self.assertEqual(len(self.lrsync.list_paths()), 3)
 
     def test_list_catalogs(self):
         self.assertEqual(len(self.lrsync.list_catalogs()), 2)
 
+    def test_print_list(self):
+        output = io.StringIO()
+        self.assertEqual(self.lrsync.print_list(output_format="json", file=output), 2)
+        self.assertListEqual([x["name"] for x in json.loads(output.getvalue())],
+                             [self.test_catalog_a.stem, self.test_catalog_c.stem])
+
+        output = io.StringIO()
+        self.lrsync.print_list(catalogs=False, output_format="jsonl", name="test_catalog_v*", offset=1, file=output)
+        self.assertListEqual([json.loads(x)["path"] for x in output.getvalue().splitlines()],
+                             [str(self.test_catalog_b.resolve())])
+
+        output = io.StringIO()
+        self.lrsync.print_list(output_format="csv", limit=1, file=output)
+        self.assertEqual(output.getvalue(), f"id,name,paths,last_sync\n1,{self.test_catalog_a.stem},2,\n")
+
+        output = io.StringIO()
+        self.assertEqual(self.lrsync.print_list(output_format="json", name="missing", file=output), 0)
+        self.assertListEqual(json.loads(output.getvalue()), [])
+
+    def test_write_rows(self):
+        rows = ({"id": x, "name": "x" * x} for x in range(1, 6))
+        output = io.StringIO()
+        self.assertEqual(lightroom_sync.write_rows(rows, (("id", "ID"), ("name", "Name")), file=output, lookahead=2), 5)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0], "ID   Name  ")
+        self.assertEqual(lines[3], "2    xx    ")
+        self.assertEqual(lines[6], "5    xxxxx ")
+
     def test_last_modified_path(self):
         self.assertEqual(self.lrsync.last_modified_path(self.test_catalog_a.stem), self.test_catalog_b.resolve())
 
+    def test_sqlite_header(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "catalog.lrcat"
+            conn = sqlite3.connect(str(path))
+            conn.execute("CREATE TABLE Adobe_images(id_local INTEGER PRIMARY KEY)")
+            conn.commit()
+            counter, cookie = lightroom_sync.sqlite_header(path)
+            conn.execute("INSERT INTO Adobe_images DEFAULT VALUES")
+            conn.commit()
+            self.assertEqual(lightroom_sync.sqlite_header(path), (counter + 1, cookie))
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.close()
+            self.assertIsNone(lightroom_sync.sqlite_header(path))
+        self.assertIsNone(lightroom_sync.sqlite_header(self.test_catalog_a))
+
+    def test_compare_replicas(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = [Path(tmp).resolve() / x / "trip.lrcat" for x in "abc"]
+            for path in paths:
+                path.parent.mkdir()
+            conn = sqlite3.connect(str(paths[0]))
+            conn.execute("CREATE TABLE Adobe_images(id_local INTEGER PRIMARY KEY, name TEXT)")
+            conn.commit()
+            conn.close()
+            for path in paths[1:]:
+                shutil.copy2(str(paths[0]), str(path))
+            self.lrsync.insert_catalog("trip")
+            self.lrsync.insert_paths([(str(x), "trip") for x in paths])
+
+            def edit(path, name):
+                stat = os.stat(str(path))
+                conn = sqlite3.connect(str(path))
+                conn.execute("INSERT INTO Adobe_images(name) VALUES (?)", (name,))
+                conn.commit()
+                conn.close()
+                # Make the edit look older than the other copies, like a drive with a clock that's behind
+                os.utime(str(path), ns=(stat.st_atime_ns, stat.st_mtime_ns - 10 ** 10))
+
+            self.assertListEqual([x["destinations"] for x in self.lrsync.plan_sync("trip")], [[]])
+            self.assertTrue(self.lrsync.sync("trip"))
+
+            # The edited copy is the source no matter its mtime, and isn't hashed
+            edit(paths[1], "edited")
+            jobs = self.lrsync.plan_sync("trip")
+            self.assertEqual(jobs[0]["source"], paths[1])
+            self.assertIsNone(jobs[0]["fingerprint"])
+            self.assertListEqual(sorted(x for job in jobs for x in job["destinations"]), [paths[0], paths[2]])
+            self.assertTrue(self.lrsync.sync("trip"))
+            self.assertEqual(paths[0].read_bytes(), paths[1].read_bytes())
+
+            # Copies edited on their own aren't overwritten
+            edit(paths[0], "first")
+            edit(paths[2], "second")
+            before = [x.read_bytes() for x in paths]
+            self.assertFalse(self.lrsync.sync("trip"))
+            self.assertListEqual([x.read_bytes() for x in paths], before)
+            self.assertListEqual(self.lrsync.select_diverged()["trip"], sorted(str(paths[x]) for x in (0, 2)))
+
+    def test_compare_replicas_online(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = [Path(tmp).resolve() / x / "trip.lrcat" for x in "abc"]
+            for path in paths:
+                path.parent.mkdir()
+                conn = sqlite3.connect(str(path))
+                conn.execute("CREATE TABLE Adobe_images(id_local INTEGER PRIMARY KEY, name TEXT)")
+                conn.commit()
+                conn.close()
+            self.lrsync.insert_catalog("trip")
+            self.lrsync.insert_paths([(str(x), "trip") for x in paths])
+            self.assertTrue(self.lrsync.sync("trip", mode="online"))
+
+            # The third copy is away while the first one is edited and synced
+            away = Path(tmp) / "away.lrcat"
+            os.rename(str(paths[2]), str(away))
+            conn = sqlite3.connect(str(paths[0]))
+            conn.execute("INSERT INTO Adobe_images(name) VALUES ('edited')")
+            conn.commit()
+            conn.close()
+            self.assertTrue(self.lrsync.sync("trip", mode="online"))
+            # The copy has a change counter of its own, which isn't mistaken for an edit
+            self.assertNotEqual(lightroom_sync.sqlite_header(paths[0]), lightroom_sync.sqlite_header(paths[1]))
+            self.assertListEqual([x["destinations"] for x in self.lrsync.plan_sync("trip")], [[]])
+
+            # The copy that was away is still as it was after the first sync, but that was from another source
+            os.rename(str(away), str(paths[2]))
+            jobs = self.lrsync.plan_sync("trip")
+            self.assertListEqual([x["destinations"] for x in jobs], [[paths[2]]])
+            self.assertListEqual([x["diverged"] for x in jobs], [[]])
+            self.assertTrue(self.lrsync.sync("trip", mode="online"))
+            self.assertListEqual([x["destinations"] for x in self.lrsync.plan_sync("trip")], [[]])
+            self.assertDictEqual(self.lrsync.select_diverged(), {})
+
+    def test_compare_replicas_interrupted_delta(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = [Path(tmp).resolve() / x / "trip.lrcat" for x in "ab"]
+            for path in paths:
+                path.parent.mkdir()
+            conn = sqlite3.connect(str(paths[0]))
+            conn.execute("CREATE TABLE Adobe_images(id_local INTEGER PRIMARY KEY, name TEXT)")
+            conn.commit()
+            conn.close()
+            shutil.copy2(str(paths[0]), str(paths[1]))
+            self.lrsync.insert_catalog("trip")
+            self.lrsync.insert_paths([(str(x), "trip") for x in paths])
+            self.assertTrue(self.lrsync.sync("trip", mode="delta"))
+
+            conn = sqlite3.connect(str(paths[0]))
+            conn.executemany("INSERT INTO Adobe_images(name) VALUES (?)", [("x" * 1000,) for _ in range(20)])
+            conn.commit()
+            conn.close()
+
+            def interrupt(copied):
+                raise OSError("Link went down")
+
+            # The header is written first, so the half written copy has the header of the source
+            self.lrsync.commit()
+            checkpoints = lightroom_sync.CopyCheckpoints(self.test_db_name)
+            with patch("lightroom_sync.lightroom_sync.DELTA_PAGES_PER_BLOCK", 1), self.assertRaises(OSError):
+                lightroom_sync.delta_copy(paths[0], paths[1], checkpoints=checkpoints, throttle=interrupt)
+            checkpoints.close()
+            self.assertEqual(lightroom_sync.sqlite_header(paths[0]), lightroom_sync.sqlite_header(paths[1]))
+            self.assertNotEqual(paths[0].read_bytes(), paths[1].read_bytes())
+
+            jobs = self.lrsync.plan_sync("trip")
+            self.assertListEqual([x["destinations"] for x in jobs], [[paths[1]]])
+            self.assertListEqual([x["diverged"] for x in jobs], [[]])
+            self.assertTrue(self.lrsync.sync("trip", mode="delta"))
+            self.assertEqual(paths[0].read_bytes(), paths[1].read_bytes())
+            self.assertSetEqual(self.lrsync.select_interrupted_copies(paths), set())
+            self.assertListEqual([x["destinations"] for x in self.lrsync.plan_sync("trip")], [[]])
+
     def test_clear(self):
         self.cur.execute("DELETE FROM catalogs")
         self.cur.execute("DELETE FROM paths")
@@ -260,7 +803,582 @@ class TestLightroomSync(TestCase):
         self.assertEqual(lightroom_sync.filename_to_name_and_version("lr_v00033_v006.lrcat"), ("lr_v00033", 6))
         self.assertEqual(lightroom_sync.filename_to_name_and_version("snelhest_fest_v023.lrcat"), ("snelhest_fest", 23))
 
+    def test_iter_catalogs(self):
+        catalogs = lightroom_sync.iter_catalogs(self.test_catalog_a.parent, self.test_catalog_c.parent)
+        self.assertNotIsInstance(catalogs, list)
+        self.assertListEqual(sorted(catalogs), sorted([self.test_catalog_a, self.test_catalog_c]))
+
+    def test_polling_watcher(self):
+        watcher = lightroom_sync.PollingWatcher([self.test_catalog_a, self.test_catalog_b], interval=0.01)
+        self.assertSetEqual(watcher.wait(0.01), set())
+        self.test_catalog_a.write_text("changed")
+        self.assertSetEqual(watcher.wait(0.01), {str(self.test_catalog_a)})
+
+    @skipUnless(sys.platform.startswith("linux"), "inotify is only available on Linux")
+    def test_inotify_watcher(self):
+        watcher = lightroom_sync.InotifyWatcher([self.test_catalog_a.resolve(), self.test_catalog_c.resolve()])
+        try:
+            self.assertSetEqual(watcher.wait(0.01), set())
+            Path(f"{self.test_catalog_a}-journal").write_text("journal")
+            Path(f"{self.test_catalog_a}-journal").unlink()
+            self.test_catalog_a.with_name("unrelated.txt").write_text("unrelated")
+            self.test_catalog_a.with_name("unrelated.txt").unlink()
+            self.assertSetEqual(watcher.wait(1), {str(self.test_catalog_a.resolve())})
+        finally:
+            watcher.close()
+
+    def test_sync_tree(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = Path(tmp) / "source.lrdata"
+            destination = Path(tmp) / "destination.lrdata"
+            (source / "a" / "b").mkdir(parents=True)
+            (source / "a" / "b" / "new.lrprev").write_text("new")
+            (source / "same.lrprev").write_text("same")
+            (destination / "old" / "folder").mkdir(parents=True)
+            (destination / "old" / "folder" / "old.lrprev").write_text("old")
+            lightroom_sync.shutil.copy2(str(source / "same.lrprev"), str(destination / "same.lrprev"))
+
+            stats = lightroom_sync.sync_tree(source, destination, workers=2)
+            self.assertDictEqual(stats, {"copied": 1, "deleted": 1, "bytes": 3})
+            self.assertEqual((destination / "a" / "b" / "new.lrprev").read_text(), "new")
+            self.assertFalse((destination / "old").exists())
+            self.assertEqual(lightroom_sync.tree_listing(source), lightroom_sync.tree_listing(destination))
+
+    def test_file_fingerprint(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            a = Path(tmp) / "a.lrcat"
+            b = Path(tmp) / "b.lrcat"
+            a.write_bytes(b"x" * 10000)
+            b.write_bytes(b"x" * 9999 + b"y")
+            self.assertEqual(lightroom_sync.file_fingerprint(a, chunk_size=1000),
+                             lightroom_sync.file_fingerprint(a, chunk_size=1000, workers=1))
+            self.assertNotEqual(lightroom_sync.file_fingerprint(a, chunk_size=1000),
+                                lightroom_sync.file_fingerprint(b, chunk_size=1000))
+            self.assertEqual(lightroom_sync.file_fingerprint(a, chunk_size=1000),
+                             lightroom_sync.file_fingerprint(a, chunk_size=1000, mapped=True))
+
+    def test_verify_copies(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = Path(tmp) / "source.lrcat"
+            conn = sqlite3.connect(str(source))
+            conn.execute("CREATE TABLE Adobe_images(id_local INTEGER PRIMARY KEY, data BLOB)")
+            conn.executemany("INSERT INTO Adobe_images(data) VALUES (randomblob(1000))", [()] * 100)
+            conn.commit()
+            conn.close()
+            good = Path(tmp) / "good.lrcat"
+            bad = Path(tmp) / "bad.lrcat"
+            shutil.copy(str(source), str(good))
+            data = bytearray(source.read_bytes())
+            data[4096:8192] = b"\xff" * 4096
+            bad.write_bytes(bytes(data))
+
+            results = lightroom_sync.verify_copies(source, [good, bad])
+            self.assertTrue(results[good]["ok"])
+            self.assertEqual(results[good]["quick_check"], "ok")
+            self.assertFalse(results[bad]["matches"])
+            self.assertNotEqual(lightroom_sync.verify_copies(source, [bad], hashed=False)[bad]["quick_check"], "ok")
+
+            # Checking a copy in WAL mode doesn't leave -wal and -shm files next to it
+            conn = sqlite3.connect(str(source))
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.close()
+            shutil.copy(str(source), str(good))
+            self.assertEqual(lightroom_sync.verify_copies(source, [good])[good]["quick_check"], "ok")
+            self.assertListEqual(sorted(x.name for x in Path(tmp).glob("good.lrcat-*")), [])
+
+    def test_sync_verify(self):
+        copy_catalogs = lightroom_sync.copy_catalogs
+
+        def damaged_copies(source, destinations, **kwargs):
+            results = copy_catalogs(source, destinations, **kwargs)
+            for destination in destinations:
+                destination.write_text("damaged")
+            return results
+
+        with patch("lightroom_sync.lightroom_sync.copy_catalogs", damaged_copies):
+            self.assertTrue(self.lrsync.sync(self.test_catalog_a.stem, verify=True))
+        self.assertEqual(self.test_catalog_a.read_text(), self.test_catalog_b.read_text())
+        self.cur.execute("SELECT destination, ok, attempt FROM verifications ORDER BY verification_id")
+        self.assertListEqual(self.cur.fetchall(), [(str(self.test_catalog_a.resolve()), 0, 0),
+                                                   (str(self.test_catalog_a.resolve()), 1, 1)])
+
+    def test_benchmarks(self):
+        from benchmarks import benchmark
+        with tempfile.TemporaryDirectory() as tmp:
+            results = benchmark.run_benchmarks(tmp, drives=2, catalogs=3, depth=2, previews=2, size=64 * 1024,
+                                               repeat=1)
+        self.assertIn("sync_delta", results["results"])
+        self.assertGreater(results["results"]["sync_copy"]["bytes"], 0)
+        self.assertGreater(results["results"]["sync_delta"]["bytes"], 0)
+        self.assertEqual(results["results"]["sync_unchanged"]["bytes"], 0)
+        json_results = json.loads(json.dumps(results))
+        rows, regressions = benchmark.compare_results(json_results, json_results)
+        self.assertEqual(len(rows), len(results["results"]))
+        self.assertListEqual(regressions, [])
+
+    def test_metrics(self):
+        metrics = lightroom_sync.Metrics()
+        with metrics.phase("sync.copy"):
+            metrics.incr("stats", 3)
+        metrics.add_copy('/drive/"quoted".lrcat', {"bytes": 2 * lightroom_sync.MB, "read": 10, "seconds": 2.0})
+
+        report = metrics.report()
+        self.assertIn("sync.copy", report["phases"])
+        self.assertEqual(report["counters"]["stats"], 3)
+        self.assertEqual(report["destinations"]['/drive/"quoted".lrcat']["mb_per_s"], 1.0)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            metrics.write_prometheus(Path(tmp) / "lightroom_sync.prom")
+            prom = (Path(tmp) / "lightroom_sync.prom").read_text()
+        self.assertIn('lightroom_sync_count{name="stats"} 3', prom)
+        self.assertIn('lightroom_sync_destination_mb_per_s{destination="/drive/\\"quoted\\".lrcat"} 1.0', prom)
+
+    def test_cli_metrics_and_profile(self):
+        cwd = os.getcwd()
+        root = logging.getLogger()
+        handlers, level = root.handlers[:], root.level
+        with tempfile.TemporaryDirectory() as tmp:
+            # The CLI keeps its database in the current directory
+            os.chdir(tmp)
+            try:
+                # list reads the database itself even while a daemon is running
+                with patch("lightroom_sync.lightroom_sync.daemon_command") as daemon_command:
+                    result = CliRunner().invoke(lightroom_sync.cli, ["--metrics", "metrics.json",
+                                                                     "--prometheus", "metrics.prom",
+                                                                     "--profile", "list.prof",
+                                                                     "list"])
+                daemon_command.assert_not_called()
+            finally:
+                os.chdir(cwd)
+                # The CLI configures logging to a file in tmp, which is gone after this test
+                for handler in root.handlers:
+                    handler.close()
+                root.handlers, root.level = handlers, level
+            self.assertEqual(result.exit_code, 0)
+            report = json.loads((Path(tmp) / "metrics.json").read_text())
+            self.assertIn("list", report["phases"])
+            self.assertGreater(report["counters"]["db_queries"], 0)
+            self.assertTrue((Path(tmp) / "metrics.prom").is_file())
+            self.assertTrue((Path(tmp) / "list.prof").is_file())
+
+    def test_startup(self):
+        code = ("import logging, time; start = time.perf_counter(); "
+                "from lightroom_sync import lightroom_sync; "
+                "print(time.perf_counter() - start, len(logging.getLogger().handlers))")
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(os.environ, PYTHONPATH=os.getcwd())
+            output = subprocess.run([sys.executable, "-c", code], cwd=tmp, env=env, check=True,
+                                    stdout=subprocess.PIPE, universal_newlines=True).stdout.split()
+            # Importing doesn't configure logging or create a log file
+            self.assertEqual(output[1], "0")
+            self.assertListEqual(os.listdir(tmp), [])
+        self.assertLess(float(output[0]), lightroom_sync.STARTUP_BUDGET)
+
+    def test_lowered_io_priority(self):
+        with patch("lightroom_sync.lightroom_sync.get_io_priority", return_value=(2, 4)), \
+                patch("lightroom_sync.lightroom_sync.set_io_priority", return_value=True) as set_io_priority:
+            with lightroom_sync.lowered_io_priority("idle"):
+                set_io_priority.assert_called_once_with("idle")
+            set_io_priority.assert_called_with((2, 4))
+
+            set_io_priority.reset_mock()
+            with lightroom_sync.lowered_io_priority(None):
+                pass
+            set_io_priority.assert_not_called()
+
+    @skipUnless(lightroom_sync.get_io_priority() is not None, "Needs ioprio_get")
+    def test_sync_restores_io_priority(self):
+        priority = lightroom_sync.get_io_priority()
+        self.assertTrue(self.lrsync.sync(io_priority="idle"))
+        self.assertEqual(lightroom_sync.get_io_priority(), priority)
+
+    def test_stat_paths(self):
+        stat = os.stat
+
+        def hung_stat(path, *args, **kwargs):
+            if "hung" in str(path):
+                time.sleep(0.5)
+            return stat(path, *args, **kwargs)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            reachable = Path(tmp) / "reachable.lrcat"
+            reachable.write_text("reachable")
+            with patch("os.stat", hung_stat):
+                start = time.monotonic()
+                stats, failed = lightroom_sync.stat_paths([reachable, Path(tmp) / "missing.lrcat",
+                                                           Path(tmp) / "hung.lrcat"], timeout=0.1)
+                self.assertLess(time.monotonic() - start, 0.4)
+            self.assertListEqual([x for x in stats], [reachable])
+            self.assertDictEqual(failed, {Path(tmp) / "missing.lrcat": "missing",
+                                          Path(tmp) / "hung.lrcat": "timeout"})
+            for thread in lightroom_sync._hung_stats.values():
+                thread.join()
+
+    def test_stat_paths_hung_volume(self):
+        stat = os.stat
+        calls = []
+
+        def hung_stat(path, *args, **kwargs):
+            calls.append(path)
+            if "hung" in str(path):
+                time.sleep(0.5)
+            return stat(path, *args, **kwargs)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = [Path(tmp) / x for x in ("a.lrcat", "b.lrcat", "hung.lrcat", "next.lrcat")]
+            for path in paths:
+                path.write_text(path.name)
+            volumes = {paths[0]: "/a", paths[1]: "/a", paths[2]: "/hung", paths[3]: "/hung"}
+            with patch("os.stat", hung_stat):
+                stats, failed = lightroom_sync.stat_paths(paths, timeout=0.1, volumes=volumes)
+                self.assertListEqual([x for x in stats], paths[:2])
+                self.assertDictEqual(failed, {paths[2]: "timeout", paths[3]: "timeout"})
+
+                # A volume that's still hung isn't stat'ed again
+                start = time.monotonic()
+                stats, failed = lightroom_sync.stat_paths(paths, timeout=0.1, volumes=volumes)
+                self.assertLess(time.monotonic() - start, 0.1)
+                self.assertListEqual([x for x in stats], paths[:2])
+                self.assertEqual(calls.count(paths[2]), 1)
+
+                lightroom_sync._hung_stats["/hung"].join()
+                stats, failed = lightroom_sync.stat_paths(paths[3:], timeout=0.1, volumes=volumes)
+                self.assertListEqual([x for x in stats], paths[3:])
+
+    def test_volume_of(self):
+        mounts = ["/", "/mnt/nas", "/mnt/nas backup"]
+        self.assertEqual(lightroom_sync.volume_of("/mnt/nas/catalog.lrcat", mounts), "/mnt/nas")
+        self.assertEqual(lightroom_sync.volume_of("/mnt/nas backup/catalog.lrcat", mounts), "/mnt/nas backup")
+        self.assertEqual(lightroom_sync.volume_of("/home/catalog.lrcat", mounts), "/")
+        self.assertEqual(lightroom_sync.volume_of("/Volumes/Drive/catalog.lrcat", []), "/Volumes/Drive")
+
+    def test_offline_paths(self):
+        stat = os.stat
+        hung = str(self.test_catalog_b.resolve())
+
+        def hung_stat(path, *args, **kwargs):
+            if str(path) == hung:
+                time.sleep(0.5)
+            return stat(path, *args, **kwargs)
+
+        # The hung catalog is on a volume of its own
+        mounts = lightroom_sync.mount_points() + [str(self.test_catalog_b.resolve().parent)]
+        self.lrsync.stat_timeout = 0.1
+        with patch("lightroom_sync.lightroom_sync.mount_points", return_value=mounts):
+            with patch("os.stat", hung_stat):
+                self.assertEqual(self.lrsync.last_modified_path(self.test_catalog_a.stem),
+                                 self.test_catalog_a.resolve())
+            offline = self.lrsync.select_offline()
+            self.assertListEqual([x for x in offline], [hung])
+            self.assertEqual(offline[hung][1], "timeout")
+
+            # The volume isn't tried again until it's retried, so nothing on it is reachable
+            self.assertEqual(self.lrsync.last_modified_path(self.test_catalog_a.stem), self.test_catalog_a.resolve())
+            self.assertListEqual([x["destinations"] for x in self.lrsync.plan_sync()], [[], []])
+
+            for thread in lightroom_sync._hung_stats.values():
+                thread.join()
+            self.lrsync.offline_volumes.clear()
+            self.assertEqual(self.lrsync.last_modified_path(self.test_catalog_a.stem),
+                             self.test_catalog_b.resolve())
+            self.assertEqual(len(self.lrsync.plan_sync()), 2)
+            self.assertDictEqual(self.lrsync.select_offline(), {})
+
     def test_mtimes(self):
         file_list = [x for x in self.not_test_catalog.parent.rglob("*") if x.is_file()]
         files_mtimes = {x: y for x, y in lightroom_sync.mtimes(file_list).items()}
         self.assertDictEqual(lightroom_sync.mtimes(file_list), files_mtimes)
+
+    def test_sqlite_page_size(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            catalog = Path(tmp) / "catalog.lrcat"
+            conn = sqlite3.connect(str(catalog))
+            conn.execute("PRAGMA page_size = 8192")
+            conn.execute("CREATE TABLE images(id INTEGER PRIMARY KEY)")
+            conn.close()
+            self.assertEqual(lightroom_sync.sqlite_page_size(catalog), 8192)
+        self.assertIsNone(lightroom_sync.sqlite_page_size(self.test_catalog_a))
+
+    def test_delta_copy(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = Path(tmp) / "source.lrcat"
+            destination = Path(tmp) / "destination.lrcat"
+            conn = sqlite3.connect(str(source))
+            conn.execute("CREATE TABLE images(id INTEGER PRIMARY KEY, name TEXT)")
+            conn.executemany("INSERT INTO images(name) VALUES (?)", [(str(x) * 50,) for x in range(2000)])
+            conn.commit()
+
+            # Missing destination falls back to a full copy
+            written = lightroom_sync.delta_copy(source, destination)["bytes"]
+            self.assertEqual(written, source.stat().st_size)
+
+            conn.execute("UPDATE images SET name = 'changed' WHERE id = 1")
+            conn.commit()
+            conn.close()
+            written = lightroom_sync.delta_copy(source, destination)["bytes"]
+            self.assertGreater(written, 0)
+            self.assertLess(written, source.stat().st_size)
+            self.assertEqual(source.read_bytes(), destination.read_bytes())
+
+            # The copy is synced to disk before the checkpoint that marks it half written is cleared
+            calls = []
+
+            class Checkpoints:
+                def save(self, source, destination, offset):
+                    calls.append("save")
+
+                def clear(self, destination):
+                    calls.append("clear")
+
+            fsync = os.fsync
+            conn = sqlite3.connect(str(source))
+            conn.execute("UPDATE images SET name = 'changed again' WHERE id = 1")
+            conn.commit()
+            conn.close()
+            with patch("os.fsync", lambda fd: calls.append("fsync") or fsync(fd)):
+                lightroom_sync.delta_copy(source, destination, checkpoints=Checkpoints())
+            self.assertListEqual(calls, ["save", "fsync", "clear"])
+
+    def test_online_copy(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = Path(tmp) / "source.lrcat"
+            destination = Path(tmp) / "destination.lrcat"
+            destination.write_text("not a database")
+            conn = sqlite3.connect(str(source))
+            conn.execute("CREATE TABLE images(id INTEGER PRIMARY KEY, name TEXT)")
+            conn.executemany("INSERT INTO images(name) VALUES (?)", [(str(x) * 50,) for x in range(500)])
+            conn.commit()
+            # Uncommitted changes in the source aren't part of the copy
+            conn.execute("DELETE FROM images")
+
+            lightroom_sync.online_copy(source, destination, pages=1, sleep=0)
+            conn.rollback()
+            conn.close()
+            copy = sqlite3.connect(str(destination))
+            self.assertEqual(copy.execute("SELECT COUNT(*) FROM images").fetchone()[0], 500)
+            copy.close()
+            self.assertEqual(destination.stat().st_mtime_ns, source.stat().st_mtime_ns)
+
+    def test_copy_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = Path(tmp) / "source.lrcat"
+            source.write_bytes(os.urandom(300000))
+            for strategy in lightroom_sync.COPY_STRATEGIES:
+                destination = Path(tmp) / f"{strategy}.lrcat"
+                destination.write_text("old and longer " * 100000)
+                used = lightroom_sync.copy_file(source, destination, strategies=(strategy, "buffered"))
+                self.assertIn(used, [strategy, "buffered"])
+                self.assertEqual(destination.read_bytes(), source.read_bytes())
+                self.assertEqual(destination.stat().st_mtime_ns, source.stat().st_mtime_ns)
+
+    def test_full_copy_resumes(self):
+        class Interrupted(lightroom_sync.CopyCheckpoints):
+            def save(self, source, destination, offset):
+                super().save(source, destination, offset)
+                raise OSError("Link went down")
+
+        with tempfile.TemporaryDirectory() as tmp:
+            source = Path(tmp) / "source.lrcat"
+            source.write_bytes(os.urandom(300000))
+            destination = Path(tmp) / "destination.lrcat"
+            destination.write_text("old")
+
+            self.lrsync.commit()
+            checkpoints = Interrupted(self.test_db_name)
+            with self.assertRaises(OSError):
+                lightroom_sync.full_copy(source, destination, checkpoints=checkpoints, interval=100000)
+            checkpoints.close()
+            # The destination is untouched until the copy is done
+            self.assertEqual(destination.read_text(), "old")
+            self.assertTrue(lightroom_sync.partial_path(destination).is_file())
+
+            checkpoints = lightroom_sync.CopyCheckpoints(self.test_db_name)
+            result = lightroom_sync.full_copy(source, destination, checkpoints=checkpoints, interval=100000)
+            self.assertEqual(result["resumed"], 100000)
+            self.assertEqual(result["bytes"], 200000)
+            self.assertEqual(destination.read_bytes(), source.read_bytes())
+            self.assertFalse(lightroom_sync.partial_path(destination).exists())
+            self.assertEqual(checkpoints.conn.execute("SELECT COUNT(*) FROM checkpoints").fetchone()[0], 0)
+
+            # A checkpoint of a source that changed since is ignored
+            checkpoints.save(source, destination, 100000)
+            source.write_bytes(os.urandom(300000))
+            self.assertEqual(checkpoints.resume(source, destination, lightroom_sync.partial_path(destination)), 0)
+            checkpoints.close()
+
+    def test_copy_file_throttled(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = Path(tmp) / "source.lrcat"
+            source.write_bytes(os.urandom(3 * lightroom_sync.THROTTLE_CHUNK_SIZE + 1000))
+            destination = Path(tmp) / "destination.lrcat"
+            throttled = []
+            lightroom_sync.copy_file(source, destination, strategies=("copy_file_range", "buffered"),
+                                     throttle=throttled.append, drop_cache=True)
+            self.assertEqual(destination.read_bytes(), source.read_bytes())
+            self.assertEqual(len(throttled), 4)
+            self.assertEqual(sum(throttled), source.stat().st_size)
+
+    def test_copy_catalog_throttled_modes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = Path(tmp) / "source.lrcat"
+            source.write_bytes(os.urandom(10000))
+            for mode in lightroom_sync.THROTTLED_COPY_MODES:
+                destination = Path(tmp) / f"{mode}.lrcat"
+                lightroom_sync.copy_catalog(source, destination, mode=mode,
+                                            io_limits=lightroom_sync.IOLimits(1e9))
+                self.assertEqual(destination.read_bytes(), source.read_bytes())
+
+    def test_token_bucket(self):
+        bucket = lightroom_sync.TokenBucket(10 * lightroom_sync.MB, burst=lightroom_sync.MB)
+        start = time.monotonic()
+        self.assertEqual(bucket.consume(lightroom_sync.MB), 0.0)
+        for _ in range(3):
+            bucket.consume(lightroom_sync.MB)
+        # The burst is free, the other 3 MB take 0.3 seconds at 10 MB/s
+        self.assertGreater(time.monotonic() - start, 0.25)
+
+    def test_io_limits(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.assertIsNone(lightroom_sync.IOLimits().throttle(tmp))
+            self.lrsync.store_setting("rate_limit", "0")
+            self.lrsync.store_setting(f"rate_limit:{tmp}", "5")
+            self.lrsync.store_setting("rate_limit:/not/mounted", "1")
+            self.lrsync.store_setting("drop_cache", "true")
+            io_limits = self.lrsync.io_limits()
+            self.assertDictEqual(io_limits.rates, {Path(tmp).stat().st_dev: 5 * lightroom_sync.MB})
+            self.assertTrue(io_limits.drop_cache)
+            self.assertIsNotNone(io_limits.throttle(Path(tmp) / "catalog.lrcat"))
+
+            # Limits given directly take precedence over the settings
+            io_limits = self.lrsync.io_limits(rate_limit=2, device_limits={tmp: 3}, drop_cache=False)
+            self.assertEqual(io_limits.default, 2 * lightroom_sync.MB)
+            self.assertDictEqual(io_limits.rates, {Path(tmp).stat().st_dev: 3 * lightroom_sync.MB})
+            self.assertFalse(io_limits.drop_cache)
+
+    def test_cli_sync_fails(self):
+        cwd = os.getcwd()
+        root = logging.getLogger()
+        handlers, level = root.handlers[:], root.level
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                for name in ("a", "b"):
+                    Path(name).mkdir()
+                    Path(name, "trip.lrcat").write_text(name)
+                os.utime("a/trip.lrcat", (0, 0))
+                # A directory in the way of the partial copy makes the copy fail
+                lightroom_sync.partial_path(Path("a", "trip.lrcat").resolve()).mkdir()
+                runner = CliRunner()
+                self.assertEqual(runner.invoke(lightroom_sync.cli, ["--no-daemon", "scan", "."]).exit_code, 0)
+                result = runner.invoke(lightroom_sync.cli, ["--no-daemon", "sync", "--all", "--no-backup"])
+                self.assertEqual(result.exit_code, 1)
+                self.assertEqual(Path("a", "trip.lrcat").read_text(), "a")
+            finally:
+                os.chdir(cwd)
+                for handler in root.handlers:
+                    handler.close()
+                root.handlers, root.level = handlers, level
+
+    def test_cli_config(self):
+        cwd = os.getcwd()
+        root = logging.getLogger()
+        handlers, level = root.handlers[:], root.level
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                runner = CliRunner()
+                self.assertEqual(runner.invoke(lightroom_sync.cli, ["config", "rate_limit", "20"]).exit_code, 0)
+                self.assertEqual(runner.invoke(lightroom_sync.cli, ["config", "ionice", "idle"]).exit_code, 0)
+                self.assertNotEqual(runner.invoke(lightroom_sync.cli, ["config", "ionice", "fast"]).exit_code, 0)
+                self.assertNotEqual(runner.invoke(lightroom_sync.cli, ["config", "speed", "1"]).exit_code, 0)
+                self.assertEqual(runner.invoke(lightroom_sync.cli, ["config"]).output,
+                                 "ionice = idle\nrate_limit = 20\n")
+                runner.invoke(lightroom_sync.cli, ["config", "ionice", "--unset"])
+                self.assertEqual(runner.invoke(lightroom_sync.cli, ["config", "ionice"]).output, "\n")
+            finally:
+                os.chdir(cwd)
+                for handler in root.handlers:
+                    handler.close()
+                root.handlers, root.level = handlers, level
+
+    def test_daemon(self):
+        self.lrsync.commit()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "daemon.sock"
+            daemon = lightroom_sync.SyncDaemon(self.lrsync, path)
+            stop = threading.Event()
+            responses = {}
+
+            def client():
+                try:
+                    while not path.exists():
+                        time.sleep(0.01)
+                    for command, args in [("status", None), ("list", None), ("sync", {"catalog": None}),
+                                          ("stop", None), ("scan", {"directories": [str(Path(tmp) / "missing")]})]:
+                        responses[command] = lightroom_sync.daemon_request(command, args, path=path)
+                finally:
+                    stop.set()
+
+            thread = threading.Thread(target=client)
+            thread.start()
+            daemon.serve(stop)
+            thread.join()
+
+            self.assertFalse(path.exists())
+            self.assertIsNone(lightroom_sync.daemon_request("status", path=path))
+        self.assertEqual(responses["status"]["result"]["catalogs"], 2)
+        self.assertIsNone(responses["status"]["result"]["busy"])
+        self.assertIn(self.test_catalog_a.stem, responses["list"]["output"])
+        self.assertEqual(responses["list"]["result"], 2)
+        self.assertTrue(responses["sync"]["result"])
+        self.assertEqual(self.test_catalog_a.read_text(), self.test_catalog_b.read_text())
+        self.assertFalse(responses["stop"]["ok"])
+        self.assertTrue(responses["scan"]["ok"])
+        self.assertEqual(daemon.served, 3)
+
+    def test_daemon_status_offline_volumes(self):
+        self.lrsync.commit()
+        daemon = lightroom_sync.SyncDaemon(self.lrsync, "unused.sock")
+        # The volumes a command found offline are only published once it's done
+        self.lrsync.offline_volumes["/mnt/nas"] = time.monotonic()
+        self.assertListEqual(daemon.status()["offline_volumes"], [])
+        self.assertTrue(daemon.run("list", {})["ok"])
+        self.assertListEqual(daemon.status()["offline_volumes"], ["/mnt/nas"])
+
+    @skipUnless(os.path.exists("/dev/full"), "needs /dev/full")
+    def test_fanout_copy_fails_on_close(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = Path(tmp) / "source.lrcat"
+            source.write_bytes(os.urandom(10000))
+            good = Path(tmp) / "good.lrcat"
+            full = Path(tmp) / "full.lrcat"
+            # Writes to /dev/full are buffered and only fail when the file is flushed after the last chunk
+            os.symlink("/dev/full", str(lightroom_sync.partial_path(full)))
+            errors = []
+
+            def copy():
+                try:
+                    lightroom_sync.fanout_copy(source, [good, full], buffer_size=4096)
+                except OSError as e:
+                    errors.append(e)
+
+            thread = threading.Thread(target=copy, daemon=True)
+            thread.start()
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+            self.assertEqual(len(errors), 1)
+            self.assertEqual(good.read_bytes(), source.read_bytes())
+            self.assertFalse(os.path.lexists(str(lightroom_sync.partial_path(full))))
+            self.assertFalse(full.exists())
+
+    def test_fanout_copy(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = Path(tmp) / "source.lrcat"
+            source.write_bytes(os.urandom(100000))
+            destinations = [Path(tmp) / f"destination_{x}.lrcat" for x in range(3)]
+
+            stats = lightroom_sync.fanout_copy(source, destinations, buffer_size=4096, queue_size=2)
+            for destination in destinations:
+                self.assertEqual(destination.read_bytes(), source.read_bytes())
+                self.assertEqual(stats[destination]["bytes"], 100000)
+                self.assertIn("mb_per_s", stats[destination])